@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Import-time benchmark of the coupled_simulation package.
+
+Imports each target in a fresh interpreter, several times, and reports the
+median import time and whether TESPy was loaded on the way. Short-lived
+helper processes and worker pools only import the deck handling and result
+parsing modules, which must stay free of TESPy and CoolProp.
+
+usage: bench_import.py [-r repeats] [-l limit] [-o results.json]
+
+With -l the script exits with status 1 if one of the light targets takes
+longer than limit seconds or imports TESPy.
+
+__author__ = "fgasa"
+
+"""
+
+import getopt
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# (statement, light) - light targets must not import TESPy
+TARGETS = [
+    ('import coupled_simulation', True),
+    ('from coupled_simulation import utilities', True),
+    ('from coupled_simulation import geostorage', True),
+    ('from coupled_simulation import coupling', True),
+    ('from coupled_simulation import powerplant', True),
+    ('from coupled_simulation.powerplant import _import_tespy; _import_tespy()', False),
+]
+
+PROBE = (
+    'import sys, time\n'
+    't0 = time.perf_counter()\n'
+    '{statement}\n'
+    'print(time.perf_counter() - t0, "tespy" in sys.modules, "numpy" in sys.modules)\n'
+)
+
+
+def time_import(statement, repeats):
+    '''
+    Times a statement in fresh interpreters
+
+    :param statement: import statement
+    :param type: str
+    :param repeats: number of interpreters
+    :param type: int
+    :returns: dict with median and minimum time and the loaded heavy modules
+    '''
+    times = []
+    for _ in range(repeats):
+        proc = subprocess.run(
+            [sys.executable, '-c', PROBE.format(statement=statement)],
+            cwd=REPO_DIR, capture_output=True, text=True
+        )
+        if proc.returncode != 0:
+            return {'error': proc.stderr.strip().splitlines()[-1:]}
+        seconds, tespy, numpy = proc.stdout.split()[-3:]
+        times.append(float(seconds))
+
+    return {
+        'median': statistics.median(times),
+        'min': min(times),
+        'tespy': tespy == 'True',
+        'numpy': numpy == 'True',
+    }
+
+
+def main(argv):
+    repeats = 5
+    limit = None
+    output = None
+
+    try:
+        opts, args = getopt.getopt(argv, 'hr:l:o:', ['repeats=', 'limit=', 'output='])
+    except getopt.GetoptError:
+        print('bench_import.py [-r repeats] [-l limit] [-o results.json]')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print('bench_import.py [-r repeats] [-l limit] [-o results.json]')
+            sys.exit()
+        elif opt in ('-r', '--repeats'):
+            repeats = int(arg)
+        elif opt in ('-l', '--limit'):
+            limit = float(arg)
+        elif opt in ('-o', '--output'):
+            output = arg
+
+    results = {}
+    failed = False
+    print("=" * 111)
+    print(f"{'Import':76s} {'median [s]':>10s} {'min [s]':>10s} {'TESPy':>6s} {'NumPy':>6s}")
+    for statement, light in TARGETS:
+        result = time_import(statement, repeats)
+        results[statement] = result
+        if 'error' in result:
+            print(f"{statement:76s} failed: {' '.join(result['error'])}")
+            failed = True
+            continue
+        print(f"{statement:76s} {result['median']:10.3f} {result['min']:10.3f} "
+              f"{str(result['tespy']):>6s} {str(result['numpy']):>6s}")
+        if light and limit is not None and (result['tespy'] or result['median'] > limit):
+            failed = True
+    print("=" * 111)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'repeats': repeats, 'python': sys.version.split()[0], 'imports': results}, f, indent=1)
+        print(f"{'Results written to:':30s} {output}")
+
+    if limit is not None and failed:
+        print(f"Light imports exceed {limit} s or load TESPy.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end benchmark of the coupling layer.
+
+Runs the bundled testdata scenarios against the stub storage simulator in
+stub_flow.py, so the Python side of the coupler can be timed reproducibly
+without OPM installed. For each scenario the wall time, the storage
+iterations per timestep and the per-phase cost from the timing profile are
+reported and saved as JSON.
+
+usage: run_benchmarks.py [-s steps] [-o results.json] [-k] [scenario ...]
+
+__author__ = "fgasa"
+
+"""
+
+import getopt
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+TESTDATA_DIR = os.path.join(REPO_DIR, 'testdata')
+
+
+def find_scenarios(testdata_dir=TESTDATA_DIR):
+    '''
+    Lists all scenarios in testdata with a main control file
+
+    :returns: dict mapping scenario directory name to main control file name
+    '''
+    scenarios = {}
+    for path in sorted(glob.glob(os.path.join(testdata_dir, '*', '*.main_ctrl.json'))):
+        scenarios[os.path.basename(os.path.dirname(path))] = os.path.basename(path)
+    return scenarios
+
+
+def write_stub_executable(path):
+    '''
+    Writes a wrapper script that runs stub_flow.py with the current interpreter
+
+    :returns: no return value
+    '''
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\n')
+        f.write(f'exec "{sys.executable}" "{os.path.join(BENCH_DIR, "stub_flow.py")}" "$@"\n')
+    os.chmod(path, 0o755)
+
+
+def prepare_scenario(name, ctrl_file, steps, target_dir, stub_path, stub_args):
+    '''
+    Copies a scenario and points its storage model to the stub simulator
+
+    :returns: path to the main control file of the copy
+    '''
+    scenario_dir = os.path.join(target_dir, name)
+    shutil.copytree(os.path.join(TESTDATA_DIR, name), scenario_dir)
+    main_ctrl = os.path.join(scenario_dir, ctrl_file)
+
+    with open(main_ctrl) as f:
+        main_data = json.load(f)
+    main_data['t_steps_total'] = steps
+    main_data['profile'] = 'True'
+    main_data['debug'] = 'False'
+    with open(main_ctrl, 'w') as f:
+        json.dump(main_data, f, indent=1)
+
+    scenario = ctrl_file[:-len('.main_ctrl.json')]
+    geostorage_ctrl = os.path.join(scenario_dir, main_data['geostorage_path'],
+                                   f"{scenario}.geostorage_ctrl.json")
+    with open(geostorage_ctrl) as f:
+        geostorage_data = json.load(f)
+    geostorage_data['simulator'] = 'OPM'
+    geostorage_data['simulator_path'] = stub_path
+    geostorage_data['simulator_args'] = stub_args
+    geostorage_data['mpi_cores'] = 1
+    with open(geostorage_ctrl, 'w') as f:
+        json.dump(geostorage_data, f, indent=1)
+
+    return main_ctrl, main_data
+
+
+def run_scenario(main_ctrl, main_data):
+    '''
+    Runs one coupled simulation in a fresh interpreter and evaluates its profile
+
+    :returns: dict with the benchmark results
+    '''
+    t0 = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-c', 'import sys; from coupled_simulation import coupling; '
+                               'coupling.main(["-i", sys.argv[1]])', main_ctrl],
+        cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    wall = time.perf_counter() - t0
+
+    result = {'wall': wall, 'returncode': proc.returncode}
+    output_path = os.path.join(os.path.dirname(main_ctrl), main_data['output_timeseries_path'])
+    profile_path = os.path.splitext(output_path)[0] + '.profile.json'
+    if proc.returncode != 0 or not os.path.isfile(profile_path):
+        result['error'] = proc.stderr.strip().splitlines()[-1:] or ['no profile written']
+        return result
+
+    with open(profile_path) as f:
+        profile = json.load(f)
+    steps = [s for s in profile['timesteps'] if s['tstep'] != 'init']
+    startup = next(s['wall'] for s in profile['timesteps'] if s['tstep'] == 'init')
+    result['startup'] = startup
+    result['timesteps'] = len(steps)
+    result['wall_per_step'] = sum(s['wall'] for s in steps) / max(len(steps), 1)
+    result['iterations_per_step'] = sum(s['iterations'] for s in steps) / max(len(steps), 1)
+    result['phases'] = profile['run']['phases']
+    return result
+
+
+def print_report(results):
+    '''
+    Prints a short table of the benchmark results
+
+    :returns: no return value
+    '''
+    print("=" * 111)
+    print(f"{'Scenario':40s} {'wall [s]':>10s} {'startup [s]':>12s} {'step [s]':>10s} {'iter/step':>10s}")
+    for name, result in results.items():
+        if 'error' in result:
+            print(f"{name:40s} failed: {' '.join(result['error'])}")
+            continue
+        print(f"{name:40s} {result['wall']:10.2f} {result['startup']:12.2f} "
+              f"{result['wall_per_step']:10.4f} {result['iterations_per_step']:10.2f}")
+        # concurrent phases (pipeline pre-solves) overlap the others, they are listed after the total
+        phases = result['phases']
+        concurrent = [name for name, entry in phases.items() if entry.get('concurrent', False)]
+        for phase, entry in phases.items():
+            if phase not in concurrent:
+                print(f"{'':4s}{phase:36s} {entry['seconds']:10.3f} {entry['count']:12d} {entry['share']:10.1%}")
+        total = sum(entry['share'] for phase, entry in phases.items() if phase not in concurrent)
+        print(f"{'':4s}{'total':36s} {'':10s} {'':12s} {total:10.1%}")
+        for phase in concurrent:
+            entry = phases[phase]
+            print(f"{'':4s}{phase + ' (concurrent)':36s} {entry['seconds']:10.3f} {entry['count']:12d} "
+                  f"{entry['share']:10.1%}")
+    print("=" * 111)
+
+
+def main(argv):
+    steps = 24
+    output = os.path.join(BENCH_DIR, 'results.json')
+    keep = False
+    stub_args = ['--stub-pore-volume=2e7', '--stub-pi=1e5']
+
+    try:
+        opts, args = getopt.getopt(argv, 'hs:o:k', ['steps=', 'output=', 'keep'])
+    except getopt.GetoptError:
+        print('run_benchmarks.py [-s steps] [-o results.json] [-k] [scenario ...]')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print('run_benchmarks.py [-s steps] [-o results.json] [-k] [scenario ...]')
+            sys.exit()
+        elif opt in ('-s', '--steps'):
+            steps = int(arg)
+        elif opt in ('-o', '--output'):
+            output = arg
+        elif opt in ('-k', '--keep'):
+            keep = True
+
+    scenarios = find_scenarios()
+    names = args or list(scenarios)
+
+    work_dir = tempfile.mkdtemp(prefix='if_bench_')
+    stub_path = os.path.join(work_dir, 'flow')
+    write_stub_executable(stub_path)
+
+    results = {}
+    for name in names:
+        print(f"{'Benchmarking scenario:':30s} {name}")
+        try:
+            main_ctrl, main_data = prepare_scenario(name, scenarios[name], steps, work_dir,
+                                                    stub_path, stub_args)
+        except (KeyError, OSError, ValueError) as e:
+            results[name] = {'error': [f"could not prepare scenario ({e})"]}
+            continue
+        results[name] = run_scenario(main_ctrl, main_data)
+
+    print_report(results)
+    with open(output, 'w') as f:
+        json.dump({'steps': steps, 'python': sys.version.split()[0], 'scenarios': results}, f, indent=1)
+    print(f"{'Results written to:':30s} {output}")
+
+    if keep:
+        print(f"{'Scenario copies kept in:':30s} {work_dir}")
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Stand-in for the OPM Flow executable used by the coupler benchmarks.
+
+Reads the restart/EQUIL, WCONINJE/WCONPROD and TSTEP sections written by
+GeoStorage.rework_ecl_data, advances a single-cell gas tank with a linear
+well inflow relation and writes an OPM-style .RSM summary file. The tank
+state is kept in <title>.STUBRST next to the deck so that restarts chain in
+the same way as for the real simulator.
+
+usage: stub_flow.py DECK.DATA [--stub-pore-volume=m3] [--stub-pi=sm3/d/bar]
+                              [--stub-sleep=s] [other flow arguments]
+
+__author__ = "fgasa"
+
+"""
+
+import datetime
+import json
+import os
+import sys
+import time
+
+P_SURFACE = 1.01325  # bar
+MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+
+def data_lines(deck, keyword):
+    '''
+    Returns the record lines following a keyword up to the terminating slash
+
+    :param deck: deck as list of lines
+    :param type: list of str
+    :param keyword: deck keyword
+    :param type: str
+    :returns: list of str
+    '''
+    records = []
+    for pos, line in enumerate(deck):
+        if line.strip() == keyword:
+            for record in deck[pos + 1:]:
+                record = record.split('--')[0].strip()
+                if not record:
+                    continue
+                if record == '/':
+                    break
+                records.append(record)
+                if keyword in ('EQUIL', 'RESTART', 'TSTEP', 'START'):
+                    break
+            break
+    return records
+
+
+def read_state(deck, wdir):
+    '''
+    Reads the initial tank state from the restart file or the EQUIL keyword
+
+    :returns: dict with pressure [bar] and elapsed time [d]
+    '''
+    restart = data_lines(deck, 'RESTART')
+    if restart:
+        title = restart[0].split()[0].strip("'")
+        with open(os.path.join(wdir, title + '.STUBRST')) as f:
+            return json.load(f)
+
+    start = datetime.date(2030, 1, 1)
+    start_record = data_lines(deck, 'START')
+    if start_record:
+        day, month, year = start_record[0].replace("'", '').split()[:3]
+        start = datetime.date(int(year), MONTHS.index(month.upper()) + 1, int(day))
+
+    equil = data_lines(deck, 'EQUIL')
+    pressure = float(equil[0].split()[1]) if equil else 100.0
+    return {'pressure': pressure, 'days': 0.0, 'start': start.isoformat()}
+
+
+def read_schedule(deck):
+    '''
+    Reads the well controls and the step length written by rework_ecl_data
+
+    :returns: tuple of mode, list of (well, rate [sm3/d], bhp limit [bar]) and step length [d]
+    '''
+    wells = []
+    mode = 'shut-in'
+    for record in data_lines(deck, 'WCONINJE'):
+        items = record.replace('/', ' ').split()
+        wells.append((items[0].strip("'"), float(items[4]), float(items[6])))
+        mode = 'injection'
+    for record in data_lines(deck, 'WCONPROD'):
+        items = record.replace('/', ' ').split()
+        wells.append((items[0].strip("'"), float(items[5]), float(items[8])))
+        mode = 'production'
+    if mode == 'production' and all(rate == 0.0 for _, rate, _ in wells):
+        mode = 'shut-in'
+
+    days = 0.0
+    for record in data_lines(deck, 'TSTEP'):
+        for item in record.replace('/', ' ').split():
+            count, _, value = item.rpartition('*')
+            days += (int(count) if count else 1) * float(value)
+    return mode, wells, days
+
+
+def advance(state, mode, wells, days, pore_volume, pi):
+    '''
+    Advances the tank by one step and returns the per-well results
+
+    :returns: list of (well, bhp, injection rate, production rate)
+    '''
+    p_res = state['pressure']
+    results = []
+    total = 0.0
+    for name, rate, limit in wells:
+        if mode == 'injection':
+            rate = max(0.0, min(rate, (limit - p_res) * pi))
+            results.append((name, p_res + rate / pi, rate, 0.0))
+            total += rate
+        elif mode == 'production':
+            rate = max(0.0, min(rate, (p_res - limit) * pi))
+            results.append((name, p_res - rate / pi, 0.0, rate))
+            total -= rate
+        else:
+            results.append((name, p_res, 0.0, 0.0))
+
+    # ideal gas tank: pressure follows the stored surface volume
+    state['pressure'] = max(P_SURFACE, p_res + total * days * P_SURFACE / pore_volume)
+    state['days'] += days
+    for idx, (name, bhp, inj, prod) in enumerate(results):
+        shift = state['pressure'] - p_res
+        results[idx] = (name, bhp + shift, inj, prod)
+    return results
+
+
+def write_rsm(path, title, date, results):
+    '''
+    Writes the summary in the block layout of OPM's .RSM output
+
+    :returns: no return value
+    '''
+    columns = [('WBHP', 'BARSA', name, bhp) for name, bhp, _, _ in results]
+    columns += [('WGIR', 'SM3/DAY', name, inj) for name, _, inj, _ in results]
+    columns += [('WGPR', 'SM3/DAY', name, prod) for name, _, _, prod in results]
+
+    lines = []
+    width = 14
+    for start in range(0, len(columns), 9):
+        block = columns[start:start + 9]
+        rule = ' ' + '-' * width * (len(block) + 1) + '\n'
+        lines += ['1\n', rule, f" SUMMARY OF RUN {title}\n", rule]
+        lines.append(f"{'DATE':>{width}}" + ''.join(f"{c[0]:>{width}}" for c in block) + '\n')
+        lines.append(f"{'':>{width}}" + ''.join(f"{c[1]:>{width}}" for c in block) + '\n')
+        lines.append(f"{'':>{width}}" + ''.join(f"{c[2]:>{width}}" for c in block) + '\n')
+        lines.append(rule)
+        lines.append(f"{date:>{width}}" + ''.join(f"{c[3]:>{width}.4f}" for c in block) + '\n')
+        lines.append('\n')
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+
+def main(argv):
+    deck_path = next(arg for arg in argv if not arg.startswith('-'))
+    options = dict(arg[2:].split('=', 1) for arg in argv if arg.startswith('--stub-'))
+    pore_volume = float(options.get('stub-pore-volume', 2.0e7))
+    pi = float(options.get('stub-pi', 1.0e5))
+    time.sleep(float(options.get('stub-sleep', 0.0)))
+
+    wdir = os.path.dirname(os.path.abspath(deck_path))
+    title = os.path.splitext(os.path.basename(deck_path))[0]
+    with open(deck_path) as f:
+        deck = list(f)
+
+    state = read_state(deck, wdir)
+    mode, wells, days = read_schedule(deck)
+    results = advance(state, mode, wells, days, pore_volume, pi)
+
+    current = datetime.date.fromisoformat(state['start']) + datetime.timedelta(days=state['days'])
+    date = f"{current.day}-{MONTHS[current.month - 1]}-{current.year}"
+    write_rsm(os.path.join(wdir, title + '.RSM'), title, date, results)
+
+    with open(os.path.join(wdir, title + '.STUBRST'), 'w') as f:
+        json.dump(state, f)
+    # restart header, copied forward by the OPM restart workaround in rework_ecl_data
+    with open(os.path.join(wdir, title + '.X0000'), 'wb') as f:
+        f.write(b'STUB')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
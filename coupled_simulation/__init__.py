@@ -1,10 +1,31 @@
 """
 Coupled Power Plant and Geostorage Interface.
+
+The submodules are imported on first access, so tools that only need deck
+handling or result parsing do not load TESPy and CoolProp.
 """
 __version__ = '0.1.1 dev'
 __license__ = 'GPL-3.0'
 
-from coupled_simulation import coupling as cp
-from coupled_simulation import powerplant as pp
-from coupled_simulation import geostorage as gs
-from coupled_simulation import utilities as util
+import importlib
+
+_submodules = {
+    'cp': 'coupling',
+    'pp': 'powerplant',
+    'gs': 'geostorage',
+    'util': 'utilities',
+    'tel': 'telemetry',
+}
+
+
+def __getattr__(name):
+    module_name = _submodules.get(name, name)
+    if module_name not in _submodules.values():
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(f'{__name__}.{module_name}')
+    globals()[name] = module
+    return module
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_submodules) | set(_submodules.values()))
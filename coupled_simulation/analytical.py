@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+__author__ = "fgasa"
+
+"""
+
+import math
+import numpy as np
+
+P_SC = 101325.0  # Pa, 1 atm
+T_SC = 288.7056  # K, 15.5556 degC
+MILLIDARCY = 9.869233e-16  # m2
+
+
+def exp1(x):
+    '''
+    Exponential integral E1(x) for positive arguments, vectorized
+
+    Uses the polynomial and rational approximations 5.1.53 and 5.1.56 of
+    Abramowitz and Stegun (relative error below 5e-5).
+
+    :param x: positive arguments
+    :param type: numpy.ndarray
+    :returns: numpy.ndarray
+    '''
+    x = np.asarray(x, dtype=float)
+    out = np.zeros_like(x)
+
+    small = x <= 1.0
+    xs = x[small]
+    out[small] = (-np.log(xs) - 0.57721566 + xs * (0.99999193 + xs * (-0.24991055 + xs * (
+        0.05519968 + xs * (-0.00976004 + xs * 0.00107857)))))
+
+    large = (x > 1.0) & (x < 700.0)
+    xl = x[large]
+    num = xl * (xl * (xl * (xl + 8.5733287401) + 18.0590169730) + 8.6347608925) + 0.2677737343
+    den = xl * (xl * (xl * (xl + 9.5733223454) + 25.6329561486) + 21.0996530827) + 3.9584969228
+    out[large] = num / den * np.exp(-xl) / xl
+    return out
+
+
+class AnalyticalStorage:
+    '''
+    In-process storage model based on the line-source solution of radial gas
+    flow in an infinite-acting, homogeneous reservoir.
+
+    The well pressures follow from spatial superposition over all wells and
+    temporal superposition of the rate changes, formulated in the gas
+    pseudo-pressure m(p) = p^2 / (mu z). All wells of the storage are operated
+    with the same rate, as in the ECLIPSE/OPM well schedule, and the rate is
+    reduced uniformly if a well would violate its BHP limit.
+
+    Iterations of the same timestep replace the rate of that timestep, the
+    rate is committed once the next timestep starts.
+    '''
+
+    def __init__(self, properties, well_names, lower_bhp, upper_bhp, surface_density, compartments=1):
+
+        self.p_init = float(properties['initial_pressure']) * 1e5
+        self.mu = float(properties.get('viscosity', 1.8e-5))
+        self.z = float(properties.get('z_factor', 1.0))
+        temperature = float(properties.get('temperature', 40.0)) + 273.15
+        k = float(properties['permeability']) * MILLIDARCY
+        h = float(properties['thickness'])
+        porosity = float(properties['porosity'])
+        # total compressibility in 1/bar, gas compressibility 1/p by default
+        c_t = float(properties.get('total_compressibility', 1e5 / self.p_init)) / 1e5
+
+        self.n_wells = len(well_names)
+        self.compartments = compartments
+        self.surface_density = surface_density
+        self.m_lower = (np.asarray(lower_bhp, dtype=float) * 1e5) ** 2 / (self.mu * self.z)
+        self.m_upper = (np.asarray(upper_bhp, dtype=float) * 1e5) ** 2 / (self.mu * self.z)
+        self.m_init = self.p_init ** 2 / (self.mu * self.z)
+
+        # pseudo-pressure change per unit surface rate (sm3/s) and unit E1
+        self.coeff = P_SC * temperature / (T_SC * 2.0 * math.pi * k * h)
+        self.eta = k / (porosity * self.mu * c_t)
+        self.skin = float(properties.get('skin', 0.0))
+
+        coordinates = properties.get('well_coordinates')
+        if coordinates is None:
+            spacing = float(properties.get('well_spacing', 100.0))
+            cols = math.ceil(math.sqrt(self.n_wells))
+            coordinates = [((i % cols) * spacing, (i // cols) * spacing) for i in range(self.n_wells)]
+        xy = np.asarray(coordinates, dtype=float)
+        r2 = ((xy[:, None, :] - xy[None, :, :]) ** 2).sum(axis=-1)
+        np.fill_diagonal(r2, float(properties.get('well_radius', 0.1)) ** 2)
+        self.r2 = r2
+
+        # committed history: start time of each step and per-well rate (sm3/s, injection positive)
+        self.starts = np.zeros(0)
+        self.rates = np.zeros(0)
+        self.t_now = 0.0
+        self.tstep = None
+        self.pending = None  # (step length, rate) of the current timestep
+        self.history = None  # (step length, history pseudo-pressure, unit response) of the current timestep
+
+        # kernel cache for elapsed times that are multiples of the base step length
+        self.dt_base = None
+        self.lag_kernel = np.zeros((0, self.n_wells))
+
+    def _kernel(self, elapsed):
+        '''
+        Pseudo-pressure response of each well to a unit rate step in all wells
+
+        :param elapsed: time since the rate step in s
+        :param type: numpy.ndarray
+        :returns: numpy.ndarray of shape (len(elapsed), n_wells)
+        '''
+        u = self.r2[None, :, :] / (4.0 * self.eta * elapsed[:, None, None])
+        return self.coeff * (exp1(u).sum(axis=-1) + 2.0 * self.skin)
+
+    def _history_kernel(self, elapsed):
+        if self.dt_base is None:
+            return self._kernel(elapsed)
+        lags = np.rint(elapsed / self.dt_base)
+        if not np.allclose(lags * self.dt_base, elapsed, rtol=0.0, atol=1e-6 * self.dt_base):
+            return self._kernel(elapsed)
+        lags = lags.astype(int)
+        n_lag = int(lags.max()) + 1
+        if n_lag > len(self.lag_kernel):
+            # lag 0 never occurs in the history, its row is kept for indexing only
+            new = np.arange(max(len(self.lag_kernel), 1), n_lag, dtype=float)
+            block = self._kernel(new * self.dt_base)
+            if not len(self.lag_kernel):
+                block = np.vstack([np.zeros((1, self.n_wells)), block])
+            self.lag_kernel = np.vstack([self.lag_kernel, block])
+        return self.lag_kernel[lags]
+
+    def _commit(self):
+        if self.pending is None:
+            return
+        dt, rate = self.pending
+        self.starts = np.append(self.starts, self.t_now)
+        self.rates = np.append(self.rates, rate)
+        self.t_now += dt
+        self.pending = None
+        self.history = None
+
+    def simulate(self, target_flow, tstep, step_length, op_mode):
+        '''
+        Simulates one timestep at the given storage mass flow
+
+        :param target_flow: target storage flow rate (magnitude) in kg/s
+        :param type: float
+        :param tstep: current timestep, -1 for the initialisation
+        :param type: int
+        :param step_length: length of the timestep in s
+        :param type: float
+        :param op_mode: 'charging', 'discharging', 'shut-in' or 'init'
+        :param type: str
+        :returns: tuple of actual storage flow rate (kg/s) and average well pressure (bar)
+        '''
+        if op_mode == 'init':
+            return 0.0, self.p_init / 1e5
+
+        if tstep != self.tstep:
+            self._commit()
+            self.tstep = tstep
+        if self.dt_base is None:
+            self.dt_base = float(step_length)
+
+        q_prev = self.rates[-1] if len(self.rates) else 0.0
+
+        # pseudo-pressure at the end of the step if the previous rate is kept,
+        # identical for all iterations of a timestep
+        if self.history is None or self.history[0] != step_length:
+            t_end = self.t_now + step_length
+            m_hist = np.full(self.n_wells, self.m_init)
+            if len(self.starts):
+                dq = np.diff(self.rates, prepend=0.0)
+                m_hist += dq @ self._history_kernel(t_end - self.starts)
+            unit = self._history_kernel(np.array([float(step_length)]))[0]
+            self.history = (step_length, m_hist, unit)
+        _, m_hist, unit = self.history
+
+        rate = abs(target_flow) / self.surface_density / self.n_wells / self.compartments
+        if op_mode == 'charging':
+            q_max = q_prev + (self.m_upper - m_hist) / unit
+            rate = max(0.0, min(rate, float(q_max.min())))
+        elif op_mode == 'discharging':
+            q_min = q_prev + (self.m_lower - m_hist) / unit
+            rate = -max(0.0, min(rate, -float(q_min.max())))
+        else:
+            rate = 0.0
+
+        self.pending = (float(step_length), rate)
+        m_wells = m_hist + (rate - q_prev) * unit
+        p_wells = np.sqrt(np.clip(m_wells, 0.0, None) * self.mu * self.z) / 1e5
+
+        flowrate = abs(rate) * self.n_wells * self.surface_density
+        return flowrate, float(p_wells.mean())
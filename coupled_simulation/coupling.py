@@ -10,7 +10,16 @@ __author__ = "witte, wtp, fgasa"
 import sys
 import getopt
 import csv
+from concurrent.futures import ThreadPoolExecutor
 from coupled_simulation import powerplant as pp, geostorage as gs, utilities as utils
+from coupled_simulation import telemetry
+from coupled_simulation.pipeline import PowerPlantPipeline
+from coupled_simulation.replay import Recording
+from coupled_simulation.results import ResultStore
+from coupled_simulation.scheduler import CoreScheduler, DEFAULT_DIR
+from coupled_simulation.storage_cache import StorageCache
+from coupled_simulation.trace import EventTrace
+import copy
 import json
 import datetime
 import os
@@ -72,29 +81,38 @@ def main(argv):
     sys.stdout.debug = cd.debug
     # create instances for power plant and storage
     geostorage = gs.GeoStorage(cd)
-    min_well_depth = min(geostorage.well_depths)
-
-    powerplant = pp.PowerPlantCoupling(cd, min_well_depth, len(geostorage.well_names), max(geostorage.well_upper_BHP), min(geostorage.well_lower_BHP))
+    if cd.storage_only:
+        # the storage follows the mass flow schedule, the power plant is not built
+        powerplant = None
+        p0 = initialise_storage(cd, geostorage)
+    else:
+        powerplant, p0 = initialise_models(cd, geostorage)
+        if cd.pipeline:
+            powerplant = PowerPlantPipeline(powerplant, cd)
+        powerplant = cd.recording.attach(powerplant)
 
     print("=" * 111)
     print('Reading input time series...')
 
-    input_ts = utils.read_series(os.path.join(cd.working_dir, cd.input_timeseries_path))
+    if cd.storage_only:
+        input_ts = utils.read_series(os.path.join(cd.working_dir, cd.massflow_timeseries_path),
+                                     *cd.massflow_columns)
+    else:
+        input_ts = utils.read_series(os.path.join(cd.working_dir, cd.input_timeseries_path))
 
     #prepare data structures
     print("=" * 111)
     print('Preparing output data structures...')
 
-    if cd.auto_eval_output:
-        variable_list = ['time', 'power_target', 'massflow_target', 'power_actual', 'heat',
-                         'massflow_actual', 'storage_pressure', 'Tstep_accepted', 'delta_power', 'delta_massflow']
-    else:
-        variable_list = ['time', 'power_target', 'massflow_target', 'power_actual', 'heat',
-                         'massflow_actual', 'storage_pressure']
-    #one output line per timestep...
-    output_data = []
+    #one output line per timestep and the initial state
+    output_data = ResultStore(cd.t_steps_total - cd.history_steps + 1, cd.auto_eval_output)
+    output_path = os.path.join(cd.working_dir, cd.output_timeseries_path)
+
+    # the storage state at the first coupled timestep follows from the mass flow history
+    if cd.history_steps:
+        p0 = run_history(geostorage, p0, cd)
 
-    current_time = cd.t_start - datetime.timedelta(seconds=cd.t_step_length)
+    current_time = cd.t_start + datetime.timedelta(seconds=(cd.history_steps - 1) * cd.t_step_length)
 
     '''debug values from here onwards'''
     #data = [0.0, 0.0]
@@ -103,12 +121,8 @@ def main(argv):
     #data = geostorage.call_storage_simulation(-1.15741, 3, cd, 'discharging')
     '''end of debug values'''
 
-    # get initial pressure before the time loop
-    p0, dummy_flow = geostorage.call_storage_simulation(0.0, -1, 0, cd, 'init')
-    if cd.auto_eval_output:
-        output_data.append([current_time, 0.0, 0.0, 0.0, 0.0, 0.0, p0, True, 0.0, 0.0])
-    else:
-        output_data.append([current_time, 0.0, 0.0, 0.0, 0.0, 0.0, p0])
+    output_data.append(current_time, 0.0, 0.0, 0.0, 0.0, 0.0, p0)
+    cd.metrics.write(cd, powerplant)
     print('Simulation initialzation completed.')
     print("=" * 111)
 
@@ -117,20 +131,46 @@ def main(argv):
     power_target_t0 = 0.0
     power_target = 0.0
 
+    # targets on the time grid, the last given target is kept for missing times
+    targets = []
     last_time = cd.t_start
     for t_step in range(cd.t_steps_total):
-
         current_time = datetime.timedelta(seconds=t_step * cd.t_step_length) + cd.t_start
-
-        try:
-            power_target = input_ts[current_time]
+        if current_time in input_ts:
             last_time = current_time
-        except KeyError:
-            power_target = input_ts[last_time]
+        targets.append(input_ts[last_time])
+    # with compress_schedule, one storage run covers consecutive timesteps of equal target
+    runs = utils.run_lengths(targets) if cd.compress_schedule else [1] * len(targets)
+
+    # t_step counts the timesteps of the time grid, s_step the storage runs
+    t_step = s_step = cd.history_steps
+    n_steps = 1
+    delta_p = 0.0
+    while t_step < cd.t_steps_total:
 
+        current_time = datetime.timedelta(seconds=t_step * cd.t_step_length) + cd.t_start
+        power_target = targets[t_step]
+        new_target = t_step == cd.history_steps or abs(power_target - power_target_t0) > 1E-7
+        n_steps = segment_steps(runs[t_step], new_target, n_steps, delta_p, cd)
+        # the storage run and the power plant see the length of all timesteps it covers
+        md = cd
+        if n_steps > 1:
+            md = copy.copy(cd)
+            md.t_step_length = n_steps * cd.t_step_length
+
+        if cd.pipeline and not cd.storage_only:
+            next_time = current_time + datetime.timedelta(seconds=md.t_step_length)
+            powerplant.next_power = input_ts.get(next_time, power_target)
+
+        cd.profiler.set_timestep(s_step)
         print("=" * 111)
         print(f"{'Advancing to timestep:':30s} {t_step}")
-        print(f"{'Target power output for this time step is:':30s} {'%.3f' % power_target}")
+        if n_steps > 1:
+            print(f"{'Timesteps in this storage run:':30s} {n_steps} (storage run {s_step})")
+        if cd.storage_only:
+            print(f"{'Target mass flow for this time step is:':30s} {'%.3f' % power_target}")
+        else:
+            print(f"{'Target power output for this time step is:':30s} {'%.3f' % power_target}")
         sys.stdout.flush()
 
         if power_plant_off == True:
@@ -142,42 +182,69 @@ def main(argv):
                 power_plant_off = False
 
         # calculate pressure, mass flow and power
-        p_actual, m_target, m_actual, power_actual, heat, success, power_plant_off = calc_timestep(
-                powerplant, geostorage, power_target, p0, cd, t_step, power_plant_off)
+        if cd.storage_only:
+            p_actual, m_target, m_actual, success, power_plant_off = calc_timestep_storage(
+                    geostorage, power_target, p0, md, s_step, power_plant_off)
+            power_actual = heat = 0.0
+        else:
+            p_actual, m_target, m_actual, power_actual, heat, success, power_plant_off = calc_timestep(
+                    powerplant, geostorage, power_target, p0, md, s_step, power_plant_off)
 
-        # save last pressure (p1) for next time step as p0
-        p0 = p_actual
         #deleting old files
-        geostorage.delete_sim_files(t_step)
-
-        # write pressure, mass flow and power to .csv
-        if cd.auto_eval_output == True:
+        with cd.profiler.phase('cleanup'):
+            geostorage.delete_sim_files(s_step)
+
+        # store pressure, mass flow and power, one row per timestep of the time grid
+        # with the pressure interpolated linearly over the storage run
+        if cd.storage_only:
+            # signed mass flows, positive into the storage
+            power_target_row = delta_power = 0.0
+        else:
+            power_target_row = power_target
             delta_power = abs(power_actual) - abs(power_target)
-            delta_massflow = abs(m_actual) - abs(m_target)
+        delta_massflow = abs(m_actual) - abs(m_target)
+        for i in range(n_steps):
+            output_data.append(current_time + datetime.timedelta(seconds=i * cd.t_step_length),
+                               power_target_row, m_target, power_actual, heat, m_actual,
+                               p0 + (p_actual - p0) * (i + 1) / n_steps, success, delta_power, delta_massflow)
+        cd.metrics.update(cd, t_step + n_steps - 1, success, powerplant, steps=n_steps)
 
-            output_data.append([current_time, power_target, m_target, power_actual, heat, m_actual,
-                                p_actual, success, delta_power, delta_massflow])
-        else:
-            output_data.append([current_time, power_target, m_target, power_actual, heat, m_actual,
-                                p_actual])
+        # save last pressure (p1) for next time step as p0
+        delta_p = abs(p_actual - p0)
+        p0 = p_actual
 
         # periodic save logic, to safely default to 10 if 'save_nth_t_step' is missing from the main JSON
+        # only the rows since the last save are appended to the .csv
         save_interval = getattr(cd, 'save_nth_t_step', 10)
-        if save_interval > 0 and t_step % save_interval == 0:
-            output_path = os.path.join(cd.working_dir, cd.output_timeseries_path)
-            with open(output_path, mode='w', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f, delimiter=';')
-                writer.writerow(variable_list)
-                writer.writerows(output_data)
+        if save_interval > 0 and (t_step + n_steps - 1) // save_interval != (t_step - 1) // save_interval:
+            with cd.profiler.phase('output'):
+                output_data.write_csv(output_path)
 
         #save old power target
         power_target_t0 = power_target
-    # write the collected array once at the end
-    output_path = os.path.join(cd.working_dir, cd.output_timeseries_path)
-    with open(output_path, mode='w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f, delimiter=';')
-        writer.writerow(variable_list)
-        writer.writerows(output_data)
+        t_step += n_steps
+        s_step += 1
+    # time of the last timestep
+    current_time = cd.t_start + datetime.timedelta(seconds=(cd.t_steps_total - 1) * cd.t_step_length)
+    # restore the initial storage inventory
+    if cd.balance_mass_eos:
+        p0 = balance_storage(powerplant, geostorage, output_data, p0, cd, current_time, s_step)
+
+    # write the remaining rows at the end
+    with cd.profiler.phase('output'):
+        output_data.write_csv(output_path)
+        if cd.binary_output:
+            output_data.save(os.path.splitext(output_path)[0] + '.npy')
+
+    if powerplant is not None:
+        powerplant.close()
+
+    # export the timing profile, the convergence log and the event trace next to the output file
+    cd.profiler.export(os.path.splitext(output_path)[0])
+    cd.convergence.export(os.path.splitext(output_path)[0])
+    cd.trace.dump(os.path.splitext(output_path)[0])
+    cd.recording.save(os.path.splitext(output_path)[0])
+    cd.metrics.write(cd, powerplant, finished=True)
 
     end_time = datetime.datetime.now()
     elapsed = end_time - start_time  # this is a timedelta object
@@ -188,72 +255,188 @@ def main(argv):
     print(f"{'Log file:':30s} {path_log}")
     print(f"{'Elapsed time:':30s} {str(elapsed)}")
     print("=" * 111)
+    cd.profiler.print_summary()
+    print("=" * 111)
+    cd.convergence.print_summary()
+    print("=" * 111)
+    if cd.scheduler.enabled:
+        cd.scheduler.print_summary()
+        print("=" * 111)
+    if cd.storage_cache.enabled:
+        cd.storage_cache.print_summary()
+        print("=" * 111)
+    if cd.recording.recording or cd.recording.replaying:
+        cd.recording.print_summary()
+        print("=" * 111)
     print("\n" * 3)
 
     if isinstance(sys.stdout, utils.Logger):
         sys.stdout.log.close()
         sys.stdout = sys.stdout.terminal
 
-    # Load balancing for mismatched mass flow to restore initial storage level
-    '''
-    if cd.balance_mass_eos:
+def segment_steps(run, new_target, n_prev, delta_p, cd):
+    """
+    Number of timesteps covered by the next storage run
+
+    Without segment_pressure_change, a storage run covers the whole segment
+    of equal targets, at most segment_max_steps timesteps. Otherwise a new
+    target starts with a single timestep and the number of timesteps is
+    scaled with the ratio of segment_pressure_change and the pressure change
+    of the last storage run, at most doubled.
+
+    :param run: number of timesteps with the current target from the current timestep on
+    :type run: int
+    :param new_target: True if the target differs from the last timestep
+    :type new_target: bool
+    :param n_prev: timesteps covered by the last storage run
+    :type n_prev: int
+    :param delta_p: pressure change of the last storage run
+    :type delta_p: float
+    :param cd: object containing the basic model data
+    :type cd: CouplingData
+    :returns: number of timesteps
+    """
+    run = min(run, cd.segment_max_steps)
+    if cd.segment_pressure_change is None:
+        return run
+    if new_target:
+        return 1
+    n_steps = 2 * n_prev
+    if delta_p > 0.0:
+        n_steps = min(n_steps, int(n_prev * float(cd.segment_pressure_change) / delta_p))
+    return max(1, min(n_steps, run))
+
+
+def run_history(geostorage, p0, cd):
+    """
+    Drives the storage through the mass flow history of the first
+    history_steps timesteps
 
-        print('Balancing storage.')
-        print("=" * 111)
+    The mass flows of the history (kg/s, positive into the storage) are
+    passed to the storage simulation as they are, without the power plant
+    and without the shut-in logic of storage-only runs. The coupled
+    timesteps continue from the resulting storage state.
+
+    :param geostorage: storage model
+    :type geostorage: GeoStorage
+    :param p0: initial storage pressure
+    :type p0: float
+    :param cd: object containing the basic model data
+    :type cd: CouplingData
+    :returns: storage pressure at the end of the history
+    """
+    history = utils.read_series(os.path.join(cd.working_dir, cd.history_path), 'cmp_m', 'exp_m')
+    print("=" * 111)
+    print(f"Running {cd.history_steps} timesteps of mass flow history...")
+
+    for t_step in range(cd.history_steps):
+        current_time = cd.t_start + datetime.timedelta(seconds=t_step * cd.t_step_length)
+        massflow = history.get(current_time, 0.0)
+        if abs(massflow) < 1E-7:
+            storage_mode = 'shut-in'
+        elif massflow < 0.0:
+            storage_mode = 'discharging'
+        else:
+            storage_mode = 'charging'
 
-        charge = output_ts['power_actual'] > 0
-        discharge = output_ts['power_actual'] < 0
+        cd.profiler.set_timestep(t_step)
+        cd.trace.at(t_step, 0)
+        p0, m_actual = geostorage.call_storage_simulation(
+            0.0 if storage_mode == 'shut-in' else abs(massflow), t_step, 0, cd, storage_mode)
+        with cd.profiler.phase('cleanup'):
+            geostorage.delete_sim_files(t_step)
+        print(f"{'History timestep:':30s} {t_step}, {storage_mode} at {massflow:.3f} kg/s, {p0:.6f} bar")
 
-        tmp = output_ts.copy()
+    return p0
 
-        tmp['massflow_out'] = -output_ts[discharge]['massflow_actual']
-        tmp["massflow_in"] = output_ts[charge]['massflow_actual']
 
-        tmp['massflow_out'].fillna(value=0, inplace=True)
-        tmp["massflow_in"].fillna(value=0, inplace=True)
+def balance_storage(powerplant, geostorage, output_data, p0, cd, current_time, t_step):
+    """
+    Restores the initial storage inventory at the end of a run
+
+    The mass put into the storage during the run is summed up from the
+    results and withdrawn (or injected) at the nominal mass flow of the power
+    plant mode, in storage steps of up to balance_step_length seconds, the
+    last step is shortened to the remaining mass. Storage-only runs balance
+    at balance_massflow, by default the largest scheduled mass flow. The
+    balancing stops early if the storage does not take the mass flow any
+    more, e.g. at a BHP limit.
+
+    :param powerplant: power plant model, None in storage-only runs
+    :type powerplant: PowerPlantCoupling
+    :param geostorage: storage model
+    :type geostorage: GeoStorage
+    :param output_data: results of the run, the balancing steps are appended
+    :type output_data: ResultStore
+    :param p0: storage pressure at the end of the run
+    :type p0: float
+    :param cd: object containing the basic model data
+    :type cd: CouplingData
+    :param current_time: time of the last timestep
+    :type current_time: datetime.datetime
+    :param t_step: storage run of the first balancing step
+    :type t_step: int
+    :returns: storage pressure after the balancing
+    """
+    accumulated_mass = output_data.accumulated_mass(cd.t_step_length, signed=cd.storage_only)
+    print("=" * 111)
+    print('Balancing storage.')
+    print(f"{'Accumulated mass [t]:':30s} {accumulated_mass / 1000:.3f}")
 
-        accumulated_mass = tmp['massflow_in'] + tmp['massflow_out']
-        accumulated_mass = accumulated_mass.sum()*3600
+    mode = 'discharging' if accumulated_mass > 0 else 'charging'
+    if cd.storage_only:
+        massflow_nominal = float(cd.balance_massflow or abs(output_data.rows['massflow_target']).max())
+    else:
+        model = getattr(powerplant, f"{pp.PowerPlantCoupling._MODE_MAP[mode]}_model", None)
+        massflow_nominal = model.dot_m_nominal if model is not None else 0.0
+    if not massflow_nominal:
+        print(f"No nominal mass flow for {mode}, storage not balanced.")
+        return p0
+    # masses below 0.1 % of a timestep at nominal mass flow are balanced
+    tolerance = 1E-3 * massflow_nominal * cd.t_step_length
+    if abs(accumulated_mass) <= tolerance:
+        print('Storage is balanced.')
+        return p0
+    print(f"{'Storage balancing mode:':30s} {mode}")
+
+    # the storage steps of the balancing differ from the timesteps of the run
+    md = copy.copy(cd)
+    sign = -1.0 if mode == 'discharging' else 1.0
+    remaining = abs(accumulated_mass)
+    pp_off = False
+    # the balancing starts at the end of the last timestep
+    current_time += datetime.timedelta(seconds=cd.t_step_length)
+    while remaining > tolerance:
+        md.t_step_length = min(cd.balance_step_length, remaining / massflow_nominal)
+        cd.profiler.set_timestep(t_step)
+        print("=" * 111)
+        print(f"{'Balancing step:':30s} {t_step}")
+        print(f"{'Step length [s]:':30s} {md.t_step_length:.0f}")
 
-        print("accumulated mass: ", accumulated_mass)
-        if accumulated_mass > 0:
-            mode = 'discharging'
-            time = (abs(accumulated_mass) / powerplant.m_nom_discharge) // 3600 + 1
-            massflow_target = -powerplant.m_nom_discharge
-        elif accumulated_mass < 0:
-            mode = 'charging'
-            time = (abs(accumulated_mass) / powerplant.m_nom_charge) // 3600 + 1
-            massflow_target = powerplant.m_nom_charge
+        if cd.storage_only:
+            p_actual, m_target, m_actual, success, pp_off = calc_timestep_storage(
+                geostorage, sign * massflow_nominal, p0, md, t_step, pp_off)
+            power_actual = heat = 0.0
         else:
-            time = 0
-            mode = 'shut-in'
-        print("Storage balancing mode " + mode)
-
-        t_start = current_time
-        for t_step in range(cd.t_steps_total, int(cd.t_steps_total + time)):
-            # calculate pressure, mass flow and power
-            current_time = datetime.timedelta(seconds=t_step * cd.t_step_length) + t_start
-            p_actual, m_target, m_actual, power_actual, heat, success, power_plant_off = calc_timestep_mass(
-                powerplant, geostorage, massflow_target, p0, cd, t_step, power_plant_off)
-
-            # save last pressure (p1) for next time step as p0
-            p0 = p_actual
-            #deleting old files
+            p_actual, m_target, m_actual, power_actual, heat, success, pp_off = calc_timestep_mass(
+                powerplant, geostorage, sign * massflow_nominal, p0, md, t_step, pp_off)
+        p0 = p_actual
+        with cd.profiler.phase('cleanup'):
             geostorage.delete_sim_files(t_step)
 
-            # write pressure, mass flow and power to .csv
-            if cd.auto_eval_output == True:
-                delta_power = abs(power_actual) - abs(power_target)
-                delta_massflow = abs(m_actual) - abs(m_target)
+        output_data.append(current_time, power_actual, m_target, power_actual, heat, m_actual,
+                           p_actual, success, 0.0, abs(m_actual) - abs(m_target))
+        current_time += datetime.timedelta(seconds=md.t_step_length)
+        t_step += 1
 
-                output_ts.loc[t_step+1] = np.array([current_time, power_actual, m_target, power_actual, heat, m_actual,
-                                                        p_actual, success, delta_power, delta_massflow])
-            else:
-                output_ts.loc[t_step+1] = np.array([current_time, power_actual, m_target, power_actual, heat, m_actual,
-                                                        p_actual])
+        if abs(m_actual) < 1E-2 * massflow_nominal:
+            print('Storage does not take the balancing mass flow, stopping the balancing.')
+            break
+        remaining -= abs(m_actual) * md.t_step_length
+
+    print(f"{'Remaining mass [t]:':30s} {remaining / 1000:.3f}")
+    return p0
 
-            output_ts.to_csv(cd.working_dir + cd.output_timeseries_path, index=False, sep=';')
-    '''
 
 def calc_timestep_mass(powerplant, geostorage, massflow, p0, md, tstep, pp_off):
     """
@@ -436,6 +619,140 @@ def calc_timestep_mass(powerplant, geostorage, massflow, p0, md, tstep, pp_off):
     sys.stdout.flush()
     return p1, m, m_corr, power_corr, heat, tstep_accepted, pp_off
 
+def initialise_models(cd, geostorage):
+    """
+    Creates the power plant model and runs the initial storage simulation
+
+    With parallel_startup, the charge and discharge layouts are solved in
+    forked worker processes and the initial storage run executes in a thread
+    meanwhile. Only the well data is shared between these parts. If the
+    initial pressure is given in the main control file, the initial storage
+    run is skipped.
+
+    :param cd: object containing the basic model data
+    :type cd: CouplingData
+    :param geostorage: storage model
+    :type geostorage: GeoStorage
+    :returns: tuple of power plant model and initial storage pressure
+    """
+    well_data = (min(geostorage.well_depths), len(geostorage.well_names),
+                 max(geostorage.well_upper_BHP), min(geostorage.well_lower_BHP))
+
+    if cd.initial_pressure is not None:
+        # the storage was initialised by a run sharing the same storage model, see sweep.py
+        print(f"{'Initial pressure is:':30s} {float(cd.initial_pressure):.6f} [bar]")
+        return pp.PowerPlantCoupling(cd, *well_data), float(cd.initial_pressure)
+
+    if not cd.parallel_startup:
+        powerplant = pp.PowerPlantCoupling(cd, *well_data)
+        # get initial pressure before the time loop
+        p0, dummy_flow = geostorage.call_storage_simulation(0.0, -1, 0, cd, 'init')
+        return powerplant, p0
+
+    # the layout workers are forked before the storage initialisation thread starts
+    layout_workers = pp.start_layouts(cd, *well_data)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # get initial pressure before the time loop
+        init_run = executor.submit(geostorage.call_storage_simulation, 0.0, -1, 0, cd, 'init')
+        pp.join_layouts(layout_workers)
+        powerplant = pp.PowerPlantCoupling(cd, *well_data)
+        p0, dummy_flow = init_run.result()
+
+    return powerplant, p0
+
+
+def initialise_storage(cd, geostorage):
+    """
+    Runs the initial storage simulation, skipped if the initial pressure is
+    given in the main control file
+
+    :param cd: object containing the basic model data
+    :type cd: CouplingData
+    :param geostorage: storage model
+    :type geostorage: GeoStorage
+    :returns: initial storage pressure
+    """
+    if cd.initial_pressure is not None:
+        print(f"{'Initial pressure is:':30s} {float(cd.initial_pressure):.6f} [bar]")
+        return float(cd.initial_pressure)
+
+    p0, dummy_flow = geostorage.call_storage_simulation(0.0, -1, 0, cd, 'init')
+    return p0
+
+
+def calc_timestep_storage(geostorage, massflow, p0, md, tstep, storage_off):
+    """
+    calculates one timestep of a storage-only simulation driven by a mass
+    flow schedule
+
+    The scheduled mass flow is passed to the storage simulation, the wells
+    keep their BHP limits. If the storage pressure is at the upper (lower)
+    well BHP limit, charging (discharging) is not started and the storage is
+    shut in until the pressure moved away from the limit by
+    pressure_change_restart or the schedule changes, like the power plant
+    shut-off in calc_timestep.
+
+    :param geostorage: storage model
+    :type geostorage: GeoStorage
+    :param massflow: scheduled mass flow in kg/s, positive into the storage
+    :type massflow: float
+    :param p0: initial pressure at timestep
+    :type p0: float
+    :param md: object containing the basic model data
+    :type md: model_data object
+    :param storage_off: storage shut in due to a BHP limit
+    :type storage_off: bool
+    :returns: - p1 (*float*) - storage pressure at the end of the timestep
+              - m (*float*) - target mass flow, positive into the storage
+              - m_corr (*float*) - achieved mass flow, positive into the storage
+              - tstep_accepted (*bool*) - always True, there is nothing to iterate
+              - storage_off (*bool*) - storage shut in due to a BHP limit
+    """
+    if abs(massflow) < 1E-7: #matching float values, potentionally dangerous
+        storage_mode = 'shut-in'
+    elif massflow < 0.0:
+        storage_mode = 'discharging'
+    else:
+        storage_mode = 'charging'
+
+    md.convergence.start(tstep, storage_mode)
+    md.trace.at(tstep, 0)
+    md.trace.record('timestep', storage_mode, massflow, p0)
+
+    if storage_mode == 'charging' and p0 >= min(geostorage.well_upper_BHP) or \
+            storage_mode == 'discharging' and p0 <= max(geostorage.well_lower_BHP):
+        print('Storage pressure at the well BHP limit, shutting in.')
+        storage_off = True
+    if storage_off:
+        if md.log_iterations:
+            print('Storage temporarily shut in due to storage pressure. Mode set to shut-in')
+        storage_mode = 'shut-in'
+    m = 0.0 if storage_mode == 'shut-in' else abs(massflow)
+    if md.log_iterations:
+        print(f"Operational mode of the storage is: {storage_mode}")
+        sys.stdout.flush()
+
+    p1, m_corr = geostorage.call_storage_simulation(m, tstep, 0, md, storage_mode)
+
+    if storage_off:
+        diff_to_max = abs(p1 - min(geostorage.well_upper_BHP))
+        diff_to_min = abs(p1 - max(geostorage.well_lower_BHP))
+        p_limit = max(geostorage.well_lower_BHP) if diff_to_min < diff_to_max else min(geostorage.well_upper_BHP)
+        if abs(p1 - p_limit) >= md.pressure_change_restart:
+            print('Pressure moved away from the well BHP limit, restarting storage operation.')
+            storage_off = False
+
+    delta_p = abs(p1 - p0)
+    delta_m = abs(abs(m_corr) - m)
+    md.convergence.iteration('shut_in' if storage_mode == 'shut-in' else 'converged',
+                             delta_p, delta_p / p1, delta_m, delta_m / abs(m_corr) if m_corr else 0.0)
+
+    sign = -1.0 if storage_mode == 'discharging' else 1.0
+    md.convergence.finish(True)
+    md.trace.record('accept', 'accepted', p1, sign * abs(m_corr), 0.0, 0.0)
+    return p1, sign * m, sign * abs(m_corr), True, storage_off
+
+
 def calc_timestep(powerplant, geostorage, power, p0, md, tstep, pp_off):
     """
     calculates one timestep of coupled power plant - storage simulation
@@ -478,8 +795,12 @@ def calc_timestep(powerplant, geostorage, power, p0, md, tstep, pp_off):
         storage_mode = 'charging'
         #m, power_corr = powerplant.get_mass_flow(power, p0, storage_mode)
 
-    print(f"Operational mode of the system is: {storage_mode}")
-    sys.stdout.flush()
+    if md.log_iterations:
+        print(f"Operational mode of the system is: {storage_mode}")
+        sys.stdout.flush()
+    md.convergence.start(tstep, storage_mode)
+    md.trace.at(tstep, 0)
+    md.trace.record('timestep', storage_mode, power, p0)
 
     #moved inner iteration into timestep function,
     #iterate until timestep is accepted
@@ -488,29 +809,39 @@ def calc_timestep(powerplant, geostorage, power, p0, md, tstep, pp_off):
     for iter_step in range(md.max_iter): #do time-specific iterations
 
         if tstep_accepted:
-            print(f"Message: Timestep accepted after iteration {iter_step - 1}")
+            if md.log_iterations:
+                print(f"Message: Timestep accepted after iteration {iter_step - 1}")
             break
-        print("-" * 50)
-        print(f"{'Current iteration:':30s} {iter_step}")
-        print("-" * 50)
-        sys.stdout.flush()
+        md.trace.at(tstep, iter_step)
+        if md.log_iterations:
+            print("-" * 50)
+            print(f"{'Current iteration:':30s} {iter_step}")
+            print("-" * 50)
+            sys.stdout.flush()
 
         if pp_off == True:
-            print ('Power plant temporarily shut-off due to storage pressure. Mode set to shut-in')
+            if md.log_iterations:
+                print ('Power plant temporarily shut-off due to storage pressure. Mode set to shut-in')
             storage_mode = "shut-in"
             m = 0.0
             power_corr = 0.0
             sys.stdout.flush()
         else:
             #run power plant model to get target flow rate
-            print ('Running power plant model')
+            if md.log_iterations:
+                print ('Running power plant model')
             m, power_corr, heat = powerplant.get_mass_flow(power, p1, storage_mode)
 
         #if target mass flow is zero, set storage mode to shut-in
         if m == 0.0:    #matching float values, potentionally dangerous
             storage_mode = 'shut-in'
             power_corr = 0.0
-        print("-" * 50)
+        if md.log_iterations:
+            print("-" * 50)
+
+        # pre-solve the power plant at the predicted storage pressure while the storage simulation runs
+        if md.pipeline:
+            powerplant.presolve(power, p1, storage_mode)
 
         #get pressure for the given target rate and the actually achieved flow rate from storage simulation
         p1, m_corr = geostorage.call_storage_simulation(m, tstep, iter_step, md, storage_mode )
@@ -528,8 +859,13 @@ def calc_timestep(powerplant, geostorage, power, p0, md, tstep, pp_off):
                 delta_m_iter = 0.0
                 delta_m_iter_rel = 0.0
 
+        # branch taken after the storage simulation, for the convergence log
+        branch = 'power_plant_off' if pp_off else None
+        m_storage_target = m
+
         if pp_off == True:
-            print ('Power plant shut-off, testing pressure difference...')
+            if md.log_iterations:
+                print ('Power plant shut-off, testing pressure difference...')
             #determine pressure limit
             diff_to_max = abs(p1 - min(geostorage.well_upper_BHP))
             diff_to_min = abs(p1 - max(geostorage.well_lower_BHP))
@@ -540,34 +876,43 @@ def calc_timestep(powerplant, geostorage, power, p0, md, tstep, pp_off):
                 #upper pressure
                 p_limit = min(geostorage.well_upper_BHP)
             p_delta_limit = abs(p1 - p_limit)
-            print ('Pressure diff to limit is ', p_delta_limit , ' bars' )
+            if md.log_iterations:
+                print ('Pressure diff to limit is ', p_delta_limit , ' bars' )
 
             if p_delta_limit >= md.pressure_change_restart:
                 print ('...restarting power plant.' )
                 pp_off = False
 
             sys.stdout.flush()
-        print( 'Summary of iteration:')
-        print('m_target / m_storage\t\t', '%.6f'%m, '/', '%.6f'%m_corr, '[kg/s]')
-        print('p_assumed / p_storage\t\t', '%.6f'%p0_temp, '/', '%.6f'%p1, '[bars]')
+        if md.log_iterations:
+            print( 'Summary of iteration:')
+            print('m_target / m_storage\t\t', '%.6f'%m, '/', '%.6f'%m_corr, '[kg/s]')
+            print('p_assumed / p_storage\t\t', '%.6f'%p0_temp, '/', '%.6f'%p1, '[bars]')
 
         if storage_mode == 'charging' or storage_mode == 'discharging':
             # pressure check
             if delta_p_iter_rel > md.pressure_diff_rel or delta_p_iter > md.pressure_diff_abs:
-                print('Adjusting mass flow rate due to storage pressure difference.')
+                if md.log_iterations:
+                    print('Adjusting mass flow rate due to storage pressure difference.')
+                branch = branch or 'pressure_adjust'
                 m, power_corr, heat = powerplant.get_mass_flow(power, p1, storage_mode)
                 if m == 0:
                     print('Forcing shut-in mode as m is zero.')
+                    branch = 'forced_shut_in'
                     storage_mode = 'shut-in'
                 sys.stdout.flush()
 
             elif delta_m_iter_rel > md.flow_diff_rel or  delta_m_iter > md.flow_diff_abs:
-                print('Storage pressure converged and mass flow is not...')
+                if md.log_iterations:
+                    print('Storage pressure converged and mass flow is not...')
+                branch = branch or 'flow_adjust'
                 m, power_corr, heat = powerplant.get_power(m_corr, p1, storage_mode)
                 m = m_corr
-                print('Adjusting power to ', power_corr)
+                if md.log_iterations:
+                    print('Adjusting power to ', power_corr)
                 if power_corr == 0.0:
                     print ('Power plant shut off due min. mass flow violation: Storage shut-in')
+                    branch = 'forced_shut_in'
                     storage_mode = 'shut-in'
                     pp_off = True
                     m = 0.0
@@ -578,33 +923,43 @@ def calc_timestep(powerplant, geostorage, power, p0, md, tstep, pp_off):
                 sys.stdout.flush()
 
             else:
-                print('Storage pressure and mass flow converged.')
+                if md.log_iterations:
+                    print('Storage pressure and mass flow converged.')
+                branch = branch or 'converged'
                 #return p1, m_corr, power
                 tstep_accepted = True
                 #m = m_corr
 
             if storage_mode == 'charging':
                 if m < powerplant.charge_model.dot_m_max and p1 < p0_temp:
-                    print ('current target mass flow is: ', '%.6f'%m, '[kg/s]')
-                    print ('current pressure is: ', '%.6f'%p1, '[bar]')
-                    print ('last pressure was: ', '%.6f'%p0_temp, '[bar]')
-                    print ('updating target power output during charging to time step target')
+                    if md.log_iterations:
+                        print ('current target mass flow is: ', '%.6f'%m, '[kg/s]')
+                        print ('current pressure is: ', '%.6f'%p1, '[bar]')
+                        print ('last pressure was: ', '%.6f'%p0_temp, '[bar]')
+                        print ('updating target power output during charging to time step target')
                     power = power_corr
             elif storage_mode == 'discharging':
                 if m < powerplant.discharge_model.dot_m_max and p1 > p0_temp:
-                    print ('current target mass flow is: ', '%.6f'%m, '[kg/s]')
-                    print ('current pressure is: ', '%.6f'%p1, '[bar]')
-                    print ('last pressure was: ', '%.6f'%p0_temp, '[bar]')
-                    print ('Updating target power output during discharging to time step target')
+                    if md.log_iterations:
+                        print ('current target mass flow is: ', '%.6f'%m, '[kg/s]')
+                        print ('current pressure is: ', '%.6f'%p1, '[bar]')
+                        print ('last pressure was: ', '%.6f'%p0_temp, '[bar]')
+                        print ('Updating target power output during discharging to time step target')
                     power = power_corr
 
         elif storage_mode == "shut-in":
-            print('Force accepting timestep b/c storage shut-in')
+            if md.log_iterations:
+                print('Force accepting timestep b/c storage shut-in')
+            branch = branch or 'shut_in'
             tstep_accepted = True
         else:
             print('Problem: Storage mode not understood')
+            branch = 'mode_error'
             tstep_accepted = True
 
+        md.convergence.iteration(branch, delta_p_iter, delta_p_iter_rel, delta_m_iter, delta_m_iter_rel)
+        md.trace.record('iteration', branch, m_storage_target, m_corr, p0_temp, p1)
+
         #saving old pressure
         p0_temp = p1
 
@@ -612,6 +967,8 @@ def calc_timestep(powerplant, geostorage, power, p0, md, tstep, pp_off):
         print("-" * 50)
         print('Problem: Results in timestep ', tstep, 'did not converge, accepting last iteration result.')
     sys.stdout.flush()
+    md.convergence.finish(tstep_accepted)
+    md.trace.record('accept', 'accepted' if tstep_accepted else 'not_accepted', p1, m, power_corr, heat)
     return p1, m, m_corr, power_corr, heat, tstep_accepted, pp_off
 
 def read_series(path):
@@ -671,6 +1028,86 @@ class CouplingData:
         date_format = '%Y-%m-%d %H:%M:%S'
         self.t_start = datetime.datetime.strptime(self.t_start, date_format)
 
+        # timing profile of the coupling loop, enabled unless 'profile' is "False"
+        self.profile = str(getattr(self, 'profile', 'True')) == 'True'
+        self.profiler = telemetry.Profiler(enabled=self.profile)
+        # convergence log of the coupling iterations, enabled unless 'convergence_log' is "False"
+        self.convergence = telemetry.ConvergenceLog(
+            enabled=str(getattr(self, 'convergence_log', 'True')) == 'True')
+
+        # concurrent layouts and initial storage run, enabled unless 'parallel_startup' is "False"
+        self.parallel_startup = str(getattr(self, 'parallel_startup', 'True')) == 'True'
+
+        # power plant pre-solves during the storage simulation, disabled unless 'pipeline' is "True"
+        self.pipeline = str(getattr(self, 'pipeline', 'False')) == 'True'
+
+        # binary event trace of the coupling loop, enabled unless 'trace' is "False"
+        self.trace = EventTrace(capacity=int(getattr(self, 'trace_capacity', 65536)),
+                                enabled=str(getattr(self, 'trace', 'True')) == 'True')
+        # per-iteration screen output, the event trace holds the same values
+        self.log_iterations = str(getattr(self, 'log_iterations', 'True')) == 'True'
+
+        # machine-wide core budget of the OPM runs, disabled unless 'core_scheduler' is "True"
+        self.scheduler = CoreScheduler(
+            budget=getattr(self, 'core_budget', None),
+            directory=getattr(self, 'core_scheduler_dir', DEFAULT_DIR),
+            cells_per_rank=getattr(self, 'cells_per_rank', 50000),
+            threads_per_rank=getattr(self, 'threads_per_rank', 1),
+            enabled=str(getattr(self, 'core_scheduler', 'False')) == 'True')
+
+        # persistent cache of the storage simulation results, disabled unless 'storage_cache' is "True"
+        geostorage_dir = os.path.join(self.working_dir, self.geostorage_path.replace('\\', os.sep).strip(os.sep))
+        self.storage_cache = StorageCache(
+            getattr(self, 'storage_cache_dir', os.path.join(geostorage_dir, '.storage_cache')),
+            max_size=getattr(self, 'storage_cache_size', 1024),
+            enabled=str(getattr(self, 'storage_cache', 'False')) == 'True')
+
+        # recording of the storage simulations next to the output file, disabled unless 'record' is "True",
+        # with 'record_powerplant' also the power plant solves; 'replay' serves the responses of a recording
+        self.recording = Recording(
+            record=str(getattr(self, 'record', 'False')) == 'True',
+            powerplant=str(getattr(self, 'record_powerplant', 'False')) == 'True',
+            replay=os.path.join(self.working_dir, self.replay) if getattr(self, 'replay', None) else None,
+            replay_powerplant=str(getattr(self, 'replay_powerplant', 'False')) == 'True')
+
+        # live progress metrics in the Prometheus text format, disabled unless 'metrics' is "True"
+        output_base = os.path.splitext(os.path.join(self.working_dir, self.output_timeseries_path))[0]
+        self.metrics = telemetry.MetricsFile(
+            os.path.join(self.working_dir, getattr(self, 'metrics_path', output_base + '.prom')),
+            interval=getattr(self, 'metrics_interval', 10.0),
+            timesteps=self.t_steps_total,
+            labels={'scenario': self.scenario, 'working_dir': self.working_dir},
+            enabled=str(getattr(self, 'metrics', 'False')) == 'True')
+
+        # storage-only runs follow a mass flow schedule in kg/s (positive into the storage) without
+        # the power plant, disabled unless 'storage_only' is "True"
+        self.storage_only = str(getattr(self, 'storage_only', 'False')) == 'True'
+        self.massflow_timeseries_path = getattr(self, 'massflow_timeseries_path', self.input_timeseries_path)
+        self.massflow_columns = tuple(getattr(self, 'massflow_columns', ('cmp_m', 'exp_m')))
+
+        # end-of-run balancing of the storage inventory, disabled unless 'balance_mass_eos' is "True"
+        self.balance_mass_eos = str(getattr(self, 'balance_mass_eos', 'False')) == 'True'
+        self.balance_step_length = float(getattr(self, 'balance_step_length', 86400))
+        self.balance_massflow = getattr(self, 'balance_massflow', None)
+
+        # the first 'history_steps' timesteps follow the storage mass flow history in 'history_path'
+        # (kg/s, positive into the storage) without the power plant
+        self.history_steps = int(getattr(self, 'history_steps', 0))
+        self.history_path = getattr(self, 'history_path', None)
+
+        # one storage run covers consecutive timesteps of equal target, at most 'segment_max_steps',
+        # shortened after pressure changes above 'segment_pressure_change' (bar), disabled unless
+        # 'compress_schedule' is "True"
+        self.compress_schedule = str(getattr(self, 'compress_schedule', 'False')) == 'True'
+        self.segment_max_steps = int(getattr(self, 'segment_max_steps', 24))
+        self.segment_pressure_change = getattr(self, 'segment_pressure_change', None)
+
+        # initial storage pressure in bar, the initial storage simulation is skipped if given
+        self.initial_pressure = getattr(self, 'initial_pressure', None)
+
+        # results as NumPy array next to the .csv output, disabled unless 'binary_output' is "True"
+        self.binary_output = str(getattr(self, 'binary_output', 'False')) == 'True'
+
         print('Reading input file \"' + self.scenario + '.main_ctrl.json\" ')
         print('in working directory \"' + self.working_dir + '\"')
 
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Monte Carlo ensembles of coupled simulations over storage parameters.
+
+usage: python -m coupled_simulation.ensemble -i <main_ctrl.json> -s <samples.csv> [-w workers] [-r retries] [-o output]
+
+The sample table is a semicolon separated file with one realization per row.
+An optional column 'member' names the realizations. Columns in upper case
+are multipliers of grid arrays of the storage deck (e.g. PORO, PERMX),
+all other columns set keys of the geostorage control file (e.g.
+well_upper_BHP), nested keys are separated by dots
+(e.g. reservoir_properties.permeability). Scalars set for list entries are
+applied to all wells.
+
+Every realization is run as coupled simulation in its own directory below
+<working dir>/ensemble, at most 'workers' at a time. All realizations use
+the power plant of the template scenario, its layout is calculated once
+before the realizations start. Failed realizations are repeated up to
+'retries' times. The results are stacked into one structured array of shape
+(realizations, timesteps + 1) in <output>.npy, the parameters and status of
+each realization are written to <output>.json.
+
+__author__ = "fgasa"
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import getopt
+import json
+import os
+import shutil
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def read_samples(path):
+    '''
+    Reads the parameter sample table
+
+    :param path: path to the sample table
+    :param type: str
+    :returns: list of tuples of member name and dict of parameters, numbers as float
+    '''
+    samples = []
+    with open(path, mode='r', newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f, delimiter=';')
+        for i, row in enumerate(reader):
+            name = row.pop('member', None) or f"{i:04d}"
+            samples.append((name, {key: _number(value) for key, value in row.items()}))
+    return samples
+
+
+def _number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def load_scenario(path):
+    '''
+    Reads the main, geostorage and power plant control files of a scenario
+
+    :param path: path to the main control file
+    :param type: str
+    :returns: SimpleNamespace with the scenario name, the directories and
+              the control data
+    '''
+    path = os.path.abspath(path)
+    working_dir = os.path.dirname(path)
+    scenario = os.path.basename(path)[:-len('.main_ctrl.json')]
+    with open(path) as f:
+        main_ctrl = json.load(f)
+
+    def directory(key):
+        return os.path.join(working_dir, main_ctrl[key].replace('\\', os.sep).strip(os.sep))
+
+    geostorage_dir = directory('geostorage_path')
+    with open(os.path.join(geostorage_dir, f"{scenario}.geostorage_ctrl.json")) as f:
+        geostorage_ctrl = json.load(f)
+
+    return SimpleNamespace(
+        path=path, working_dir=working_dir, scenario=scenario, main_ctrl=main_ctrl,
+        geostorage_dir=geostorage_dir, geostorage_ctrl=geostorage_ctrl,
+        powerplant_dir=directory('powerplant_path'),
+        input_path=os.path.join(working_dir, main_ctrl['input_timeseries_path'])
+    )
+
+
+def well_data(geostorage_ctrl):
+    '''
+    Well data the power plant layout depends on
+
+    :param geostorage_ctrl: geostorage control data
+    :param type: dict
+    :returns: tuple of minimum well depth, number of wells, maximum and minimum pressure
+    '''
+    return (min(geostorage_ctrl['well_depths']), len(geostorage_ctrl['well_names']),
+            max(geostorage_ctrl['well_upper_BHP']), min(geostorage_ctrl['well_lower_BHP']))
+
+
+def prepare_powerplant(base, geostorage_ctrls, main_ctrl=None):
+    '''
+    Calculates the power plant layouts into the layout cache of the template
+    scenario, once for every distinct set of well data
+
+    :param base: template scenario, see load_scenario
+    :param type: SimpleNamespace
+    :param geostorage_ctrls: geostorage control data of the runs
+    :param type: list
+    :param main_ctrl: main control data, defaults to the one of the template
+    :param type: dict
+    :returns: no return value
+    '''
+    from coupled_simulation import powerplant as pp
+
+    main_ctrl = main_ctrl or base.main_ctrl
+    # the runs share the power plant of the template and always use the layout cache, see make_run
+    settings = SimpleNamespace(**{
+        **main_ctrl, 'working_dir': base.working_dir, 'powerplant_path': base.powerplant_dir,
+        'scenario': base.scenario, 'layout_cache': 'True'
+    })
+    for data in sorted(set(well_data(ctrl) for ctrl in geostorage_ctrls)):
+        pp.PowerPlantCoupling(settings, *data).close()
+
+
+def set_key(ctrl, key, value):
+    '''
+    Sets a (dotted) key of a control dict, lists are set element-wise
+
+    :param ctrl: control data
+    :param type: dict
+    :param key: key, nested keys separated by dots
+    :param type: str
+    :param value: new value
+    :param type: float or str
+    :returns: no return value
+    '''
+    *parents, name = key.split('.')
+    for parent in parents:
+        ctrl = ctrl.setdefault(parent, {})
+    if isinstance(ctrl.get(name), list) and not isinstance(value, list):
+        value = [value] * len(ctrl[name])
+    ctrl[name] = value
+
+
+def multiply_grid(deck_path, multipliers):
+    '''
+    Adds a MULTIPLY keyword for grid arrays at the end of the GRID section
+
+    :param deck_path: path to the storage deck
+    :param type: str
+    :param multipliers: factor for each grid array
+    :param type: dict
+    :returns: no return value
+    '''
+    if not multipliers:
+        return
+    with open(deck_path) as f:
+        lines = f.readlines()
+    keywords = [line.split('--')[0].strip() for line in lines]
+    end = keywords.index('EDIT') if 'EDIT' in keywords else keywords.index('PROPS')
+    block = ['MULTIPLY\n'] + [f"  '{array}' {factor:g} /\n" for array, factor in multipliers.items()] + ['/\n', '\n']
+    with open(deck_path, 'w') as f:
+        f.writelines(lines[:end] + block + lines[end:])
+
+
+def make_run(base, run_dir, main_keys=None, geostorage_keys=None, multipliers=None, powerplant_dir=None):
+    '''
+    Creates the directory of a coupled run from the template scenario
+
+    The geostorage directory is copied, the power plant and the input time
+    series are used from the template (or the given power plant directory).
+    Runs on the power plant of the template always use the layout cache.
+
+    :param base: template scenario, see load_scenario
+    :param type: SimpleNamespace
+    :param run_dir: directory of the run, replaced if it exists
+    :param type: str
+    :param main_keys: keys of the main control file to set
+    :param type: dict
+    :param geostorage_keys: keys of the geostorage control file to set
+    :param type: dict
+    :param multipliers: grid array multipliers of the storage deck
+    :param type: dict
+    :param powerplant_dir: power plant directory of the run
+    :param type: str
+    :returns: path to the main control file of the run
+    '''
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_dir)
+    geostorage_dir = os.path.join(run_dir, 'geostorage')
+    shutil.copytree(base.geostorage_dir, geostorage_dir)
+
+    geostorage_ctrl = json.loads(json.dumps(base.geostorage_ctrl))
+    for key, value in (geostorage_keys or {}).items():
+        set_key(geostorage_ctrl, key, value)
+    with open(os.path.join(geostorage_dir, f"{base.scenario}.geostorage_ctrl.json"), 'w') as f:
+        json.dump(geostorage_ctrl, f, indent=1)
+    if geostorage_ctrl['simulator'] != 'ANALYTICAL':
+        multiply_grid(os.path.join(geostorage_dir, f"{geostorage_ctrl['simulation_title']}.DATA"), multipliers)
+
+    main_ctrl = dict(base.main_ctrl)
+    main_ctrl.update({
+        'geostorage_path': 'geostorage',
+        'powerplant_path': powerplant_dir or base.powerplant_dir,
+        'input_timeseries_path': base.input_path,
+        'output_timeseries_path': 'output.csv',
+        'binary_output': 'True',
+    })
+    # further input files of the template, relative to its working directory
+    for key in ('massflow_timeseries_path', 'replay'):
+        if key in main_ctrl:
+            main_ctrl[key] = os.path.join(base.working_dir, main_ctrl[key])
+    main_ctrl.update(main_keys or {})
+    if powerplant_dir is None:
+        # concurrent runs on the power plant of the template must not lay it out into
+        # the design.json files of its model directories, they restore the layouts from the cache
+        main_ctrl['layout_cache'] = 'True'
+    path = os.path.join(run_dir, f"{base.scenario}.main_ctrl.json")
+    with open(path, 'w') as f:
+        json.dump(main_ctrl, f, indent=1)
+    return path
+
+
+def run_coupled(path, prepare=None, retries=1):
+    '''
+    Runs a coupled simulation in a separate interpreter, repeated if it fails
+
+    :param path: path to the main control file
+    :param type: str
+    :param prepare: called before every attempt to (re)create the run directory
+    :param type: callable
+    :param retries: number of repetitions of a failed run
+    :param type: int
+    :returns: tuple of the results (numpy.ndarray or None) and the number of attempts
+    '''
+    run_dir = os.path.dirname(path)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [PACKAGE_ROOT, env.get('PYTHONPATH')]))
+    for attempt in range(1, retries + 2):
+        if prepare is not None:
+            prepare()
+        with open(os.path.join(run_dir, 'run.err'), 'w') as err:
+            proc = subprocess.run(
+                [sys.executable, '-m', 'coupled_simulation.coupling', '-i', path],
+                cwd=run_dir, env=env, stdout=subprocess.DEVNULL, stderr=err
+            )
+        result_path = os.path.join(run_dir, 'output.npy')
+        if proc.returncode == 0 and os.path.isfile(result_path):
+            return np.load(result_path), attempt
+    return None, attempt
+
+
+def stack_results(results, n_rows):
+    '''
+    Stacks the results of several runs, missing results are filled with NaN
+
+    :param results: structured arrays of the runs or None
+    :param type: list
+    :param n_rows: number of rows per run
+    :param type: int
+    :returns: numpy.ndarray of shape (runs, n_rows)
+    '''
+    dtype = next((r.dtype for r in results if r is not None), None)
+    if dtype is None:
+        return None
+    stacked = np.zeros((len(results), n_rows), dtype=dtype)
+    for name in dtype.names:
+        if dtype[name].kind == 'f':
+            stacked[name] = np.nan
+        elif dtype[name].kind == 'M':
+            stacked[name] = np.datetime64('NaT')
+    for i, result in enumerate(results):
+        if result is not None:
+            stacked[i, :min(len(result), n_rows)] = result[:n_rows]
+    return stacked
+
+
+def run_ensemble(path, samples, workers=None, retries=1, output=None):
+    '''
+    Runs all realizations of an ensemble
+
+    :param path: path to the main control file of the template scenario
+    :param type: str
+    :param samples: member names and parameters, see read_samples
+    :param type: list
+    :param workers: number of concurrent realizations, defaults to the available cores
+    :param type: int
+    :param retries: number of repetitions of a failed realization
+    :param type: int
+    :param output: path of the results without extension, defaults to <working dir>/ensemble/ensemble
+    :param type: str
+    :returns: tuple of the stacked results and the member records
+    '''
+    from coupled_simulation.powerplant import _available_cores
+
+    base = load_scenario(path)
+    root = os.path.join(base.working_dir, 'ensemble')
+    output = output or os.path.join(root, 'ensemble')
+    workers = workers or _available_cores()
+
+    members = []
+    for name, params in samples:
+        multipliers = {key: value for key, value in params.items() if key.isupper()}
+        geostorage_keys = {key: value for key, value in params.items() if not key.isupper()}
+        members.append({'member': name, 'parameters': params, 'dir': os.path.join(root, f"member_{name}"),
+                        'multipliers': multipliers, 'geostorage_keys': geostorage_keys})
+
+    ctrls = []
+    for member in members:
+        ctrl = json.loads(json.dumps(base.geostorage_ctrl))
+        for key, value in member['geostorage_keys'].items():
+            set_key(ctrl, key, value)
+        ctrls.append(ctrl)
+    print(f"{'Ensemble members:':30s} {len(members)}")
+    print('Preparing power plant layouts...')
+    prepare_powerplant(base, ctrls)
+
+    def run(member):
+        ctrl_path = os.path.join(member['dir'], f"{base.scenario}.main_ctrl.json")
+
+        def prepare():
+            make_run(base, member['dir'], geostorage_keys=member['geostorage_keys'],
+                     multipliers=member['multipliers'])
+
+        # a member whose run directory cannot be created (e.g. a deck without the sections
+        # for the grid multipliers) fails on its own, the other members go on
+        try:
+            result, attempts = run_coupled(ctrl_path, prepare, retries)
+            error = None if result is not None else f"see {os.path.join(member['dir'], 'run.err')}"
+        except Exception as e:
+            result, attempts, error = None, 0, str(e)
+        status = 'failed' if result is None else 'done'
+        print(f"{'Member ' + member['member'] + ':':30s} {status} after {attempts} attempt(s)"
+              + (f", {error}" if error else ''))
+        return result, attempts, error
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        outcomes = list(executor.map(run, members))
+
+    results = [result for result, _, _ in outcomes]
+    stacked = stack_results(results, int(base.main_ctrl['t_steps_total']) + 1)
+    records = [{'member': m['member'], 'parameters': m['parameters'], 'dir': m['dir'],
+                'status': 'failed' if result is None else 'done', 'attempts': attempts, 'error': error}
+               for m, (result, attempts, error) in zip(members, outcomes)]
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    if stacked is not None:
+        np.save(output + '.npy', stacked)
+    with open(output + '.json', 'w') as f:
+        json.dump({'template': base.path, 'members': records}, f, indent=1)
+    print(f"{'Failed members:':30s} {sum(r['status'] == 'failed' for r in records)} of {len(records)}")
+    print(f"{'Results written to:':30s} {output}.npy")
+    return stacked, records
+
+
+def main(argv):
+    usage = 'ensemble.py -i <main_ctrl.json> -s <samples.csv> [-w workers] [-r retries] [-o output]'
+    path = samples = output = None
+    workers = None
+    retries = 1
+
+    try:
+        opts, args = getopt.getopt(argv, 'hi:s:w:r:o:', ['ipath=', 'samples=', 'workers=', 'retries=', 'output='])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            sys.exit()
+        elif opt in ('-i', '--ipath'):
+            path = arg
+        elif opt in ('-s', '--samples'):
+            samples = arg
+        elif opt in ('-w', '--workers'):
+            workers = int(arg)
+        elif opt in ('-r', '--retries'):
+            retries = int(arg)
+        elif opt in ('-o', '--output'):
+            output = arg
+    if path is None or samples is None:
+        print(usage)
+        sys.exit(2)
+
+    run_ensemble(path, read_samples(samples), workers, retries, output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
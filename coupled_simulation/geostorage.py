@@ -8,6 +8,11 @@ __author__ = "wtp, fgasa"
 """
 
 from coupled_simulation import utilities as util
+from coupled_simulation.telemetry import Profiler
+from coupled_simulation.replay import Recording
+from coupled_simulation.scheduler import CoreScheduler
+from coupled_simulation.storage_cache import StorageCache, simulator_identity
+from coupled_simulation.trace import EventTrace
 import json
 import os
 import re
@@ -36,17 +41,39 @@ class GeoStorage:
 
         self.working_dir_loc = wdir
         self.keep_ecl_logs = False
+        self.profiler = getattr(cd, 'profiler', None) or Profiler(enabled=False)
+        self.trace = getattr(cd, 'trace', None) or EventTrace(enabled=False)
+        self.scheduler = getattr(cd, 'scheduler', None) or CoreScheduler(enabled=False)
+        self.recording = getattr(cd, 'recording', None) or Recording(enabled=False)
+        self.grid_cells = None
+        self.storage_cache = getattr(cd, 'storage_cache', None) or StorageCache(None, enabled=False)
+        # cache keys of the simulations, a simulation restarts from the last one of the previous timestep
+        self.cache_tstep = None
+        self.cache_parent = None
+        self.cache_last = None
+        self.cache_simulator = simulator_identity(self.simulator, getattr(self, 'simulator_path', None),
+                                                  getattr(self, 'simulator_args', None))
+        self.log_iterations = getattr(cd, 'log_iterations', True)
 
         # save the original simulation title in case of eclipse simulation (not needed for e300)
+        # the analytical model does not use a deck, the title is optional in that case
+        self.simulation_title = getattr(self, 'simulation_title', self.simulator)
         self.simulation_title_orig = self.simulation_title
         self.current_simulation_title = self.simulation_title
         self.old_simulation_title = self.simulation_title
 
-        if self.retain_ecl_logs == "True":
+        if getattr(self, 'retain_ecl_logs', "False") == "True":
             self.keep_ecl_logs = True
         else:
             self.keep_ecl_logs = False
 
+        if self.simulator == 'ANALYTICAL':
+            # imported here, deck handling and result parsing do not need NumPy
+            from coupled_simulation.analytical import AnalyticalStorage
+            self.analytical_model = AnalyticalStorage(
+                self.reservoir_properties, self.well_names, self.well_lower_BHP, self.well_upper_BHP,
+                self.surface_density, getattr(self, 'reservoir_compartments', 1))
+
     def call_storage_simulation(self, target_flow, tstep, iter_step, coupling_data, op_mode):
         '''
         Entry point for geo-storage simulation, handles all data transfer, executes simulator
@@ -64,15 +91,23 @@ class GeoStorage:
         '''
         #this is the entry point for the geostorage coupling
 
-        if self.simulator in ['ECLIPSE', 'e300']:
+        if self.recording.replaying:
+            pressure, flowrate = self.recording.storage(target_flow, tstep, iter_step,
+                                                        coupling_data.t_step_length, op_mode)
+        elif self.simulator in ['ECLIPSE', 'e300']:
             flowrate, pressure = self.run_simulator(target_flow, tstep, iter_step, coupling_data.t_step_length, op_mode)
         elif self.simulator == 'PROXY':
             flowrate, pressure = self.run_proxy(target_flow, tstep, iter_step, coupling_data.t_step_length, op_mode)
         elif self.simulator == 'OPM':
             flowrate, pressure = self.run_simulator(target_flow, tstep, iter_step, coupling_data.t_step_length, op_mode)
+        elif self.simulator == 'ANALYTICAL':
+            flowrate, pressure = self.run_analytical(target_flow, tstep, iter_step, coupling_data.t_step_length, op_mode)
         else:
             print('ERROR: simulator flag not understood. Is: ', self.simulator)
 
+        self.recording.record_storage(target_flow, tstep, iter_step, coupling_data.t_step_length, op_mode,
+                                      pressure, flowrate)
+        self.trace.record('storage', op_mode, target_flow, flowrate, pressure, coupling_data.t_step_length)
         return pressure, flowrate
 
     def run_simulator(self, target_flowrate, tstep, iter_step, tstepsize, current_mode):
@@ -109,7 +144,7 @@ class GeoStorage:
                     os.path.join(self.working_dir_loc, f"{self.current_simulation_title}.DATA")
                 )
 
-        if not current_mode == 'init':
+        if current_mode != 'init' and self.log_iterations:
             print(f"{'Running storage simulation'}")
             print(f"{'Simulation title:':30s} {self.current_simulation_title}")
             print(f"{'Timestep / iteration:':30s} {int(tstep)} / {int(iter_step)}")
@@ -118,33 +153,50 @@ class GeoStorage:
             print(f"{'Target flowrate [sm3/s]:':30s} {(target_flowrate / self.surface_density):.6f}")
             print(f"{'Operational mode:':30s} {current_mode}")
 
-        else:
+        elif current_mode == 'init':
             print('Running storage simulation to obtain initial pressure')
 
         #adjusting to surface volume rates
         target_flowrate = target_flowrate / self.surface_density
 
         # assembling current ecl data file
-        self.rework_ecl_data(tstep, tstepsize, target_flowrate, current_mode)
-        # executing reservoir simulator
-        if str(self.simulator).upper().startswith("OPM"):
-            self.execute_opm(tstep, iter_step)
-        else:
-            self.execute_ecl(tstep, iter_step, current_mode)
-        # reading results
-        ecl_results = self.get_ecl_results(tstep, current_mode)
+        with self.profiler.phase('deck_rework'):
+            self.rework_ecl_data(tstep, tstepsize, target_flowrate, current_mode)
+        ecl_results = None
+        if self.storage_cache.enabled:
+            if tstep != self.cache_tstep:
+                self.cache_parent = self.cache_last
+                self.cache_tstep = tstep
+            deck_path = os.path.join(self.working_dir_loc, f"{self.current_simulation_title}.DATA")
+            self.cache_last = self.storage_cache.key(deck_path, self.cache_parent, target_flowrate,
+                                                     current_mode, tstepsize, self.cache_simulator)
+            ecl_results = self.storage_cache.restore(self.cache_last, self.working_dir_loc,
+                                                     self.current_simulation_title)
+        if ecl_results is None:
+            # executing reservoir simulator
+            with self.profiler.phase('simulator'):
+                if str(self.simulator).upper().startswith("OPM"):
+                    self.execute_opm(tstep, iter_step)
+                else:
+                    self.execute_ecl(tstep, iter_step, current_mode)
+            # reading results
+            with self.profiler.phase('result_parsing'):
+                ecl_results = self.get_ecl_results(tstep, current_mode)
+            self.storage_cache.store(self.cache_last, self.working_dir_loc, self.current_simulation_title,
+                                     ecl_results)
 
         #adjusting to mass flow rates
         ecl_results[1] = ecl_results[1] * self.surface_density
 
-        if not current_mode == 'init':
+        if current_mode == 'init':
+            print(f"{'Initial pressure is: '} {'%.6f' % ecl_results[0]}" ' [bar]')
+            print("-" * 50)
+        elif self.log_iterations:
             print("-" * 50)
             print(f"{'Pressure actual [bar]:':30s} {'%.6f' % ecl_results[0]}")
             print(f"{'Flowrate actual [kg/s]:':30s} {'%.6f' % ecl_results[1]}")
             print(f"{' ':30s} {'%.6f' % (ecl_results[1] / self.surface_density)}" ' [sm3/s]')
-        else:
-            print(f"{'Initial pressure is: '} {'%.6f' % ecl_results[0]}" ' [bar]')
-        print("-" * 50)
+            print("-" * 50)
         return (ecl_results[1], ecl_results[0])
 
     def rearrange_rsm_data_array(self, rsm_list):
@@ -401,6 +453,10 @@ class GeoStorage:
 
     def delete_sim_files(self, tstep):
 
+        if self.simulator == 'ANALYTICAL':
+            # in-process model, no simulator files to clean up
+            return
+
         file_ending_unform = ".X"
         file_ending_form = ".F"
         temp_nr_str = ""
@@ -624,7 +680,7 @@ class GeoStorage:
             self.old_simulation_title = self.current_simulation_title
             self.current_simulation_title = f"{self.simulation_title_orig}_TSTEP_{tstep}_{iter_step}"
 
-        if not current_mode == 'init':
+        if current_mode != 'init' and self.log_iterations:
             print('Running storage simulation')
             print(f"{'Simulation title:':30s} {self.current_simulation_title}")
             print(f"{'Timestep / iteration:':30s} {int(tstep)} / {int(iter_step)}")
@@ -632,28 +688,31 @@ class GeoStorage:
             print(f"{'Target flowrate [kg/s]:':30s} {target_flowrate:.6f}")  # storage flow rate
             print(f"{'Target flowrate [sm3/s]:':30s} {(target_flowrate / self.surface_density):.6f}")
             print(f"{'Operational mode:':30s} {current_mode}")
-        else:
+        elif current_mode == 'init':
             print('Running storage simulation to obtain initial pressure')
 
         # change unit of flowrates to kg/s from kg/d
         target_flowrate = target_flowrate / self.surface_density * 60.0 * 60.0 * 24.0
 
-        self.rework_proxy_data(tstep, iter_step, target_flowrate, current_mode)
-
-        self.execute_proxy()
+        with self.profiler.phase('deck_rework'):
+            self.rework_proxy_data(tstep, iter_step, target_flowrate, current_mode)
 
-        proxy_results = self.get_proxy_results(current_mode)
+        with self.profiler.phase('simulator'):
+            self.execute_proxy()
 
-        self.rework_proxy_results(tstep, iter_step)
+        with self.profiler.phase('result_parsing'):
+            proxy_results = self.get_proxy_results(current_mode)
+            self.rework_proxy_results(tstep, iter_step)
 
-        if not current_mode == 'init':
+        if current_mode == 'init':
+            print(f"{'Initial pressure is:':30s} {'%.6f' % proxy_results[0]}" '[bar]')
+            print("-" * 50)
+        elif self.log_iterations:
             print("-" * 50)
             print(f"{'Pressure actual [bar]:':30s} {'%.6f' % proxy_results[0]}")
             print(f"{'Flowrate actual [kg/s]:':30s} {'%.6f' % proxy_results[1]}")
             print(f"{' ':30s} {'%.6f' % (proxy_results[1] / self.surface_density)}" ' [sm3/s]')
-        else:
-            print(f"{'Initial pressure is:':30s} {'%.6f' % proxy_results[0]}" '[bar]')
-        print("-" * 50)
+            print("-" * 50)
 
         return (proxy_results[1], proxy_results[0])
 
@@ -797,6 +856,43 @@ class GeoStorage:
         old_filename = os.path.join(self.working_dir_loc, f"{self.simulation_title_orig}.RESULT_WELLS")
         os.rename(old_filename, new_filename)
 
+    def run_analytical(self, target_flowrate, tstep, iter_step, tstepsize, current_mode):
+        '''
+        Function acting as a wrapper for the in-process analytical storage model
+
+        :param target_flowrate: target storage flow rate in kg/s
+        :param type: float
+        :param tstep: current timestep
+        :param type: int
+        :param iter_step: current iteration step
+        :param type: int
+        :param tstepsize: length of current timestep
+        :param type: float
+        :param current_mode: current operational mode, either 'charging', 'discharging', 'shut-in' or 'init'
+        :param type: str
+        :returns: returns tuple of actual (achieved) storage flow rate and new pressure at the well
+        '''
+        if current_mode != 'init' and self.log_iterations:
+            print('Running analytical storage model')
+            print(f"{'Timestep / iteration:':30s} {int(tstep)} / {int(iter_step)}")
+            print(f"{'Target flowrate [kg/s]:':30s} {target_flowrate:.6f}")
+            print(f"{'Operational mode:':30s} {current_mode}")
+        elif current_mode == 'init':
+            print('Running analytical storage model to obtain initial pressure')
+
+        with self.profiler.phase('simulator'):
+            flowrate, pressure = self.analytical_model.simulate(target_flowrate, tstep, tstepsize, current_mode)
+
+        if current_mode == 'init':
+            print(f"{'Initial pressure is: '} {'%.6f' % pressure}" ' [bar]')
+            print("-" * 50)
+        elif self.log_iterations:
+            print("-" * 50)
+            print(f"{'Pressure actual [bar]:':30s} {'%.6f' % pressure}")
+            print(f"{'Flowrate actual [kg/s]:':30s} {'%.6f' % flowrate}")
+            print("-" * 50)
+        return (flowrate, pressure)
+
     def execute_opm(self, tstep, iter_step):
 
         simulation_path = os.path.join(self.working_dir_loc, self.current_simulation_title + ".DATA")
@@ -808,6 +904,45 @@ class GeoStorage:
             log_file_path = None
         sim_args = getattr(self, 'simulator_args')
         mpi_cores = int(getattr(self, 'mpi_cores', 0))
+        if self.scheduler.enabled:
+            if self.grid_cells is None:
+                self.grid_cells = self.get_grid_cells(simulation_path)
+            # mpi_cores is the upper limit of the ranks granted by the core scheduler
+            with self.scheduler.lease(self.grid_cells, mpi_cores) as (ranks, threads):
+                self.run_opm(simulation_path, log_file_path, sim_args, ranks, threads)
+        else:
+            self.run_opm(simulation_path, log_file_path, sim_args, mpi_cores)
+
+    def get_grid_cells(self, deck_path):
+        '''
+        Number of grid cells from the DIMENS keyword of a deck
+
+        :param deck_path: path to the storage deck
+        :param type: str
+        :returns: int, 0 if the deck has no DIMENS keyword
+        '''
+        deck = util.get_file(deck_path)
+        pos = util.search_section(deck, 'DIMENS')
+        if pos < 0:
+            return 0
+        dims = deck[pos + 1].split('/')[0].split()
+        return int(dims[0]) * int(dims[1]) * int(dims[2])
+
+    def run_opm(self, simulation_path, log_file_path, sim_args, mpi_cores, threads=None):
+        '''
+        Runs OPM Flow on a deck, with MPI if more than one core is given
+
+        :param mpi_cores: number of MPI ranks
+        :param type: int
+        :param threads: OpenMP threads per rank, not set if None
+        :param type: int
+        :returns: no return value
+        '''
+        env = None
+        if threads is not None:
+            env = dict(os.environ, OMP_NUM_THREADS=str(threads))
+            sim_args = sim_args + [f"--threads-per-process={threads}"]
+
         def to_wsl(path):
             p = path.replace("\\", "/")
             drive = p[0].lower()
@@ -829,7 +964,7 @@ class GeoStorage:
             else:
                 # silence output when logs disabled
                 run_cmd = run_cmd + " > /dev/null 2>&1"
-            subprocess.run(["wsl", "bash", "-c", run_cmd])
+            subprocess.run(["wsl", "bash", "-c", run_cmd], env=env)
             return
 
          # linux execution
@@ -841,7 +976,7 @@ class GeoStorage:
 
             if log_file_path is not None:
                 with open(log_file_path, "w", encoding="utf-8") as logf:
-                    subprocess.run(run_cmd, stdout=logf, stderr=logf)
+                    subprocess.run(run_cmd, stdout=logf, stderr=logf, env=env)
             else:
-                subprocess.run(run_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                subprocess.run(run_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
             return
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+__author__ = "fgasa"
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import shutil
+import tempfile
+from types import SimpleNamespace
+import time
+
+from coupled_simulation import powerplant as pp
+
+
+class PowerPlantPipeline:
+    '''
+    Pre-solves the power plant off-design while the storage simulator runs.
+
+    Wraps a PowerPlantCoupling object. Before each storage simulation the
+    mass flows for the current power target (needed if the storage pressure
+    does not converge) and for the power target of the next timestep are
+    solved on a worker thread. The worker uses its own copy of the power
+    plant networks, restored from the layout cache, so the state of the main
+    networks is not changed. Each target is solved at two pressures that
+    bracket the storage pressure before the simulation and the pressure
+    predicted from the last observed pressure change. If the actual storage
+    pressure falls inside the bracket, the result is interpolated linearly,
+    otherwise the power plant is solved as usual.
+
+    The pre-solved results are discarded with the next pre-solve. All other
+    attributes are taken from the wrapped power plant.
+    '''
+
+    def __init__(self, powerplant, cd):
+        self.powerplant = powerplant
+        self.profiler = cd.profiler
+        self.log_iterations = getattr(cd, 'log_iterations', True)
+        # minimum half width of the pressure bracket in bar
+        self.window = float(getattr(cd, 'pipeline_pressure_window', 0.5))
+
+        # the copy writes its design states to a directory of its own, without layout cache
+        # it is laid out again while the main models solve from the design states of the model directories
+        self.design_dir = tempfile.mkdtemp(prefix='if_pplant_pipeline_')
+        settings = SimpleNamespace(
+            working_dir=cd.working_dir, powerplant_path=cd.powerplant_path,
+            scenario=cd.scenario, layout_cache=getattr(cd, 'layout_cache', 'True'),
+            design_dir=self.design_dir
+        )
+        self.copy = pp.PowerPlantCoupling(
+            settings, powerplant.min_well_depth, powerplant.num_wells, powerplant.p_max, powerplant.p_min
+        )
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        # (mode, power) -> (base pressure, low pressure, high pressure, future)
+        self.cache = {}
+        self.next_power = None
+        # storage pressure change observed between a pre-solve and the following lookup
+        self.last_change = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        return getattr(self.powerplant, name)
+
+    def presolve(self, power, pressure, mode):
+        '''
+        Submits the pre-solves for the current and the next power target
+
+        :param power: power target of the current iteration
+        :param type: float
+        :param pressure: storage pressure passed to the storage simulation
+        :param type: float
+        :param mode: current storage mode
+        :param type: str
+        :returns: no return value
+        '''
+        self._drain()
+        self.cache = {}
+
+        targets = [(mode, power)]
+        if self.next_power is not None and abs(self.next_power) >= 1E-7:
+            next_mode = 'discharging' if self.next_power < 0.0 else 'charging'
+            targets.append((next_mode, self.next_power))
+
+        change = self.last_change
+        if abs(change) > 10 * self.window:
+            # pressure jump after a change of the storage mode, not repeated in the next step
+            change = 0.0
+        p_low = min(pressure, pressure + change) - self.window
+        p_high = max(pressure, pressure + change) + self.window
+        for key in dict.fromkeys(targets):
+            if key[0] not in ('charging', 'discharging'):
+                continue
+            future = self.executor.submit(self._solve_bracket, key[1], p_low, p_high, key[0])
+            self.cache[key] = (pressure, p_low, p_high, future)
+
+    def _solve_bracket(self, power, p_low, p_high, mode):
+        t0 = time.perf_counter()
+        results = (self.copy.get_mass_flow(power, p_low, mode),
+                   self.copy.get_mass_flow(power, p_high, mode))
+        self.profiler.add('presolve', time.perf_counter() - t0)
+        return results
+
+    def _drain(self):
+        # the worker and the main thread never solve at the same time
+        for _, _, _, future in self.cache.values():
+            future.exception()
+
+    def get_mass_flow(self, power, pressure, mode):
+        '''
+        Mass flow at given power and pressure, interpolated from the
+        pre-solved bracket if possible, see PowerPlantCoupling.get_mass_flow
+
+        :returns: tuple of mass flow, power and heat
+        '''
+        if mode not in ('charging', 'discharging'):
+            return self.powerplant.get_mass_flow(power, pressure, mode)
+
+        entry = self.cache.get((mode, power))
+        if entry is not None:
+            base, p_low, p_high, future = entry
+            self.last_change = pressure - base
+            if future.exception() is None and p_low <= pressure <= p_high:
+                low, high = future.result()
+                # both ends feasible, the plant is not shut off or limited in between
+                if low[0] != 0 and high[0] != 0:
+                    self.hits += 1
+                    share = (pressure - p_low) / (p_high - p_low)
+                    result = tuple(a + share * (b - a) for a, b in zip(low, high))
+                    if self.log_iterations:
+                        print(f"Pre-solved result for power = {power}, pressure = {pressure}: "
+                              f"massflow = {result[0]}.")
+                    return result
+
+        self.misses += 1
+        self._drain()
+        return self.powerplant.get_mass_flow(power, pressure, mode)
+
+    def get_power(self, mass_flow, pressure, mode):
+        self._drain()
+        return self.powerplant.get_power(mass_flow, pressure, mode)
+
+    def close(self):
+        '''
+        Stops the worker threads and prints the share of pre-solved results
+
+        :returns: no return value
+        '''
+        self._drain()
+        self.executor.shutdown()
+        self.copy.close()
+        self.powerplant.close()
+        shutil.rmtree(self.design_dir, ignore_errors=True)
+        total = self.hits + self.misses
+        share = self.hits / total if total else 0.0
+        print(f"{'Pre-solved power plant calls:':30s} {self.hits} of {total} ({share:.1%})")
@@ -6,16 +6,184 @@ Created on Mon Feb 12 15:17:46 2018
 @author: witte
 """
 
+import bisect
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
+import hashlib
+import importlib.metadata
+import multiprocessing
 import os
 import json
 import logging
-from tespy.tools.logger import logger
-from .powerplant_template import PowerPlant, H2PowerPlant
-from tespy import __version__
-print("TESPy version:", __version__)
+import shutil
+import sys
+import tempfile
+from types import SimpleNamespace
+import numpy as np
+from .telemetry import Profiler
+from .trace import EventTrace
 
-logger.setLevel(logging.ERROR)
+# TESPy and the model templates are imported on first use of
+# PowerPlantCoupling, see _import_tespy
+PowerPlant = H2PowerPlant = None
+tespy_version = None
+
+
+def _import_tespy():
+    """
+    Import TESPy and the power plant model templates, silence the TESPy
+    logger and print the TESPy version once.
+    """
+    global PowerPlant, H2PowerPlant, tespy_version
+    if tespy_version is not None:
+        return
+
+    from tespy import __version__
+    from tespy.tools.logger import logger
+    from .powerplant_template import PowerPlant, H2PowerPlant
+    print("TESPy version:", __version__)
+
+    logger.setLevel(logging.ERROR)
+    tespy_version = __version__
+
+
+def start_layouts(cd, min_well_depth, num_wells, p_max, p_min):
+    """
+    Start one worker process per charge and discharge layout missing in the
+    layout cache.
+
+    The workers are forked, so they neither re-import the calling script nor
+    re-run the coupling, and must be started before the caller starts any
+    thread (e.g. the storage initialisation). Their output is collected in
+    temporary files and printed by :code:`join_layouts`, prefixed with the
+    mode. The results are stored in the
+    layout cache, the :code:`PowerPlantCoupling` created after
+    :code:`join_layouts` restores them from there. No worker is started if
+    the layout cache is disabled, at most one layout is missing, fewer than
+    two cores are available (every worker imports TESPy on its own, which
+    does not pay off on a single core) or the platform cannot fork.
+
+    Parameters
+    ----------
+    cd : coupling_data
+        Generel data for the interface handling.
+
+    min_well_depth, num_wells, p_max, p_min
+        Well information, see :code:`PowerPlantCoupling`.
+
+    Returns
+    -------
+    workers : list
+        Tuples of mode, worker process and output file.
+    """
+    settings = {
+        "working_dir": cd.working_dir,
+        "powerplant_path": cd.powerplant_path,
+        "scenario": cd.scenario,
+        "layout_cache": getattr(cd, "layout_cache", "True"),
+        "layout_snapshot": getattr(cd, "layout_snapshot", "True"),
+    }
+    coupling = PowerPlantCoupling(
+        SimpleNamespace(**settings), min_well_depth, num_wells, p_max, p_min, load_models=False
+    )
+    if not coupling.layout_cache or "fork" not in multiprocessing.get_all_start_methods():
+        return []
+
+    modes = [mode for mode in coupling.available_modes()
+             if not os.path.isdir(os.path.join(coupling.layout_cache_dir, coupling._layout_key(mode)))]
+    if len(modes) < 2 or _available_cores() < 2:
+        return []
+
+    print(f"{'Solving layouts concurrently:':30s} {', '.join(modes)}")
+    # the workers inherit the buffered output of the parent
+    sys.stdout.flush()
+    if hasattr(sys.stdout, "log"):
+        sys.stdout.log.flush()
+    context = multiprocessing.get_context("fork")
+    workers = []
+    for mode in modes:
+        handle, output = tempfile.mkstemp(prefix=f"if_pplant_layout_{mode}_", suffix=".out")
+        os.close(handle)
+        process = context.Process(
+            target=_layout_worker, args=(settings, mode, output, min_well_depth, num_wells, p_max, p_min)
+        )
+        process.start()
+        workers.append((mode, process, output))
+    return workers
+
+
+def join_layouts(workers):
+    """
+    Wait for the layout workers started by :code:`start_layouts`. Layouts
+    of failed workers are calculated serially by the
+    :code:`PowerPlantCoupling` created afterwards.
+
+    Parameters
+    ----------
+    workers : list
+        Tuples of mode, worker process and output file.
+
+    Returns
+    -------
+    modes : list
+        Modes whose layouts were solved in worker processes.
+    """
+    modes = []
+    for mode, process, output in workers:
+        process.join()
+        with open(output, errors="replace") as f:
+            lines = f.read().splitlines()
+        os.remove(output)
+        if lines:
+            # one write, the storage initialisation thread prints at the same time
+            print("".join(f"[layout {mode}] {line}\n" for line in lines), end="")
+        if process.exitcode == 0:
+            modes.append(mode)
+        else:
+            msg = (f"Concurrent layout calculation of {mode} failed (exit code {process.exitcode}), "
+                   "continuing serially.")
+            print(msg)
+            logging.warning(msg)
+    return modes
+
+
+# power plant of a batch worker process, see PowerPlantCoupling._solve_batch
+_batch_coupling = None
+
+
+def _init_batch_worker(settings, design_root, min_well_depth, num_wells, p_max, p_min):
+    global _batch_coupling
+    # without layout cache every worker lays out the power plant, each in a design directory of its own
+    settings = dict(settings, design_dir=tempfile.mkdtemp(dir=design_root))
+    _batch_coupling = PowerPlantCoupling(
+        SimpleNamespace(**settings), min_well_depth, num_wells, p_max, p_min
+    )
+
+
+def _batch_worker(method, targets, pressures, mode):
+    return [getattr(_batch_coupling, method)(target, pressure, mode)
+            for target, pressure in zip(targets, pressures)]
+
+
+def _available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _layout_worker(settings, mode, output, min_well_depth, num_wells, p_max, p_min):
+    # all output of the worker, also of the solver and the logging, goes to its
+    # output file, it would interleave with the other workers and the parent
+    f = open(output, "w", buffering=1)
+    os.dup2(f.fileno(), 1)
+    os.dup2(f.fileno(), 2)
+    sys.stdout = sys.stderr = f
+    coupling = PowerPlantCoupling(
+        SimpleNamespace(**settings), min_well_depth, num_wells, p_max, p_min, load_models=False
+    )
+    setattr(coupling, f"{mode}_model", coupling._build_model(mode))
+    coupling._make_layout(mode)
+    return mode
 
 
 class PowerPlantCoupling:
@@ -51,15 +219,66 @@ class PowerPlantCoupling:
 
     _MODE_MAP = {'charging': 'charge', 'discharging': 'discharge'}
 
-    def __init__(self, cd, min_well_depth, num_wells, p_max, p_min):
+    def __init__(self, cd, min_well_depth, num_wells, p_max, p_min, load_models=True):
 
         self.wdir = os.path.join(cd.working_dir, cd.powerplant_path)
         self.sc = cd.scenario
-        ctrl_file = os.path.join(self.wdir, f"{cd.scenario}.powerplant_ctrl.json")
+        self.profiler = getattr(cd, 'profiler', None) or Profiler(enabled=False)
+        self.trace = getattr(cd, 'trace', None) or EventTrace(enabled=False)
+        self.log_iterations = getattr(cd, 'log_iterations', True)
+        self.ctrl_file = os.path.join(self.wdir, f"{cd.scenario}.powerplant_ctrl.json")
 
-        with open(ctrl_file) as f:
+        with open(self.ctrl_file) as f:
             self.config = json.load(f)
 
+        # layout cache, enabled unless 'layout_cache' is "False" in the main control file
+        self.layout_cache = str(getattr(cd, 'layout_cache', 'True')) == 'True'
+        self.layout_cache_dir = os.path.join(self.wdir, ".layout_cache")
+        self.layout_cache_hits = 0
+        self.layout_cache_misses = 0
+        # snapshots of the laid-out models in the layout cache, enabled unless
+        # 'layout_snapshot' is "False" in the main control file
+        self.layout_snapshot = self.layout_cache and str(getattr(cd, 'layout_snapshot', 'True')) == 'True'
+
+        # private directory for the design states written by layout calculations, for copies of
+        # the power plant laid out while other instances read the design states of the model directories
+        self.design_dir = getattr(cd, 'design_dir', None)
+
+        # operating envelope, enabled if 'operating_envelope' is "True" in the main control file
+        self.operating_envelope = str(getattr(cd, 'operating_envelope', 'False')) == 'True'
+        self.envelope_points = int(getattr(cd, 'envelope_points', 7))
+        # relative margin, requests closer to the envelope boundary are solved
+        self.envelope_margin = float(getattr(cd, 'envelope_margin', 0.02))
+        # mass flows of the characteristic table, the two bounds form the envelope
+        self.characteristic_points = int(getattr(cd, 'characteristic_points', 2))
+        # worker processes for batch queries that are not served from the characteristic table
+        self.batch_workers = int(getattr(cd, 'batch_workers', _available_cores()))
+        self._batch_pool = None
+        self._batch_design_dir = None
+        self._batch_settings = {
+            "working_dir": cd.working_dir,
+            "powerplant_path": cd.powerplant_path,
+            "scenario": cd.scenario,
+            "layout_cache": getattr(cd, "layout_cache", "True"),
+            "layout_snapshot": getattr(cd, "layout_snapshot", "True"),
+            "operating_envelope": "False",
+        }
+
+        # linearized corrections around the last solved point of each mode,
+        # enabled if 'linearization' is "True" in the main control file
+        self.linearization = str(getattr(cd, 'linearization', 'False')) == 'True'
+        # trust region: pressure change in bar and relative change of the target
+        self.linearization_pressure = float(getattr(cd, 'linearization_pressure', 0.5))
+        self.linearization_target = float(getattr(cd, 'linearization_target', 0.01))
+        self._anchors = {}
+        self.linearized_calls = 0
+        if self.linearization and self.characteristic_points <= 2:
+            msg = ("Linearization with a characteristic table of the envelope mass flows only, the sensitivities "
+                   "are chord slopes between minimum and maximum mass flow. Set 'characteristic_points' > 2 for "
+                   "local slopes.")
+            print(msg)
+            logging.warning(msg)
+
         # well information
         self.min_well_depth = min_well_depth
         self.num_wells = num_wells
@@ -68,96 +287,183 @@ class PowerPlantCoupling:
         self.p_max = p_max
         self.p_min = p_min
 
-        self.load_tespy_models()
+        if load_models:
+            self.load_tespy_models()
+
+    def available_modes(self):
+        """
+        Modes with an exported TESPy model, the discharge model is optional.
+        """
+        discharge_path = os.path.join(self.wdir, self.config["discharge"]["path"], "export.json")
+        if not os.path.exists(discharge_path):
+            return ["charge"]
+        return ["charge", "discharge"]
 
     def load_tespy_models(self):
 
-        data = deepcopy(self.config["charge"])
-        data["path"] = os.path.join(self.wdir, data["path"])
-        charge_path = os.path.join(data["path"], "export.json")
-        self.charge_model = PowerPlant.from_json(charge_path, data)
-        self.charge_model.nw.solve("design", init_path=self.charge_model._design_path)
-        self.charge_model.nw.set_attr(iterinfo=False)
+        for mode in self.available_modes():
+            if not (self.layout_snapshot and self._load_snapshot(mode)):
+                setattr(self, f"{mode}_model", self._build_model(mode))
+                self._make_layout(mode)
+            if self.operating_envelope:
+                self._make_characteristics(mode)
 
-        data = deepcopy(self.config["discharge"])
+    def _build_model(self, mode):
+        """
+        Create the TESPy model of a mode from its export.json.
+        """
+        _import_tespy()
+        data = deepcopy(self.config[mode])
         data["path"] = os.path.join(self.wdir, data["path"])
-        discharge_path = os.path.join(data["path"], "export.json")
+        model_path = os.path.join(data["path"], "export.json")
 
-        if not os.path.exists(discharge_path):
-            self._make_charge_layout()
-            return
+        template = PowerPlant
+        if mode == "discharge":
+            with open(model_path, "r") as f:
+                model_data = json.load(f)
 
-        with open(discharge_path, "r") as f:
-            model_data = json.load(f)
+            connections = model_data["Connection"]["Connection"]
+            if "01" in connections and "H2" in connections["01"]["fluid"]["val"]:
+                template = H2PowerPlant
 
-        self.discharge_model = PowerPlant.from_json(discharge_path, data)
+        model = template.from_json(model_path, data)
+        model._design_path = self._default_design_path(model, mode)
+        return model
 
-        if "01" in model_data["Connection"]["Connection"]:
-            if "H2" in model_data["Connection"]["Connection"]["01"]["fluid"]["val"]:
-                self.discharge_model = H2PowerPlant.from_json(discharge_path, data)
-                nw = self.discharge_model.nw
-                c05 = nw.get_conn("05")
-                c05_T = c05.T.val
-                c05.set_attr(T=None)
+    def _default_design_path(self, model, mode):
+        """
+        Design state of a model that is not restored from the layout cache:
+        design.json in the model directory, or a copy of it in
+        :code:`design_dir` if the instance has a private design directory.
+        """
+        path = os.path.join(model.config["path"], "design.json")
+        if self.design_dir is None:
+            return path
+        private = os.path.join(self.design_dir, mode, "design.json")
+        if not os.path.isfile(private):
+            os.makedirs(os.path.dirname(private), exist_ok=True)
+            if os.path.isfile(path):
+                shutil.copyfile(path, private)
+        return private
+
+    def _initialise_design(self, mode):
+        """
+        Initial design solve of a freshly loaded model, required before the
+        layout calculation.
+        """
+        model = getattr(self, f"{mode}_model")
 
-                comb = nw.get_comp("combustion")
-                comb.set_attr(lamb=3)
+        if mode == "charge":
+            model.nw.solve("design", init_path=model._design_path)
 
-                c08 = nw.get_conn("08")
-                c08.set_attr(T=500)
+        elif isinstance(model, H2PowerPlant):
+            startup_values = self._set_h2_startup_specifications(model)
+            model.nw.solve('design')
+            self._reset_h2_startup_specifications(model, startup_values)
+            model.nw.solve('design')
 
-                evap = nw.get_comp("evaporator")
-                evap_ttd_l = evap.ttd_l.val
-                evap.set_attr(ttd_l=None)
+        else:
+            model.nw.solve("design", init_path=model._stable_solution)
 
-                c01 = nw.get_conn("01")
-                c01.set_attr(m=5)           # fix fuel mass flow (or H2 flow) for startup
+        model.nw.set_attr(iterinfo=False)
 
-                e01 = nw.get_conn("e01")
-                e01_E = e01.E.val
-                e01.set_attr(E=None)   # now the bus sets the power
+    def _set_h2_startup_specifications(self, model):
+        """
+        Startup specifications of the H2 plant (combustion, evaporator and
+        fuel mass flow overrides), returns the values to restore afterwards.
+        """
+        nw = model.nw
+        c05 = nw.get_conn("05")
+        c05_T = c05.T.val
+        c05.set_attr(T=None)
 
-                well = nw.get_comp("well")
-                well_ks = well.ks.val
-                well.set_attr(dp=2, ks=None)
+        comb = nw.get_comp("combustion")
+        comb.set_attr(lamb=3)
 
-                nw.solve('design')
+        c08 = nw.get_conn("08")
+        c08.set_attr(T=500)
 
-                c05.set_attr(T=c05_T)
-                comb.set_attr(lamb=None)
+        evap = nw.get_comp("evaporator")
+        evap_ttd_l = evap.ttd_l.val
+        evap.set_attr(ttd_l=None)
 
-                c08.set_attr(T=None)
-                evap.set_attr(ttd_l=evap_ttd_l)
+        c01 = nw.get_conn("01")
+        c01.set_attr(m=5)           # fix fuel mass flow (or H2 flow) for startup
 
-                c01.set_attr(m=None)           # fix fuel mass flow (or H2 flow) for startup
-                e01.set_attr(E=e01_E)   # now the bus sets the power
+        e01 = nw.get_conn("e01")
+        e01_E = e01.E.val
+        e01.set_attr(E=None)   # now the bus sets the power
 
-                well.set_attr(dp=None, ks=well_ks)
-                nw.solve('design')
+        well = nw.get_comp("well")
+        well_ks = well.ks.val
+        well.set_attr(dp=2, ks=None)
 
-        else:
-            self.discharge_model.nw.solve("design", init_path=self.discharge_model._stable_solution)
+        return c05_T, evap_ttd_l, e01_E, well_ks
 
-        self.discharge_model.nw.set_attr(iterinfo=False)
-        self._make_power_plant_layouts()
+    def _reset_h2_startup_specifications(self, model, startup_values):
+        nw = model.nw
+        c05_T, evap_ttd_l, e01_E, well_ks = startup_values
 
-    def _make_power_plant_layouts(self):
+        nw.get_conn("05").set_attr(T=c05_T)
+        nw.get_comp("combustion").set_attr(lamb=None)
+
+        nw.get_conn("08").set_attr(T=None)
+        nw.get_comp("evaporator").set_attr(ttd_l=evap_ttd_l)
+
+        nw.get_conn("01").set_attr(m=None)           # fix fuel mass flow (or H2 flow) for startup
+        nw.get_conn("e01").set_attr(E=e01_E)   # now the bus sets the power
+
+        nw.get_comp("well").set_attr(dp=None, ks=well_ks)
+
+    def _make_layout(self, mode):
         """
         Power plant layout calculation to determine power plant design point using
         nominal power input/output and nominal pressure as inputs.
+
+        The resulting design state and nominal values are taken from the layout
+        cache if the plant configuration and well parameters did not change.
         """
-        self._make_charge_layout()
-        self._make_discharge_layout()
+        model = getattr(self, f"{mode}_model")
+        key = self._layout_key(mode)
+
+        if self.layout_cache and self._load_layout(model, mode, key):
+            self.layout_cache_hits += 1
+        else:
+            self.layout_cache_misses += 1
+            self._initialise_design(mode)
+            if mode == "charge":
+                self._make_charge_layout()
+            else:
+                self._make_discharge_layout()
+
+            if self.layout_cache:
+                self._store_layout(model, key)
+
+        if self.layout_snapshot:
+            self._store_snapshot(model, key)
+
+    def _layout_specifications(self, mode):
+        if mode == "charge":
+            return {
+                "ambient_pressure": self.config["general"]["ambient pressure"],
+                "ambient_temperature": self.config["general"]["ambient temperature"],
+                "well_number": self.num_wells,
+                "well_depth": self.min_well_depth,
+                "power": self.config["charge"]["power_nominal"],
+                "well_pressure": self.config["charge"]["pressure_nominal"]
+            }
+        else:
+            return {
+                "ambient_pressure": self.config["general"]["ambient pressure"],
+                "well_number": self.num_wells,
+                "well_depth": self.min_well_depth,
+                "power": self.config["charge"]["power_nominal"],
+                "well_pressure": self.config["charge"]["pressure_nominal"],
+                "well_temperature": self.config["storage"]["temperature"]
+            }
 
     def _make_charge_layout(self):
-        charge_specifications = {
-            "ambient_pressure": self.config["general"]["ambient pressure"],
-            "ambient_temperature": self.config["general"]["ambient temperature"],
-            "well_number": self.num_wells,
-            "well_depth": self.min_well_depth,
-            "power": self.config["charge"]["power_nominal"],
-            "well_pressure": self.config["charge"]["pressure_nominal"]
-        }
+        charge_specifications = self._layout_specifications("charge")
         self.charge_model.solve_model_design_with_stepping(**charge_specifications)
         self.charge_model.save_design_state()
         self.charge_model.solve_model_offdesign()
@@ -176,14 +482,7 @@ class PowerPlantCoupling:
 
     def _make_discharge_layout(self):
 
-        discharge_specifications = {
-            "ambient_pressure": self.config["general"]["ambient pressure"],
-            "well_number": self.num_wells,
-            "well_depth": self.min_well_depth,
-            "power": self.config["charge"]["power_nominal"],
-            "well_pressure": self.config["charge"]["pressure_nominal"],
-            "well_temperature": self.config["storage"]["temperature"]
-        }
+        discharge_specifications = self._layout_specifications("discharge")
         self.discharge_model.solve_model_design_with_stepping(**discharge_specifications)
         self.discharge_model.save_design_state()
         self.discharge_model.solve_model_offdesign()
@@ -200,6 +499,279 @@ class PowerPlantCoupling:
             * self.config["discharge"]["massflow_max_rel"]
         )
 
+    def _layout_key(self, mode):
+        """
+        Hash of everything the layout of a mode depends on: the powerplant
+        control file, the mode's export.json, the well number and depth and
+        the installed TESPy version (read without importing TESPy).
+        """
+        digest = hashlib.sha256()
+        with open(self.ctrl_file, "rb") as f:
+            digest.update(f.read())
+        with open(os.path.join(self.wdir, self.config[mode]["path"], "export.json"), "rb") as f:
+            digest.update(f.read())
+        digest.update(f"{mode}|{self.num_wells}|{self.min_well_depth}|{importlib.metadata.version('tespy')}".encode())
+        return f"{mode}-{digest.hexdigest()[:24]}"
+
+    def _load_layout(self, model, mode, key):
+        entry = os.path.join(self.layout_cache_dir, key)
+        layout_file = os.path.join(entry, "layout.json")
+        if not os.path.isfile(layout_file):
+            return False
+
+        with open(layout_file) as f:
+            layout = json.load(f)
+
+        # restore the off-design state at the nominal point from the cached
+        # design state, only the stepped design solves of the layout are skipped
+        model._design_path = os.path.join(entry, "design.json")
+        if isinstance(model, H2PowerPlant):
+            # the H2 plant needs its startup solves to reach a consistent set of specifications
+            self._initialise_design(mode)
+        else:
+            model.nw.set_attr(iterinfo=False)
+            model.nw.solve("design", init_path=model._design_path, init_only=True)
+        model.set_parameters(**self._layout_specifications(mode))
+        model.solve_model_offdesign()
+        if not model._solved:
+            msg = f"Cached power plant layout {key} could not be restored, recalculating layout."
+            print(msg)
+            logging.warning(msg)
+            model._design_path = self._default_design_path(model, mode)
+            return False
+
+        for attr in ("dot_m_nominal", "power_nominal", "dot_m_min", "dot_m_max"):
+            setattr(model, attr, layout[attr])
+        print(f"{'Power plant layout from cache:':30s} {key}")
+        return True
+
+    def _store_layout(self, model, key):
+        os.makedirs(self.layout_cache_dir, exist_ok=True)
+        # write into a temporary directory and rename, concurrent runs may store the same key
+        tmp = tempfile.mkdtemp(dir=self.layout_cache_dir)
+        shutil.copyfile(model._design_path, os.path.join(tmp, "design.json"))
+        layout = {
+            attr: getattr(model, attr)
+            for attr in ("dot_m_nominal", "power_nominal", "dot_m_min", "dot_m_max")
+        }
+        with open(os.path.join(tmp, "layout.json"), "w") as f:
+            json.dump(layout, f, indent=1)
+        try:
+            os.rename(tmp, os.path.join(self.layout_cache_dir, key))
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _load_snapshot(self, mode):
+        """
+        Restore the laid-out model of a mode from its snapshot in the layout
+        cache, this skips building the network from export.json and the
+        solves restoring the layout.
+        """
+        key = self._layout_key(mode)
+        entry = os.path.join(self.layout_cache_dir, key)
+        path = os.path.join(entry, "snapshot.pkl")
+        if not os.path.isfile(path):
+            return False
+
+        _import_tespy()
+        data = deepcopy(self.config[mode])
+        data["path"] = os.path.join(self.wdir, data["path"])
+        try:
+            model = PowerPlant.from_snapshot(path, data, os.path.join(entry, "design.json"))
+        except Exception as e:
+            msg = f"Power plant snapshot {key} could not be loaded ({e}), rebuilding the model."
+            print(msg)
+            logging.warning(msg)
+            return False
+
+        setattr(self, f"{mode}_model", model)
+        self.layout_cache_hits += 1
+        print(f"{'Power plant from snapshot:':30s} {key}")
+        return True
+
+    def _store_snapshot(self, model, key):
+        entry = os.path.join(self.layout_cache_dir, key)
+        path = os.path.join(entry, "snapshot.pkl")
+        # the design state is restored from the entry's design.json
+        if not os.path.isdir(entry) or os.path.isfile(path):
+            return
+        # write to a temporary file and rename, concurrent runs may store the same key
+        fd, tmp = tempfile.mkstemp(dir=entry, suffix=".pkl")
+        os.close(fd)
+        try:
+            model.save_snapshot(tmp)
+            os.replace(tmp, path)
+        except Exception as e:
+            os.remove(tmp)
+            msg = f"Power plant snapshot {key} could not be written ({e})."
+            print(msg)
+            logging.warning(msg)
+
+    def _make_characteristics(self, mode):
+        """
+        Characteristic table of a mode: power and heat at
+        :code:`characteristic_points` mass flows from minimum to maximum mass
+        flow on a grid of well pressures between the pressure limits. The
+        first and the last mass flow form the operating envelope. The table
+        is kept with the layout in the layout cache.
+        """
+        model = getattr(self, f"{mode}_model")
+        if not self.p_max > self.p_min:
+            msg = (f"No characteristic table for {mode}, the pressure range from {self.p_min} to {self.p_max} bar "
+                   "is empty. The power plant is solved for every request.")
+            print(msg)
+            logging.warning(msg)
+            return
+        n = max(self.envelope_points, 2)
+        k = max(self.characteristic_points, 2)
+        pressures = [self.p_min + (self.p_max - self.p_min) * i / (n - 1) for i in range(n)]
+        mass_flows = [model.dot_m_min + (model.dot_m_max - model.dot_m_min) * i / (k - 1) for i in range(k)]
+
+        table_file = os.path.join(
+            self.layout_cache_dir, self._layout_key(mode),
+            f"characteristics-{self.p_min:g}-{self.p_max:g}-{n}-{k}.json"
+        )
+        if self.layout_cache and os.path.isfile(table_file):
+            with open(table_file) as f:
+                model.characteristics = json.load(f)
+            return
+
+        table = {"pressure": pressures, "mass_flow": mass_flows, "power": [], "heat": []}
+        for i, mass_flow in enumerate(mass_flows):
+            # sweep the pressures up and down in turns, so the stepped solves
+            # only take small steps
+            sweep = pressures if i % 2 == 0 else pressures[::-1]
+            results = {p: self.get_power(mass_flow, p, mode) for p in sweep}
+            # None marks pressures without solution, their intervals are solved as usual
+            table["power"].append([abs(results[p][1]) if results[p][0] != 0 else None for p in pressures])
+            table["heat"].append([results[p][2] if results[p][0] != 0 else None for p in pressures])
+        model.characteristics = table
+
+        if self.layout_cache and os.path.isdir(os.path.dirname(table_file)):
+            tmp = table_file + f".{os.getpid()}"
+            with open(tmp, "w") as f:
+                json.dump(table, f, indent=1)
+            os.replace(tmp, table_file)
+
+    def _characteristics_at(self, model, pressure):
+        """
+        Power and heat of all mass flows of the characteristic table,
+        interpolated linearly at the given pressure. Returns None if the table
+        is not available at this pressure, also outside of its pressure range.
+        """
+        table = getattr(model, "characteristics", None)
+        if table is None:
+            return None
+
+        pressures = table["pressure"]
+        if not pressures[0] <= pressure <= pressures[-1]:
+            return None
+        i = min(max(bisect.bisect_right(pressures, pressure), 1), len(pressures) - 1)
+        share = (pressure - pressures[i - 1]) / (pressures[i] - pressures[i - 1])
+        values = {}
+        for name in ("power", "heat"):
+            values[name] = []
+            for row in table[name]:
+                low, high = row[i - 1], row[i]
+                if low is None or high is None:
+                    return None
+                values[name].append(low + share * (high - low))
+        return values["power"], values["heat"]
+
+    def _table_point(self, model, method, target, pressure):
+        """
+        Mass flow, power and heat (unsigned) interpolated from the
+        characteristic table, for a power target (get_mass_flow) or a mass
+        flow target (get_power). Returns None for targets outside of the
+        table.
+        """
+        characteristics = self._characteristics_at(model, pressure)
+        if characteristics is None:
+            return None
+        powers, heats = characteristics
+        mass_flows = model.characteristics["mass_flow"]
+        values = powers if method == "get_mass_flow" else mass_flows
+        if not min(values) <= target <= max(values):
+            return None
+        if method == "get_mass_flow":
+            return np.array([np.interp(target, powers, mass_flows), target, np.interp(target, powers, heats)])
+        return np.array([target, np.interp(target, mass_flows, powers), np.interp(target, mass_flows, heats)])
+
+    def _set_anchor(self, method, mode, model, target, pressure, result):
+        """
+        Store a solved point with its local sensitivities to the target and
+        to the pressure, taken from the slopes of the characteristic table.
+        The slopes are central differences, one-sided at the edges of the
+        table.
+        """
+        if not self.linearization:
+            return
+        h_p = 0.1
+        h_t = 1e-3 * abs(target)
+        center = self._table_point(model, method, target, pressure)
+        d_target = self._table_slope(model, method, center, (target + h_t, pressure), (target - h_t, pressure), h_t)
+        d_pressure = self._table_slope(model, method, center, (target, pressure + h_p), (target, pressure - h_p), h_p)
+        if d_target is None or d_pressure is None or h_t == 0:
+            self._anchors.pop((method, mode), None)
+            return
+
+        self._anchors[(method, mode)] = {
+            "target": target,
+            "pressure": pressure,
+            "result": np.array([result[0], abs(result[1]), result[2]]),
+            "d_target": d_target,
+            "d_pressure": d_pressure,
+        }
+
+    def _table_slope(self, model, method, center, forward, backward, step):
+        """
+        Difference quotient of the characteristic table between the points
+        (target, pressure) forward and backward of the center point, one-sided
+        if one of them is outside of the table. None if neither side is
+        available.
+        """
+        if center is None:
+            return None
+        upper = self._table_point(model, method, *forward)
+        lower = self._table_point(model, method, *backward)
+        if upper is not None and lower is not None:
+            return (upper - lower) / (2 * step)
+        if upper is not None:
+            return (upper - center) / step
+        if lower is not None:
+            return (center - lower) / step
+        return None
+
+    def _linearized(self, method, mode, model, target, pressure):
+        """
+        Result from the linearization around the last solved point, None if
+        the request is outside of its trust region.
+        """
+        anchor = self._anchors.get((method, mode))
+        if anchor is None:
+            return None
+
+        d_target = target - anchor["target"]
+        d_pressure = pressure - anchor["pressure"]
+        if (abs(d_pressure) > self.linearization_pressure
+                or abs(d_target) > self.linearization_target * abs(anchor["target"])):
+            return None
+
+        mass_flow, power, heat = anchor["result"] + anchor["d_target"] * d_target + anchor["d_pressure"] * d_pressure
+        if method == "get_mass_flow":
+            power = target
+        else:
+            mass_flow = target
+        if not model.dot_m_min <= mass_flow <= model.dot_m_max:
+            return None
+
+        self.linearized_calls += 1
+        power = -abs(power) if mode == "discharge" else abs(power)
+        self.trace.record("powerplant", "linearized", mass_flow, power, pressure, heat)
+        if self.log_iterations:
+            print(f"Linearized result for target = {target}, {pressure = }: {mass_flow = }, {power = }.")
+        return mass_flow, power, heat
+
     def _check_pressure_limits(self, pressure, mode):
         if pressure + 1e-4 < self.p_min and mode == 'discharge':
             msg = (
@@ -257,38 +829,74 @@ class PowerPlantCoupling:
             model = self.discharge_model
 
         power = abs(power)#/1e6
-        specification = {
-            "power": power,
-            "well_pressure": pressure,
-            "powerplant_mass_flow": None  # unset the mass flow specification
-        }
-        result = model.solve_model_offdesign_with_stepping(**specification)
-        if result:
-            if abs(power) < abs(model.power_nominal / 100):
+        # the part-load limit does not depend on the solution
+        if abs(power) < abs(model.power_nominal / 100):
+            msg = (
+                f"Target power ({power:.2f} MW) is below minimum stable "
+                "part-load limit"
+            )
+            print(msg)
+            logging.warning(msg)
+            return 0, 0, 0
+
+        # requests clearly outside of the operating envelope need no solve
+        characteristics = self._characteristics_at(model, pressure)
+        if characteristics is not None:
+            power_min, power_max = characteristics[0][0], characteristics[0][-1]
+            heat_max = characteristics[1][-1]
+            if power < power_min * (1 - self.envelope_margin):
                 msg = (
-                    f"Target power ({power:.2f} MW) is below minimum stable "
-                    "part-load limit"
+                    f"Power {power} at pressure={pressure} below operating "
+                    f"envelope ({power_min:.3f} at minimum mass flow "
+                    f"{model.dot_m_min}), shutting down."
                 )
                 print(msg)
-                logging.warning(msg)
+                logging.error(msg)
+                self.trace.record("powerplant", "below_envelope", 0, power, pressure, 0)
                 return 0, 0, 0
+            elif power > power_max * (1 + self.envelope_margin):
+                msg = (
+                    f"Power {power} at pressure={pressure} above operating "
+                    f"envelope. Adjusting power to {power_max:.3f} at maximum "
+                    f"mass flow {model.dot_m_max}."
+                )
+                print(msg)
+                logging.warning(msg)
+                output_power = -power_max if mode == "discharge" else power_max
+                self.trace.record("powerplant", "above_envelope", model.dot_m_max, output_power, pressure, heat_max)
+                return model.dot_m_max, output_power, heat_max
 
-            else:
+        # small corrections around the last solved point
+        linearized = self._linearized("get_mass_flow", mode, model, power, pressure)
+        if linearized is not None:
+            return linearized
 
-                mass_flow = model.get_parameter("powerplant_mass_flow")
-                heat = model.get_parameter("heat")
-                # negative sign for discharging output
-                output_power = -abs(power) if mode == "discharge" else abs(power)
-                return self._check_results(
-                    mass_flow,
-                    model.dot_m_min, model.dot_m_max,
-                    output_power, pressure, heat, mode
-                )
+        specification = {
+            "power": power,
+            "well_pressure": pressure,
+            "powerplant_mass_flow": None  # unset the mass flow specification
+        }
+        with self.profiler.phase('powerplant'):
+            result = model.solve_model_offdesign_with_stepping(**specification)
+        if result:
+            mass_flow = model.get_parameter("powerplant_mass_flow")
+            heat = model.get_parameter("heat")
+            # negative sign for discharging output
+            output_power = -abs(power) if mode == "discharge" else abs(power)
+            result = self._check_results(
+                mass_flow,
+                model.dot_m_min, model.dot_m_max,
+                output_power, pressure, heat, mode
+            )
+            if result[0] == mass_flow:
+                self._set_anchor("get_mass_flow", mode, model, power, pressure, result)
+            return result
 
         else:
             msg = (f"{'No solution found for Power / Pressure:':45s} {'%.3f' % power} / {'%.3f' % pressure}")
             print(msg)
             logging.warning(msg)
+            self.trace.record("powerplant", "no_solution", 0, power, pressure, 0)
             return 0, 0, 0
 
     def _check_results(self, massflow, massflow_min, massflow_max, power, pressure, heat, mode):
@@ -300,6 +908,7 @@ class PowerPlantCoupling:
             )
             print(msg)
             logging.error(msg)
+            self.trace.record("powerplant", "below_min_flow", massflow, power, pressure, heat)
             return 0, 0, 0
         elif massflow > massflow_max:
             msg = (
@@ -309,14 +918,17 @@ class PowerPlantCoupling:
             )
             print(msg)
             logging.warning(msg)
+            self.trace.record("powerplant", "above_max_flow", massflow, power, pressure, heat)
             return self.get_power(massflow_max, pressure, mode)
         else:
-            msg = (
-                f"Calculation successful for {power = }, {pressure = }: "
-                f"{massflow = }."
-            )
-            print(msg)
-            # logging.debug(msg)
+            self.trace.record("powerplant", "solved", massflow, power, pressure, heat)
+            if self.log_iterations:
+                msg = (
+                    f"Calculation successful for {power = }, {pressure = }: "
+                    f"{massflow = }."
+                )
+                print(msg)
+                # logging.debug(msg)
             return massflow, power, heat
 
     def get_power(self, mass_flow, pressure, mode):
@@ -374,14 +986,21 @@ class PowerPlantCoupling:
             logging.warning(msg)
             return self.get_power(mass_flow_max, pressure, mode)
 
+        # small corrections around the last solved point
+        linearized = self._linearized("get_power", mode, model, mass_flow, pressure)
+        if linearized is not None:
+            return linearized
+
         specification = {
             "power": None,
             "well_pressure": pressure,
             "powerplant_mass_flow": mass_flow
         }
-        result = model.solve_model_offdesign_with_stepping(**specification)
+        with self.profiler.phase('powerplant'):
+            result = model.solve_model_offdesign_with_stepping(**specification)
 
         if not result:
+            self.trace.record("powerplant", "no_solution", mass_flow, 0, pressure, 0)
             return 0, 0, 0
 
         else:
@@ -390,4 +1009,173 @@ class PowerPlantCoupling:
             # negative sign for discharging output
             if mode == "discharge":
                 power = -abs(power)
+            self.trace.record("powerplant", "solved", mass_flow, power, pressure, heat)
+            self._set_anchor("get_power", mode, model, mass_flow, pressure, (mass_flow, power, heat))
             return mass_flow, power, heat
+
+    def get_mass_flow_batch(self, powers, pressures, mode):
+        """
+        Calculate the mass flows for arrays of power targets and pressures,
+        see :code:`get_mass_flow`.
+
+        Parameters
+        ----------
+        powers : array_like
+            Scheduled electrical power input/output of the power plant.
+
+        pressures : array_like
+            Bottom borehole pressures, broadcast against :code:`powers`.
+
+        mode : str
+            Calculation mode: :code:`mode in ['charging', 'discharging']`.
+
+        Returns
+        -------
+        mass_flow, power, heat : numpy.ndarray
+            Results as returned by :code:`get_mass_flow` for every point.
+
+        feasible : numpy.ndarray
+            True where the scheduled power is met.
+
+        Note
+        ----
+        With the operating envelope, points outside of it are decided from
+        the envelope. Points inside are interpolated from the characteristic
+        table if it has more than the two envelope mass flows, all other
+        points are solved in a pool of :code:`batch_workers` processes.
+        """
+        return self._batch("get_mass_flow", powers, pressures, mode)
+
+    def get_power_batch(self, mass_flows, pressures, mode):
+        """
+        Calculate the power for arrays of mass flows and pressures, see
+        :code:`get_power`.
+
+        Parameters
+        ----------
+        mass_flows : array_like
+            Mass flows.
+
+        pressures : array_like
+            Bottom borehole pressures, broadcast against :code:`mass_flows`.
+
+        mode : str
+            Calculation mode: :code:`mode in ['charging', 'discharging']`.
+
+        Returns
+        -------
+        mass_flow, power, heat : numpy.ndarray
+            Results as returned by :code:`get_power` for every point.
+
+        feasible : numpy.ndarray
+            True where the mass flow is met.
+        """
+        return self._batch("get_power", mass_flows, pressures, mode)
+
+    def _batch(self, method, targets, pressures, mode):
+        targets, pressures = np.broadcast_arrays(
+            np.asarray(targets, dtype=float), np.asarray(pressures, dtype=float)
+        )
+        shape = targets.shape
+        targets, pressures = targets.ravel(), pressures.ravel()
+
+        results = np.zeros((len(targets), 3))
+        pending = []
+        for i, (target, pressure) in enumerate(zip(targets, pressures)):
+            result = self._lookup(method, target, pressure, mode)
+            if result is None:
+                pending.append(i)
+            else:
+                results[i] = result
+        if pending:
+            results[pending] = self._solve_batch(method, targets[pending], pressures[pending], mode)
+
+        mass_flow, power, heat = results.T
+        if method == "get_mass_flow":
+            achieved = np.abs(power)
+        else:
+            achieved = mass_flow
+        feasible = (mass_flow != 0) & np.isclose(achieved, np.abs(targets), rtol=1e-6, atol=1e-9)
+        return (mass_flow.reshape(shape), power.reshape(shape),
+                heat.reshape(shape), feasible.reshape(shape))
+
+    def _lookup(self, method, target, pressure, mode):
+        """
+        Result of a batch point without solving the power plant, None if the
+        point needs a solve.
+        """
+        mode = self._MODE_MAP.get(mode, mode)
+        if mode == "shut-in" or not hasattr(self, f"{mode}_model"):
+            return 0, 0, 0
+        if not self._check_pressure_limits(pressure, mode):
+            return 0, 0, 0
+
+        model = getattr(self, f"{mode}_model")
+        characteristics = self._characteristics_at(model, pressure)
+        if characteristics is None:
+            return None
+        powers, heats = characteristics
+        mass_flows = model.characteristics["mass_flow"]
+        sign = -1 if mode == "discharge" else 1
+        # interior points are only interpolated between intermediate mass flows
+        interpolate = len(mass_flows) > 2
+
+        if method == "get_mass_flow":
+            power = abs(target)
+            if power < abs(model.power_nominal / 100) or power < powers[0] * (1 - self.envelope_margin):
+                return 0, 0, 0
+            elif power > powers[-1] * (1 + self.envelope_margin):
+                return model.dot_m_max, sign * powers[-1], heats[-1]
+            elif interpolate and powers[0] <= power <= powers[-1]:
+                return (np.interp(power, powers, mass_flows), sign * power,
+                        np.interp(power, powers, heats))
+        else:
+            if target < model.dot_m_min - 1e-4:
+                return 0, 0, 0
+            elif target > model.dot_m_max + 1e-3:
+                return model.dot_m_max, sign * powers[-1], heats[-1]
+            elif interpolate:
+                return (target, sign * np.interp(target, mass_flows, powers),
+                        np.interp(target, mass_flows, heats))
+        return None
+
+    def _solve_batch(self, method, targets, pressures, mode):
+        """
+        Solves batch points in the worker pool, or in this process if the
+        pool would have fewer than two workers.
+
+        Note
+        ----
+        The workers are spawned and import the calling script, scripts using
+        the batch queries need an :code:`if __name__ == '__main__':` guard.
+        """
+        workers = min(self.batch_workers, len(targets))
+        if workers < 2:
+            return [getattr(self, method)(target, pressure, mode)
+                    for target, pressure in zip(targets, pressures)]
+
+        if self._batch_pool is None:
+            # every worker restores the layouts from the layout cache
+            self._batch_design_dir = tempfile.mkdtemp(prefix='if_pplant_batch_')
+            self._batch_pool = ProcessPoolExecutor(
+                max_workers=self.batch_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_batch_worker,
+                initargs=(self._batch_settings, self._batch_design_dir,
+                          self.min_well_depth, self.num_wells, self.p_max, self.p_min)
+            )
+        futures = [
+            self._batch_pool.submit(_batch_worker, method, targets[chunk].tolist(), pressures[chunk].tolist(), mode)
+            for chunk in np.array_split(np.arange(len(targets)), workers)
+        ]
+        return [result for future in futures for result in future.result()]
+
+    def close(self):
+        """
+        Shut down the worker pool of the batch queries.
+        """
+        if self._batch_pool is not None:
+            self._batch_pool.shutdown()
+            self._batch_pool = None
+            shutil.rmtree(self._batch_design_dir, ignore_errors=True)
+            self._batch_design_dir = None
@@ -1,9 +1,67 @@
 from tespy.tools.helpers import merge_dicts
+from tespy.tools.units import Units
 from tespy.connections import Ref
 from tespy.networks import Network
+from tespy import __version__ as tespy_version
 import os
+import pickle
+import sys
+import pint
 import numpy as np
 
+SNAPSHOT_FORMAT = 1
+
+
+class _SnapshotPickler(pickle.Pickler):
+    # the pint unit registries of the networks hold lambdas, registries,
+    # quantities and units are stored by reference and rebuilt on load
+
+    def __init__(self, f):
+        super().__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.registries = {}
+
+    def _registry(self, registry):
+        return self.registries.setdefault(id(registry), len(self.registries))
+
+    def persistent_id(self, obj):
+        if isinstance(obj, pint.UnitRegistry):
+            return ("registry", self._registry(obj))
+        if isinstance(obj, pint.Quantity):
+            return ("quantity", self._registry(obj._REGISTRY), obj.magnitude, obj._units)
+        if isinstance(obj, pint.Unit):
+            return ("unit", self._registry(obj._REGISTRY), obj._units)
+        return None
+
+
+class _SnapshotUnpickler(pickle.Unpickler):
+
+    def __init__(self, f):
+        super().__init__(f)
+        self.registries = {}
+
+    def _registry(self, number):
+        if number not in self.registries:
+            self.registries[number] = Units().ureg
+        return self.registries[number]
+
+    def persistent_load(self, pid):
+        if pid[0] == "registry":
+            return self._registry(pid[1])
+        if pid[0] == "quantity":
+            return self._registry(pid[1]).Quantity(pid[2], pid[3])
+        if pid[0] == "unit":
+            return self._registry(pid[1]).Unit(pid[2])
+        raise pickle.UnpicklingError(f"Unknown reference {pid[0]} in power plant snapshot.")
+
+
+def _snapshot_versions():
+    return {
+        "format": SNAPSHOT_FORMAT,
+        "python": list(sys.version_info[:2]),
+        "tespy": tespy_version,
+        "pint": pint.__version__,
+    }
+
 
 class ModelTemplate():
 
@@ -83,6 +141,38 @@ class ModelTemplate():
     def export(self):
         self.nw.export(os.path.join(self.config["path"], "export.json"))
 
+    def save_snapshot(self, path):
+        """
+        Write the model with its network, design state and nominal values
+        as a pickled snapshot, see :code:`from_snapshot`.
+        """
+        with open(path, "wb") as f:
+            pickle.dump(_snapshot_versions(), f)
+            _SnapshotPickler(f).dump(self)
+
+    @classmethod
+    def from_snapshot(cls, path, config, design_path=None):
+        """
+        Restore a model from a snapshot written by :code:`save_snapshot`.
+
+        The snapshot must stem from the same Python, TESPy and pint versions.
+        Paths are taken from :code:`config`, the design state from
+        :code:`design_path` if given. Snapshots are pickles, only load files
+        written by yourself.
+        """
+        with open(path, "rb") as f:
+            versions = pickle.load(f)
+            if versions != _snapshot_versions():
+                raise ValueError(f"Snapshot {path} was written with {versions}.")
+            instance = _SnapshotUnpickler(f).load()
+
+        if not isinstance(instance, cls):
+            raise TypeError(f"Snapshot {path} holds a {type(instance).__name__}.")
+        instance.config = config
+        instance._design_path = design_path or os.path.join(config["path"], "design.json")
+        instance._stable_solution = os.path.join(config["path"], "_stable_solution.json")
+        return instance
+
     def solve_model_design(self, **kwargs) -> None:
         self.set_parameters(**kwargs)
 
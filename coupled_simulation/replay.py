@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Recording of the storage simulations (and power plant solves) of a coupled
+run and replay of the recorded responses.
+
+usage: python -m coupled_simulation.replay [-k kind] [-t tstep] [-n last] <output>.replay.bin
+
+__author__ = "fgasa"
+
+"""
+
+import getopt
+import json
+import math
+import struct
+import sys
+import threading
+
+from coupled_simulation.trace import MODES
+
+MAGIC = b'IFREPLAY'
+# kind, mode, timestep, iteration, two request values, three response values
+RECORD = struct.Struct('<BBih5d')
+
+# kind, labels of the request and the response values
+KINDS = (
+    ('storage', ('target_flow', 'step_length'), ('pressure', 'flowrate', '')),
+    ('get_mass_flow', ('power', 'pressure'), ('mass_flow', 'power', 'heat')),
+    ('get_power', ('mass_flow', 'pressure'), ('mass_flow', 'power', 'heat')),
+)
+KIND_CODES = {name: code for code, (name, _, _) in enumerate(KINDS)}
+MODE_CODES = {mode: code for code, mode in enumerate(MODES)}
+
+
+class Recording:
+    '''
+    Record-and-replay of the storage simulator and the power plant model.
+
+    In record mode every storage simulation request (timestep, iteration,
+    mode, target flow and step length) is stored with its response
+    (pressure and flow rate), optionally also every power plant solve
+    requested by the coupling loop. The records are written as a binary file
+    next to the output file.
+
+    In replay mode the storage simulator is not started, the responses are
+    served from a recording in the order they were recorded. If the coupling
+    logic asks for something else than the next recorded request, the
+    response is taken from the recorded simulation of the same timestep and
+    mode with the closest target flow (power plant solves: the closest
+    request of the same timestep and mode) and the request is counted as
+    diverged. Only the solves requested from outside of the power plant are
+    recorded and replayed, not the ones it makes internally. Power
+    plant solves are replayed only if requested, the power plant model is
+    built in any case.
+    '''
+
+    def __init__(self, record=False, powerplant=False, replay=None, replay_powerplant=False, enabled=True):
+        self.enabled = enabled
+        self.recording = enabled and record
+        self.record_powerplant = self.recording and powerplant
+        self.replaying = enabled and replay is not None
+        self.replay_powerplant = self.replaying and replay_powerplant
+        self.records = bytearray()
+        self.count = 0
+        self.tstep = -1
+        self.iteration = 0
+        self.served = 0
+        self.diverged = 0
+        # the storage initialisation may run in a thread during startup
+        self.lock = threading.Lock()
+        # depth of the power plant solves per thread, nested solves are not recorded
+        self.local = threading.local()
+
+        if self.replaying:
+            self.path = replay
+            _, records = read_recording(replay)
+            self.queues = {code: [] for code in range(len(KINDS))}
+            for record in records:
+                self.queues[record[0]].append(record)
+            self.positions = {code: 0 for code in self.queues}
+
+    def _add(self, kind, mode, request, response):
+        with self.lock:
+            self.records += RECORD.pack(KIND_CODES[kind], MODE_CODES.get(mode, 0), self.tstep, self.iteration,
+                                        *request, *response, *(0.0,) * (3 - len(response)))
+            self.count += 1
+
+    def _serve(self, kind, mode, request):
+        code = KIND_CODES[kind]
+        queue = self.queues[code]
+        with self.lock:
+            position = self.positions[code]
+            if position < len(queue):
+                record = queue[position]
+                # the power plant solver is reproducible up to round-off only
+                if (record[1] == MODE_CODES.get(mode, 0)
+                        and all(math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-12) for a, b in zip(record[4:6], request))
+                        and (kind != 'storage' or record[2:4] == (self.tstep, self.iteration))):
+                    self.positions[code] += 1
+                    self.served += 1
+                    return record[6:]
+
+            candidates = [r for r in queue if r[1] == MODE_CODES.get(mode, 0) and r[2] == self.tstep]
+            candidates.sort(key=lambda r: sum(abs(a - b) / max(abs(b), 1.0) for a, b in zip(r[4:6], request)))
+            if not candidates:
+                raise ValueError(f"No recorded {kind} response for timestep {self.tstep}, mode {mode} "
+                                 f"and request {request} in {self.path}.")
+            self.served += 1
+            self.diverged += 1
+            return candidates[0][6:]
+
+    def storage(self, target_flow, tstep, iter_step, step_length, op_mode):
+        '''
+        Serves a recorded storage simulation
+
+        :param target_flow: target storage flow rate
+        :param type: float
+        :param tstep: current timestep
+        :param type: int
+        :param iter_step: coupling iteration
+        :param type: int
+        :param step_length: length of the timestep in s
+        :param type: float
+        :param op_mode: operational mode
+        :param type: str
+        :returns: tuple of pressure and flow rate
+        '''
+        self.tstep, self.iteration = tstep, iter_step
+        pressure, flowrate, _ = self._serve('storage', op_mode, (float(target_flow), float(step_length)))
+        return pressure, flowrate
+
+    def record_storage(self, target_flow, tstep, iter_step, step_length, op_mode, pressure, flowrate):
+        '''
+        Adds a storage simulation to the recording
+
+        :param pressure: resulting pressure
+        :param type: float
+        :param flowrate: resulting flow rate
+        :param type: float
+        :returns: no return value
+        '''
+        self.tstep, self.iteration = tstep, iter_step
+        if self.recording:
+            self._add('storage', op_mode, (float(target_flow), float(step_length)), (pressure, flowrate))
+
+    def attach(self, powerplant):
+        '''
+        Records or replays the solves of a power plant model
+
+        Replaces get_mass_flow and get_power of the instance. Calls the
+        power plant makes to these methods while solving (result checks,
+        retries) go to the original methods and are not recorded.
+
+        :param powerplant: power plant model
+        :param type: PowerPlantCoupling or PowerPlantPipeline
+        :returns: the power plant model
+        '''
+        if not (self.record_powerplant or self.replay_powerplant):
+            return powerplant
+
+        def wrap(kind, method):
+            def solve(target, pressure, mode):
+                depth = getattr(self.local, 'depth', 0)
+                if depth:
+                    return method(target, pressure, mode)
+                request = (float(target), float(pressure))
+                if self.replay_powerplant:
+                    return tuple(self._serve(kind, mode, request))
+                self.local.depth = depth + 1
+                try:
+                    result = method(target, pressure, mode)
+                finally:
+                    self.local.depth = depth
+                self._add(kind, mode, request, result)
+                return result
+            return solve
+
+        powerplant.get_mass_flow = wrap('get_mass_flow', powerplant.get_mass_flow)
+        powerplant.get_power = wrap('get_power', powerplant.get_power)
+        return powerplant
+
+    def save(self, path_base):
+        '''
+        Writes the recording to path_base + '.replay.bin'
+
+        :param path_base: path of the output file without extension
+        :param type: str
+        :returns: no return value
+        '''
+        if not self.recording:
+            return
+        header = json.dumps({
+            'record': RECORD.format,
+            'kinds': KINDS,
+            'modes': MODES,
+            'recorded': self.count,
+        }).encode()
+        with open(path_base + '.replay.bin', 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            f.write(self.records)
+
+    def print_summary(self):
+        '''
+        Prints the number of recorded and replayed responses
+
+        :returns: no return value
+        '''
+        if self.recording:
+            print(f"{'Recorded responses:':30s} {self.count}")
+        if self.replaying:
+            print(f"{'Replayed from:':30s} {self.path}")
+            print(f"{'Replayed responses:':30s} {self.served} ({self.diverged} diverged from the recording)")
+
+
+def read_recording(path):
+    '''
+    Reads a recording
+
+    :param path: path of the .replay.bin file
+    :param type: str
+    :returns: tuple of the header (dict) and a list of records (tuples)
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a recording.")
+    offset = len(MAGIC) + 4
+    size, = struct.unpack_from('<I', data, len(MAGIC))
+    header = json.loads(data[offset:offset + size])
+    record = struct.Struct(header['record'])
+    return header, list(record.iter_unpack(data[offset + size:]))
+
+
+def format_recording(path, kind=None, tstep=None, last=None):
+    '''
+    Decodes a recording into text lines
+
+    :param path: path of the .replay.bin file
+    :param type: str
+    :param kind: only records of this kind
+    :param type: str
+    :param tstep: only records of this timestep
+    :param type: int
+    :param last: only the last records
+    :param type: int
+    :returns: list of str
+    '''
+    header, records = read_recording(path)
+    kinds, modes = header['kinds'], header['modes']
+
+    lines = [f"{'tstep':>6s} {'iter':>4s} {'kind':14s} {'mode':12s} request -> response"]
+    selected = [r for r in records
+                if (kind is None or kinds[r[0]][0] == kind) and (tstep is None or r[2] == tstep)]
+    if last is not None:
+        selected = selected[-last:]
+    for code, mode, step, iteration, *values in selected:
+        name, request_labels, response_labels = kinds[code]
+        request = ' '.join(f"{label}={value:.6f}" for label, value in zip(request_labels, values[:2]))
+        response = ' '.join(f"{label}={value:.6f}" for label, value in zip(response_labels, values[2:]) if label)
+        lines.append(f"{step:6d} {iteration:4d} {name:14s} {modes[mode]:12s} {request} -> {response}")
+    return lines
+
+
+def main(argv):
+    usage = 'replay.py [-k kind] [-t tstep] [-n last] <output>.replay.bin'
+    kind = tstep = last = None
+
+    try:
+        opts, args = getopt.getopt(argv, 'hk:t:n:', ['kind=', 'tstep=', 'last='])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            sys.exit()
+        elif opt in ('-k', '--kind'):
+            kind = arg
+        elif opt in ('-t', '--tstep'):
+            tstep = int(arg)
+        elif opt in ('-n', '--last'):
+            last = int(arg)
+    if len(args) != 1:
+        print(usage)
+        sys.exit(2)
+
+    for line in format_recording(args[0], kind, tstep, last):
+        print(line)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
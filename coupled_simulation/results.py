@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+__author__ = "fgasa"
+
+"""
+
+import csv
+import numpy as np
+
+
+class ResultStore:
+    '''
+    In-memory store of the coupled simulation results, one row per timestep.
+
+    The rows are kept in a preallocated NumPy structured array with a
+    datetime64 time column and float64 and bool columns. The array is sized
+    for the scheduled timesteps and grows if more rows are added, e.g. by the
+    storage balancing at the end of a run. The CSV writer appends the rows
+    that were not written yet, the binary writer saves the array as .npy.
+    '''
+
+    columns = ('time', 'power_target', 'massflow_target', 'power_actual', 'heat',
+               'massflow_actual', 'storage_pressure')
+    eval_columns = ('Tstep_accepted', 'delta_power', 'delta_massflow')
+
+    def __init__(self, n_rows, auto_eval=False):
+        self.auto_eval = auto_eval
+        self.variable_list = list(self.columns)
+        if auto_eval:
+            self.variable_list += list(self.eval_columns)
+        self.dtype = np.dtype([
+            (name, 'datetime64[s]' if name == 'time' else bool if name == 'Tstep_accepted' else 'f8')
+            for name in self.variable_list
+        ])
+        self.data = np.zeros(max(int(n_rows), 1), dtype=self.dtype)
+        self.size = 0
+        # rows already written to the CSV file
+        self.written = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def rows(self):
+        '''
+        View of the filled rows
+
+        :returns: numpy.ndarray
+        '''
+        return self.data[:self.size]
+
+    def append(self, time, power_target, massflow_target, power_actual, heat, massflow_actual,
+               storage_pressure, accepted=True, delta_power=0.0, delta_massflow=0.0):
+        '''
+        Adds the results of a timestep
+
+        :param time: time of the timestep
+        :param type: datetime.datetime
+        :param accepted: True if the timestep converged, stored with auto_eval only
+        :param type: bool
+        :param delta_power: difference of actual and target power, stored with auto_eval only
+        :param type: float
+        :param delta_massflow: difference of actual and target mass flow, stored with auto_eval only
+        :param type: float
+        :returns: no return value
+        '''
+        if self.size == len(self.data):
+            self.data = np.concatenate([self.data, np.zeros(len(self.data), dtype=self.dtype)])
+        row = (np.datetime64(time, 's'), power_target, massflow_target, power_actual, heat,
+               massflow_actual, storage_pressure)
+        if self.auto_eval:
+            row += (accepted, delta_power, delta_massflow)
+        self.data[self.size] = row
+        self.size += 1
+
+    def accumulated_mass(self, t_step_length, signed=False):
+        '''
+        Net mass put into the storage over the filled rows
+
+        :param t_step_length: timestep length in s
+        :param type: float
+        :param signed: True if the mass flows are signed (storage-only runs),
+                       otherwise the direction follows the sign of the actual power
+        :param type: bool
+        :returns: float, mass in kg, positive if the storage gained mass
+        '''
+        rows = self.rows
+        massflow = rows['massflow_actual']
+        if not signed:
+            massflow = np.sign(rows['power_actual']) * massflow
+        return float(massflow.sum() * t_step_length)
+
+    def write_csv(self, path):
+        '''
+        Writes the rows added since the last call to a semicolon separated file,
+        the file is created with a header on the first call
+
+        :param path: path of the output file
+        :param type: str
+        :returns: no return value
+        '''
+        mode = 'a' if self.written else 'w'
+        with open(path, mode=mode, newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, delimiter=';')
+            if not self.written:
+                writer.writerow(self.variable_list)
+            # datetime64[s] converts to datetime.datetime, floats and bools to Python objects
+            writer.writerows(self.data[self.written:self.size].tolist())
+        self.written = self.size
+
+    def save(self, path):
+        '''
+        Writes the filled rows as a NumPy .npy file
+
+        :param path: path of the output file
+        :param type: str
+        :returns: no return value
+        '''
+        np.save(path, self.rows)
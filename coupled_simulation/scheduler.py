@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Machine-wide core budget for the storage simulator runs.
+
+usage: python -m coupled_simulation.scheduler [-d directory] [-b budget]
+
+Prints the cores of the budget that are currently held and by which process.
+
+__author__ = "fgasa"
+
+"""
+
+from contextlib import contextmanager
+import getopt
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows, the scheduler is disabled
+    fcntl = None
+
+DEFAULT_DIR = os.path.join(tempfile.gettempdir(), 'if_pplant_cores')
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class CoreScheduler:
+    '''
+    Hands out cores of a machine-wide budget to storage simulator runs.
+
+    Every core of the budget is a lock file in a directory shared by all
+    coupled runs on the machine. A simulator run holds one lock per core it
+    uses (MPI ranks times threads per rank) until it finishes, locks of
+    crashed processes are released by the operating system. The number of
+    ranks follows from the number of grid cells of the deck and is reduced
+    to the free cores; if not even one rank is free, the run waits.
+
+    Waiting times, granted ranks and core-seconds are recorded for the
+    utilization report.
+    '''
+
+    def __init__(self, budget=None, directory=DEFAULT_DIR, cells_per_rank=50000, threads_per_rank=1,
+                 poll=0.2, enabled=True):
+        self.enabled = enabled and fcntl is not None
+        self.budget = int(budget or available_cores())
+        self.directory = directory
+        self.cells_per_rank = int(cells_per_rank)
+        self.threads_per_rank = max(1, int(threads_per_rank))
+        self.poll = poll
+        self.run_start = time.perf_counter()
+        # granted ranks, waiting time and run time of every launch
+        self.launches = []
+        self.lock = threading.Lock()
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def ranks_for(self, cells, max_ranks=None):
+        '''
+        Number of MPI ranks a deck would get on an idle machine
+
+        :param cells: number of grid cells of the deck
+        :param type: int
+        :param max_ranks: upper limit, e.g. 'mpi_cores' of the geostorage control file
+        :param type: int
+        :returns: int
+        '''
+        ranks = max(1, math.ceil(cells / self.cells_per_rank))
+        ranks = min(ranks, max(1, self.budget // self.threads_per_rank))
+        if max_ranks:
+            ranks = min(ranks, int(max_ranks))
+        return ranks
+
+    def _try_acquire(self, ranks):
+        held = []
+        for i in range(self.budget):
+            f = open(os.path.join(self.directory, f"core_{i:03d}.lock"), 'a+')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            f.seek(0)
+            f.truncate()
+            f.write(f"{os.getpid()}\n")
+            f.flush()
+            held.append(f)
+            if len(held) == ranks * self.threads_per_rank:
+                break
+        # whole ranks only, surplus cores are released
+        granted = len(held) // self.threads_per_rank
+        for f in held[granted * self.threads_per_rank:]:
+            self._release_file(f)
+        return granted, held[:granted * self.threads_per_rank]
+
+    @staticmethod
+    def _release_file(f):
+        f.seek(0)
+        f.truncate()
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+    @contextmanager
+    def lease(self, cells, max_ranks=None):
+        '''
+        Holds cores for one simulator run
+
+        :param cells: number of grid cells of the deck
+        :param type: int
+        :param max_ranks: upper limit of MPI ranks
+        :param type: int
+        :returns: context yielding the tuple of ranks and threads per rank,
+                  (None, None) if the scheduler is disabled
+        '''
+        if not self.enabled:
+            yield None, None
+            return
+
+        wanted = self.ranks_for(cells, max_ranks)
+        t0 = time.perf_counter()
+        ranks, held = self._try_acquire(wanted)
+        while ranks == 0:
+            time.sleep(self.poll)
+            ranks, held = self._try_acquire(wanted)
+        t1 = time.perf_counter()
+        try:
+            yield ranks, self.threads_per_rank
+        finally:
+            for f in held:
+                self._release_file(f)
+            with self.lock:
+                self.launches.append((wanted, ranks, t1 - t0, time.perf_counter() - t1))
+
+    def summary(self):
+        '''
+        Aggregates the launches
+
+        :returns: dict with the number of launches, the queued and reduced
+                  launches, the waiting time and the share of the budget used
+        '''
+        wall = time.perf_counter() - self.run_start
+        core_seconds = sum(ranks * self.threads_per_rank * run for _, ranks, _, run in self.launches)
+        return {
+            'budget': self.budget,
+            'launches': len(self.launches),
+            'queued': sum(wait > self.poll / 2 for _, _, wait, _ in self.launches),
+            'reduced': sum(ranks < wanted for wanted, ranks, _, _ in self.launches),
+            'wait': sum(wait for _, _, wait, _ in self.launches),
+            'mean_ranks': (sum(ranks for _, ranks, _, _ in self.launches) / len(self.launches)
+                           if self.launches else 0.0),
+            'utilization': core_seconds / (self.budget * wall) if wall > 0.0 else 0.0,
+        }
+
+    def print_summary(self):
+        '''
+        Prints the utilization report
+
+        :returns: no return value
+        '''
+        if not self.enabled:
+            return
+        summary = self.summary()
+        print(f"{'Core budget:':30s} {summary['budget']}")
+        print(f"{'Simulator launches:':30s} {summary['launches']} "
+              f"({summary['queued']} queued, {summary['reduced']} with fewer ranks)")
+        print(f"{'Mean MPI ranks:':30s} {summary['mean_ranks']:.2f}")
+        print(f"{'Waiting time [s]:':30s} {summary['wait']:.3f}")
+        print(f"{'Budget utilization:':30s} {summary['utilization']:.1%}")
+
+
+def main(argv):
+    usage = 'scheduler.py [-d directory] [-b budget]'
+    directory = DEFAULT_DIR
+    budget = available_cores()
+
+    try:
+        opts, args = getopt.getopt(argv, 'hd:b:', ['directory=', 'budget='])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            sys.exit()
+        elif opt in ('-d', '--directory'):
+            directory = arg
+        elif opt in ('-b', '--budget'):
+            budget = int(arg)
+    if fcntl is None:
+        print('The core scheduler needs fcntl (POSIX).')
+        sys.exit(1)
+
+    busy = 0
+    for i in range(budget):
+        path = os.path.join(directory, f"core_{i:03d}.lock")
+        if not os.path.isfile(path):
+            continue
+        with open(path, 'a+') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.seek(0)
+                busy += 1
+                print(f"{'core ' + str(i) + ':':30s} held by process {f.read().strip()}")
+                continue
+            fcntl.flock(f, fcntl.LOCK_UN)
+    print(f"{'Cores held:':30s} {busy} of {budget}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Spool-directory job queue for coupled runs on hosts sharing a filesystem.
+
+usage: python -m coupled_simulation.spool submit -q <spool> <main_ctrl.json> [...]
+       python -m coupled_simulation.spool work -q <spool> [-r retries] [-s stale] [-b heartbeat] [-x]
+       python -m coupled_simulation.spool status -q <spool>
+
+Submitting calculates the power plant layouts of the scenarios into their
+layout caches and writes one job file per scenario to <spool>/pending. Workers,
+started on any host that sees the spool directory, claim jobs by renaming
+the job file to <spool>/running, which succeeds for exactly one of them.
+A job runs in its own directory <spool>/work/<job>.<attempt> (see
+ensemble.make_run), the worker touches the job file as heartbeat. Jobs whose
+heartbeat is older than 'stale' seconds are moved back to pending by any
+worker, failed jobs are repeated up to 'retries' times before they end in
+<spool>/failed. Finished jobs are moved to <spool>/done.
+
+__author__ = "fgasa"
+
+"""
+
+import getopt
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from coupled_simulation import ensemble
+
+STATES = ('pending', 'running', 'done', 'failed')
+
+
+def _dirs(spool):
+    for state in STATES + ('work',):
+        os.makedirs(os.path.join(spool, state), exist_ok=True)
+
+
+def _write_job(path, job):
+    # write and rename, the job file is read by other hosts at any time
+    tmp = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(job, f, indent=1)
+    os.replace(tmp, path)
+
+
+def _read_job(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _filesystem_time(spool):
+    # hosts' clocks may differ, heartbeats are compared in the time of the shared filesystem
+    path = os.path.join(spool, f".clock.{socket.gethostname()}.{os.getpid()}")
+    with open(path, 'w'):
+        pass
+    now = os.path.getmtime(path)
+    os.remove(path)
+    return now
+
+
+def submit(spool, paths):
+    '''
+    Adds scenarios to the queue
+
+    :param spool: spool directory
+    :param type: str
+    :param paths: main control files of the scenarios
+    :param type: list
+    :returns: list of job names
+    '''
+    _dirs(spool)
+    names = []
+    for path in paths:
+        # the jobs share the power plant of their scenario, its layouts are calculated
+        # into the layout cache here and not by concurrent workers, see ensemble.make_run
+        base = ensemble.load_scenario(path)
+        print(f"{'Preparing power plant of:':30s} {base.scenario}")
+        ensemble.prepare_powerplant(base, [base.geostorage_ctrl])
+        scenario = os.path.basename(path)[:-len('.main_ctrl.json')]
+        name = f"{time.strftime('%Y%m%d%H%M%S')}-{scenario}-{uuid.uuid4().hex[:8]}"
+        job = {'job': name, 'path': os.path.abspath(path), 'attempts': 0,
+               'submitted': time.strftime('%Y-%m-%d %H:%M:%S')}
+        _write_job(os.path.join(spool, 'pending', name + '.json'), job)
+        names.append(name)
+        print(f"{'Submitted:':30s} {name}")
+    return names
+
+
+def requeue_stale(spool, stale):
+    '''
+    Moves running jobs without heartbeat back to pending
+
+    :param spool: spool directory
+    :param type: str
+    :param stale: heartbeat age in s after which a job is considered lost
+    :param type: float
+    :returns: list of requeued job names
+    '''
+    now = _filesystem_time(spool)
+    requeued = []
+    running = os.path.join(spool, 'running')
+    for entry in sorted(os.listdir(running)):
+        if not entry.endswith('.json'):
+            continue
+        path = os.path.join(running, entry)
+        try:
+            if now - os.path.getmtime(path) < stale:
+                continue
+            # take the job out of running first, only one worker can do so
+            private = os.path.join(spool, f"{entry}.{socket.gethostname()}.{os.getpid()}.requeue")
+            os.rename(path, private)
+        except FileNotFoundError:
+            continue
+        job = _read_job(private)
+        job['requeued'] = job.get('requeued', 0) + 1
+        _write_job(private, job)
+        os.rename(private, os.path.join(spool, 'pending', entry))
+        requeued.append(job['job'])
+        print(f"{'Requeued stale job:':30s} {job['job']} (last host {job.get('host')})")
+    return requeued
+
+
+def claim(spool):
+    '''
+    Claims the oldest pending job
+
+    :param spool: spool directory
+    :param type: str
+    :returns: path of the claimed job file in running, None if no job is pending
+    '''
+    for entry in sorted(os.listdir(os.path.join(spool, 'pending'))):
+        if not entry.endswith('.json'):
+            continue
+        path = os.path.join(spool, 'running', entry)
+        pending = os.path.join(spool, 'pending', entry)
+        try:
+            # the rename keeps the modification time, a job that waited longer than 'stale'
+            # would be requeued right away without a fresh heartbeat
+            os.utime(pending)
+            os.rename(pending, path)
+        except FileNotFoundError:
+            # claimed by another worker
+            continue
+        return path
+    return None
+
+
+def run_job(spool, path, retries=1, heartbeat=30.0):
+    '''
+    Runs a claimed job and files it as done, failed or pending again
+
+    :param spool: spool directory
+    :param type: str
+    :param path: job file in running
+    :param type: str
+    :param retries: number of repetitions of a failed job
+    :param type: int
+    :param heartbeat: interval of the heartbeat in s
+    :param type: float
+    :returns: final state of the job
+    '''
+    try:
+        job = _read_job(path)
+    except FileNotFoundError:
+        print(f"Claimed job {os.path.basename(path)[:-len('.json')]} was requeued as stale meanwhile.")
+        return 'requeued'
+    job['attempts'] += 1
+    # the claim token tells this run's job file from the one of a later claim of the same job
+    job.update({'host': socket.gethostname(), 'pid': os.getpid(), 'claim': uuid.uuid4().hex,
+                'started': time.strftime('%Y-%m-%d %H:%M:%S')})
+    _write_job(path, job)
+
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(heartbeat):
+            try:
+                if _read_job(path).get('claim') == job['claim']:
+                    os.utime(path)
+            except FileNotFoundError:
+                # requeued, or taken out of running for a moment by a finishing worker
+                continue
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    print(f"{'Running job:':30s} {job['job']} (attempt {job['attempts']})")
+    t0 = time.perf_counter()
+    run_dir = os.path.join(spool, 'work', f"{job['job']}.{job['attempts']}")
+    try:
+        base = ensemble.load_scenario(job['path'])
+        ctrl_path = os.path.join(run_dir, f"{base.scenario}.main_ctrl.json")
+        result, _ = ensemble.run_coupled(ctrl_path, lambda: ensemble.make_run(base, run_dir), retries=0)
+        error = None if result is not None else f"see {os.path.join(run_dir, 'run.err')}"
+    except Exception as e:
+        error = str(e)
+    finally:
+        stop.set()
+        thread.join()
+
+    job.update({'run_dir': run_dir, 'elapsed': time.perf_counter() - t0, 'error': error})
+    if error is None:
+        state = 'done'
+    elif job['attempts'] <= retries:
+        state = 'pending'
+    else:
+        state = 'failed'
+    # take the job out of running first, then check the claim: the job may have been requeued
+    # as stale and claimed by another worker meanwhile, whose job file is given back
+    private = os.path.join(spool, f"{os.path.basename(path)}.{socket.gethostname()}.{os.getpid()}.finish")
+    try:
+        os.rename(path, private)
+    except FileNotFoundError:
+        private = None
+    if private is not None and _read_job(private).get('claim') != job['claim']:
+        os.rename(private, path)
+        private = None
+    if private is None:
+        print(f"Job {job['job']} was requeued as stale meanwhile, its result is kept in {run_dir}.")
+        return 'requeued'
+    _write_job(os.path.join(spool, state, os.path.basename(path)), job)
+    os.remove(private)
+    print(f"{'Job ' + state + ':':30s} {job['job']} after {job['elapsed']:.1f} s")
+    return state
+
+
+def work(spool, retries=1, stale=300.0, heartbeat=30.0, poll=5.0, exit_when_empty=False):
+    '''
+    Worker loop, claims and runs jobs until the queue is empty (with
+    exit_when_empty) or forever
+
+    :param spool: spool directory
+    :param type: str
+    :param retries: number of repetitions of a failed job
+    :param type: int
+    :param stale: heartbeat age in s after which a running job is requeued
+    :param type: float
+    :param heartbeat: interval of the heartbeat in s
+    :param type: float
+    :param poll: waiting time in s if no job is pending
+    :param type: float
+    :returns: dict with the number of jobs per final state
+    '''
+    _dirs(spool)
+    counts = {}
+    while True:
+        requeue_stale(spool, stale)
+        path = claim(spool)
+        if path is None:
+            if exit_when_empty and not os.listdir(os.path.join(spool, 'running')):
+                break
+            time.sleep(poll)
+            continue
+        state = run_job(spool, path, retries, heartbeat)
+        counts[state] = counts.get(state, 0) + 1
+    return counts
+
+
+def status(spool):
+    '''
+    Prints the number of jobs per state and the running jobs
+
+    :param spool: spool directory
+    :param type: str
+    :returns: dict with the job names per state
+    '''
+    _dirs(spool)
+    jobs = {state: sorted(entry[:-len('.json')] for entry in os.listdir(os.path.join(spool, state))
+                          if entry.endswith('.json'))
+            for state in STATES}
+    for state in STATES:
+        print(f"{state + ':':30s} {len(jobs[state])}")
+    now = _filesystem_time(spool)
+    for name in jobs['running']:
+        path = os.path.join(spool, 'running', name + '.json')
+        try:
+            job = _read_job(path)
+            age = now - os.path.getmtime(path)
+        except FileNotFoundError:
+            continue
+        print(f"{name:30s} host {job.get('host')}, pid {job.get('pid')}, heartbeat {age:.0f} s ago")
+    return jobs
+
+
+def main(argv):
+    usage = ('spool.py submit -q <spool> <main_ctrl.json> [...]\n'
+             'spool.py work -q <spool> [-r retries] [-s stale] [-b heartbeat] [-x]\n'
+             'spool.py status -q <spool>')
+    if not argv or argv[0] not in ('submit', 'work', 'status'):
+        print(usage)
+        sys.exit(2)
+    command = argv[0]
+    spool = None
+    retries = 1
+    stale = 300.0
+    heartbeat = 30.0
+    exit_when_empty = False
+
+    try:
+        opts, args = getopt.getopt(argv[1:], 'hq:r:s:b:x',
+                                   ['spool=', 'retries=', 'stale=', 'heartbeat=', 'exit'])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            sys.exit()
+        elif opt in ('-q', '--spool'):
+            spool = arg
+        elif opt in ('-r', '--retries'):
+            retries = int(arg)
+        elif opt in ('-s', '--stale'):
+            stale = float(arg)
+        elif opt in ('-b', '--heartbeat'):
+            heartbeat = float(arg)
+        elif opt in ('-x', '--exit'):
+            exit_when_empty = True
+    if spool is None or (command == 'submit' and not args):
+        print(usage)
+        sys.exit(2)
+
+    if command == 'submit':
+        submit(spool, args)
+    elif command == 'work':
+        counts = work(spool, retries, stale, heartbeat, exit_when_empty=exit_when_empty)
+        print(f"{'Jobs:':30s} {', '.join(f'{n} {state}' for state, n in counts.items()) or 'none'}")
+    else:
+        status(spool)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+__author__ = "fgasa"
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+
+class StorageCache:
+    '''
+    Persistent, content-addressed cache of storage simulation results.
+
+    An entry is keyed by the hash of the deck written for the simulation
+    and the files it includes, the simulator identity, the key of the
+    simulation it restarts from, the target rate, the operational mode and
+    the step length. It holds the parsed pressure and
+    flow rate and the files the simulator produced for the simulation title
+    (summary and restart files), which are restored under the current title
+    on a hit, so that later simulations can restart from them.
+
+    Entries are evicted least recently used first once the cache exceeds
+    its size limit.
+    '''
+
+    def __init__(self, directory, max_size=1024, enabled=True):
+        self.enabled = enabled
+        self.directory = directory
+        # size limit in MB
+        self.max_size = float(max_size) * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.size = None
+
+    def key(self, deck_path, parent, rate, mode, step_length, simulator=''):
+        '''
+        Key of a storage simulation
+
+        :param deck_path: path to the deck written for the simulation
+        :param type: str
+        :param parent: key of the simulation the deck restarts from, None for the first simulation
+        :param type: str
+        :param rate: target flow rate
+        :param type: float
+        :param mode: operational mode
+        :param type: str
+        :param step_length: length of the timestep in s
+        :param type: float
+        :param simulator: simulator identity, see simulator_identity
+        :param type: str
+        :returns: str
+        '''
+        digest = hashlib.sha256()
+        for path in deck_files(deck_path):
+            digest.update(f"{os.path.relpath(path, os.path.dirname(deck_path))}|".encode())
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+        digest.update(f"|{simulator}".encode())
+        # the solver noise of the power plant model is below the rounding of the rate
+        digest.update(f"|{parent}|{float(rate):.9g}|{mode}|{float(step_length):.9g}".encode())
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def restore(self, key, working_dir, title):
+        '''
+        Copies the files of a cached simulation into the working directory
+
+        :param key: key of the simulation
+        :param type: str
+        :param working_dir: directory of the deck
+        :param type: str
+        :param title: current simulation title, file names are <title><extension>
+        :param type: str
+        :returns: cached results, None on a miss
+        '''
+        if not self.enabled:
+            return None
+        entry = self._entry(key)
+        result_file = os.path.join(entry, 'result.json')
+        if not os.path.isfile(result_file):
+            self.misses += 1
+            return None
+
+        with open(result_file) as f:
+            result = json.load(f)
+        for extension in result['files']:
+            shutil.copyfile(os.path.join(entry, 'files', extension), os.path.join(working_dir, title + extension))
+        # access time for the eviction
+        os.utime(result_file)
+        self.hits += 1
+        return result['results']
+
+    def store(self, key, working_dir, title, results):
+        '''
+        Adds a simulation with the files produced for its title
+
+        :param key: key of the simulation
+        :param type: str
+        :param working_dir: directory of the deck
+        :param type: str
+        :param title: simulation title
+        :param type: str
+        :param results: parsed results
+        :param type: list
+        :returns: no return value
+        '''
+        if not self.enabled:
+            return
+        entry = self._entry(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        # write into a temporary directory and rename, concurrent runs may store the same key
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        os.makedirs(os.path.join(tmp, 'files'))
+        extensions = []
+        for name in os.listdir(working_dir):
+            extension = name[len(title):]
+            if not name.startswith(title + '.') or extension == '.DATA' or '.' in extension[1:]:
+                continue
+            shutil.copyfile(os.path.join(working_dir, name), os.path.join(tmp, 'files', extension))
+            extensions.append(extension)
+        with open(os.path.join(tmp, 'result.json'), 'w') as f:
+            json.dump({'results': [float(value) for value in results], 'files': extensions}, f)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+        if self.size is not None:
+            self.size += _tree_size(entry)
+        self.evict()
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache fits its size limit
+
+        :returns: no return value
+        '''
+        if self.size is not None and self.size <= self.max_size:
+            return
+        entries = []
+        for prefix in os.listdir(self.directory):
+            for key in os.listdir(os.path.join(self.directory, prefix)):
+                path = os.path.join(self.directory, prefix, key)
+                result_file = os.path.join(path, 'result.json')
+                if os.path.isfile(result_file):
+                    entries.append((os.path.getmtime(result_file), _tree_size(path), path))
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self.size <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            self.size -= size
+            self.evicted += 1
+
+    def print_summary(self):
+        '''
+        Prints the hit rate
+
+        :returns: no return value
+        '''
+        if not self.enabled:
+            return
+        total = self.hits + self.misses
+        share = self.hits / total if total else 0.0
+        print(f"{'Storage cache hits:':30s} {self.hits} of {total} ({share:.1%})")
+        print(f"{'Storage cache size [MB]:':30s} {(self.size or 0) / 1024 / 1024:.1f}, "
+              f"{self.evicted} entries evicted")
+
+
+def deck_files(deck_path):
+    '''
+    The deck and all files it includes, recursively. INCLUDE paths are
+    relative to the directory of the top-level deck.
+
+    :param deck_path: path to the deck
+    :param type: str
+    :returns: list of paths, missing include files are listed as well
+    '''
+    root = os.path.dirname(os.path.abspath(deck_path))
+    files = [os.path.abspath(deck_path)]
+    for path in files:
+        if not os.path.isfile(path):
+            continue
+        with open(path, errors='replace') as f:
+            lines = [line.split('--')[0].strip() for line in f]
+        for i, line in enumerate(lines):
+            if line.upper() != 'INCLUDE':
+                continue
+            # the file name is the first item of the record after the keyword, quoted or a single word
+            record = next((line for line in lines[i + 1:] if line), '')
+            if record[:1] in ("'", '"'):
+                name = record[1:].split(record[0])[0]
+            else:
+                name = record.split()[0].rstrip('/') if record else ''
+            include = os.path.normpath(os.path.join(root, name))
+            if name and include not in files:
+                files.append(include)
+    return files
+
+
+def simulator_identity(simulator, simulator_path=None, simulator_args=None):
+    '''
+    Identity of the storage simulator for the cache keys, the simulator
+    name, the executable with its size and modification time (a changed
+    installation changes the keys) and the simulator arguments
+
+    :param simulator: simulator flag of the geostorage control file
+    :param type: str
+    :param simulator_path: path or name of the simulator executable
+    :param type: str
+    :param simulator_args: arguments passed to the simulator
+    :param type: list or str
+    :returns: str
+    '''
+    executable = simulator_path or ('eclrun' if simulator in ('ECLIPSE', 'e300') else simulator)
+    resolved = shutil.which(executable) or executable
+    try:
+        stat = os.stat(resolved)
+        installation = f"{os.path.realpath(resolved)}|{stat.st_size}|{stat.st_mtime_ns}"
+    except (OSError, TypeError):
+        installation = str(resolved)
+    return json.dumps([simulator, installation, simulator_args], default=str)
+
+
+def _tree_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Power plant design sweeps of a coupled scenario.
+
+usage: python -m coupled_simulation.sweep -i <main_ctrl.json> -g <grid.json> [-w workers] [-r retries]
+
+The grid file maps parameters to lists of values, every combination of
+values is a variant. Parameters are dotted keys of the power plant control
+file (e.g. charge.power_nominal, discharge.massflow_max_rel), keys with the
+prefix 'geostorage.' set keys of the geostorage control file and 'wells'
+keeps the given number of wells of the geostorage well lists.
+
+The power plant layouts of the variants are solved in worker processes.
+Variants with the same storage model share one initial storage simulation,
+which runs meanwhile. The coupled runs of the variants are then scheduled
+concurrently, at most 'workers' at a time, each in <working dir>/sweep/variant_<n>.
+Every variant gets a summary.json, all summaries are collected in
+<working dir>/sweep/sweep.csv.
+
+__author__ = "fgasa"
+
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import csv
+import getopt
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+
+from coupled_simulation import ensemble
+
+WELL_KEYS = ('well_names', 'well_depths', 'well_lower_BHP', 'well_upper_BHP')
+
+
+def expand_grid(grid):
+    '''
+    Expands a parameter grid into its variants
+
+    :param grid: list of values for each parameter
+    :param type: dict
+    :returns: list of dicts with one value per parameter
+    '''
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def split_parameters(variant, geostorage_ctrl):
+    '''
+    Splits the parameters of a variant into power plant and geostorage keys
+
+    :param variant: parameters of the variant
+    :param type: dict
+    :param geostorage_ctrl: geostorage control data of the template
+    :param type: dict
+    :returns: tuple of power plant keys and geostorage keys
+    '''
+    powerplant_keys, geostorage_keys = {}, {}
+    for key, value in variant.items():
+        if key == 'wells':
+            for name in WELL_KEYS:
+                geostorage_keys[name] = geostorage_ctrl[name][:int(value)]
+        elif key.startswith('geostorage.'):
+            geostorage_keys[key[len('geostorage.'):]] = value
+        else:
+            powerplant_keys[key] = value
+    return powerplant_keys, geostorage_keys
+
+
+def make_powerplant(base, powerplant_dir, powerplant_keys):
+    '''
+    Copies the power plant of the template and sets the variant's keys
+
+    :param base: template scenario, see ensemble.load_scenario
+    :param type: SimpleNamespace
+    :param powerplant_dir: power plant directory of the variant
+    :param type: str
+    :param powerplant_keys: dotted keys of the power plant control file
+    :param type: dict
+    :returns: no return value
+    '''
+    shutil.rmtree(powerplant_dir, ignore_errors=True)
+    shutil.copytree(base.powerplant_dir, powerplant_dir)
+    path = os.path.join(powerplant_dir, f"{base.scenario}.powerplant_ctrl.json")
+    with open(path) as f:
+        ctrl = json.load(f)
+    original = json.dumps(ctrl, sort_keys=True)
+    for key, value in powerplant_keys.items():
+        ensemble.set_key(ctrl, key, value)
+    # the layout cache is keyed by the file content, an unchanged plant keeps the template's layouts
+    if json.dumps(ctrl, sort_keys=True) != original:
+        with open(path, 'w') as f:
+            json.dump(ctrl, f, indent=1)
+
+
+def _layout_worker(settings, well_data):
+    from coupled_simulation import powerplant as pp
+
+    pp.PowerPlantCoupling(SimpleNamespace(**settings), *well_data).close()
+    return well_data
+
+
+def _initial_pressure(base, run_dir, geostorage_keys):
+    from coupled_simulation import coupling, geostorage as gs
+
+    path = ensemble.make_run(base, run_dir, geostorage_keys=geostorage_keys)
+    cd = coupling.CouplingData(path=path)
+    p0, _ = gs.GeoStorage(cd).call_storage_simulation(0.0, -1, 0, cd, 'init')
+    return p0
+
+
+def summarize(results, t_step_length):
+    '''
+    Key figures of a coupled run
+
+    :param results: results of the run, see results.ResultStore
+    :param type: numpy.ndarray
+    :param t_step_length: timestep length in s
+    :param type: float
+    :returns: dict
+    '''
+    rows = results[1:]
+    hours = t_step_length / 3600.0
+    power = rows['power_actual']
+    target = rows['power_target']
+    mass = rows['massflow_actual'] * t_step_length / 1000.0
+    summary = {
+        'timesteps': len(rows),
+        'energy_charged [MWh]': float(power[power > 0].sum() * hours),
+        'energy_discharged [MWh]': float(-power[power < 0].sum() * hours),
+        'mass_injected [t]': float(mass[power > 0].sum()),
+        'mass_withdrawn [t]': float(mass[power < 0].sum()),
+        'pressure_min [bar]': float(rows['storage_pressure'].min()),
+        'pressure_max [bar]': float(rows['storage_pressure'].max()),
+        'target_met': float(np.abs(power).sum() / np.abs(target).sum()) if np.abs(target).sum() else 1.0,
+    }
+    if 'Tstep_accepted' in rows.dtype.names:
+        summary['not_accepted'] = int((~rows['Tstep_accepted']).sum())
+    return summary
+
+
+def run_sweep(path, grid, workers=None, retries=1):
+    '''
+    Runs all variants of a design sweep
+
+    :param path: path to the main control file of the template scenario
+    :param type: str
+    :param grid: list of values for each parameter
+    :param type: dict
+    :param workers: number of concurrent workers, defaults to the available cores
+    :param type: int
+    :param retries: number of repetitions of a failed coupled run
+    :param type: int
+    :returns: list of variant records with parameters, status and summary
+    '''
+    from coupled_simulation.powerplant import _available_cores
+
+    base = ensemble.load_scenario(path)
+    root = os.path.join(base.working_dir, 'sweep')
+    workers = workers or _available_cores()
+
+    variants = []
+    for i, parameters in enumerate(expand_grid(grid)):
+        powerplant_keys, geostorage_keys = split_parameters(parameters, base.geostorage_ctrl)
+        geostorage_ctrl = json.loads(json.dumps(base.geostorage_ctrl))
+        for key, value in geostorage_keys.items():
+            ensemble.set_key(geostorage_ctrl, key, value)
+        variants.append({
+            'variant': i, 'parameters': parameters, 'dir': os.path.join(root, f"variant_{i:03d}"),
+            'geostorage_keys': geostorage_keys, 'well_data': ensemble.well_data(geostorage_ctrl),
+            'storage': json.dumps(geostorage_ctrl, sort_keys=True)
+        })
+        make_powerplant(base, os.path.join(variants[-1]['dir'], 'powerplant'), powerplant_keys)
+    print(f"{'Sweep variants:':30s} {len(variants)}")
+
+    # one initial storage run per distinct storage model
+    storages = {}
+    for variant in variants:
+        storages.setdefault(variant['storage'], variant['geostorage_keys'])
+    print(f"{'Initial storage runs:':30s} {len(storages)}")
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as layouts, \
+            ThreadPoolExecutor(max_workers=1) as inits:
+        init_runs = {
+            storage: inits.submit(_initial_pressure, base, os.path.join(root, f"init_{k:03d}"), keys)
+            for k, (storage, keys) in enumerate(storages.items())
+        }
+        layout_runs = []
+        for variant in variants:
+            settings = {**base.main_ctrl, 'working_dir': variant['dir'], 'powerplant_path': 'powerplant',
+                        'scenario': base.scenario}
+            layout_runs.append(layouts.submit(_layout_worker, settings, variant['well_data']))
+        for variant, future in zip(variants, layout_runs):
+            future.result()
+            print(f"{'Layout of variant:':30s} {variant['variant']}")
+        initial_pressures = {storage: future.result() for storage, future in init_runs.items()}
+
+    def run(variant):
+        run_dir = os.path.join(variant['dir'], 'run')
+        ctrl_path = os.path.join(run_dir, f"{base.scenario}.main_ctrl.json")
+
+        def prepare():
+            ensemble.make_run(base, run_dir, main_keys={'initial_pressure': initial_pressures[variant['storage']]},
+                              geostorage_keys=variant['geostorage_keys'],
+                              powerplant_dir=os.path.join(variant['dir'], 'powerplant'))
+
+        result, attempts = ensemble.run_coupled(ctrl_path, prepare, retries)
+        record = {'variant': variant['variant'], 'parameters': variant['parameters'],
+                  'status': 'failed' if result is None else 'done', 'attempts': attempts,
+                  'summary': {} if result is None else summarize(result, float(base.main_ctrl['t_step_length']))}
+        with open(os.path.join(variant['dir'], 'summary.json'), 'w') as f:
+            json.dump(record, f, indent=1)
+        print(f"{'Variant ' + str(variant['variant']) + ':':30s} {record['status']} after {attempts} attempt(s)")
+        return record
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        records = list(executor.map(run, variants))
+
+    columns = list(grid) + ['status'] + next((list(r['summary']) for r in records if r['summary']), [])
+    with open(os.path.join(root, 'sweep.csv'), mode='w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(['variant'] + columns)
+        for record in records:
+            values = {**record['parameters'], 'status': record['status'], **record['summary']}
+            writer.writerow([record['variant']] + [values.get(column, '') for column in columns])
+    print(f"{'Summary written to:':30s} {os.path.join(root, 'sweep.csv')}")
+    return records
+
+
+def main(argv):
+    usage = 'sweep.py -i <main_ctrl.json> -g <grid.json> [-w workers] [-r retries]'
+    path = grid = None
+    workers = None
+    retries = 1
+
+    try:
+        opts, args = getopt.getopt(argv, 'hi:g:w:r:', ['ipath=', 'grid=', 'workers=', 'retries='])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            sys.exit()
+        elif opt in ('-i', '--ipath'):
+            path = arg
+        elif opt in ('-g', '--grid'):
+            grid = arg
+        elif opt in ('-w', '--workers'):
+            workers = int(arg)
+        elif opt in ('-r', '--retries'):
+            retries = int(arg)
+    if path is None or grid is None:
+        print(usage)
+        sys.exit(2)
+
+    with open(grid) as f:
+        run_sweep(path, json.load(f), workers, retries)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
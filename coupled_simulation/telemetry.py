@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+__author__ = "fgasa"
+
+"""
+
+from contextlib import contextmanager
+import csv
+import json
+import os
+import threading
+import time
+
+
+class Profiler:
+    '''
+    Collects wall-clock timings of the individual phases of the coupling loop.
+
+    Timings are aggregated per timestep and for the whole run. The profile can
+    be exported as machine-readable JSON and CSV files next to the output file.
+    '''
+
+    phases = ('powerplant', 'deck_rework', 'simulator', 'result_parsing', 'cleanup', 'output')
+    # phases timed in worker threads while the coupling loop goes on, e.g. the
+    # power plant pre-solves of the pipeline, they overlap the other phases
+    concurrent = ('presolve',)
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.run_start = time.perf_counter()
+        self.tstep = 'init'
+        self.step_start = self.run_start
+        # timestep -> {'wall': seconds, 'phases': {phase: [seconds, count]}}
+        self.steps = {self.tstep: {'wall': 0.0, 'phases': {}}}
+        self.totals = {}
+        # the storage initialisation may run in a thread during startup
+        self.lock = threading.Lock()
+
+    def set_timestep(self, tstep):
+        '''
+        Closes the current timestep and assigns subsequent timings to tstep
+
+        :param tstep: timestep identifier
+        :param type: int or str
+        :returns: no return value
+        '''
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.steps[self.tstep]['wall'] += now - self.step_start
+        self.step_start = now
+        self.tstep = tstep
+        self.steps.setdefault(tstep, {'wall': 0.0, 'phases': {}})
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Context manager timing a single phase of the current timestep
+
+        :param name: name of the phase, see Profiler.phases
+        :param type: str
+        '''
+        if not self.enabled:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def add(self, name, seconds):
+        '''
+        Adds a timing to the current timestep and to the run totals
+
+        :param name: name of the phase
+        :param type: str
+        :param seconds: elapsed wall-clock time
+        :param type: float
+        :returns: no return value
+        '''
+        with self.lock:
+            entry = self.steps[self.tstep]['phases'].setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+            total = self.totals.setdefault(name, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+    def iterations(self, tstep):
+        '''
+        Number of storage simulation runs recorded for a timestep
+
+        :param tstep: timestep identifier
+        :param type: int or str
+        :returns: int
+        '''
+        return self.steps.get(tstep, {'phases': {}})['phases'].get('simulator', [0.0, 0])[1]
+
+    def summary(self):
+        '''
+        Aggregates the run totals
+
+        :returns: dict with the total wall time, the share of wall time of
+                  the phases of the coupling loop and seconds, call count,
+                  share of wall time and whether it is concurrent for each phase
+        '''
+        wall = time.perf_counter() - self.run_start
+        phases = {}
+        for name, (seconds, count) in self.totals.items():
+            phases[name] = {
+                'seconds': seconds,
+                'count': count,
+                'share': seconds / wall if wall > 0.0 else 0.0,
+                'concurrent': name in self.concurrent
+            }
+        # concurrent phases overlap the loop, their shares are not part of the total
+        share = sum(entry['share'] for entry in phases.values() if not entry['concurrent'])
+        return {'wall': wall, 'share': share, 'timesteps': len(self.steps) - 1, 'phases': phases}
+
+    def export(self, path_base):
+        '''
+        Writes the profile to path_base + '.profile.json' and '.profile.csv'
+
+        :param path_base: path of the output file without extension
+        :param type: str
+        :returns: no return value
+        '''
+        if not self.enabled:
+            return
+        self.set_timestep(self.tstep)
+        names = list(self.phases) + sorted(set(self.totals) - set(self.phases))
+
+        timesteps = []
+        for tstep, step in self.steps.items():
+            timesteps.append({
+                'tstep': tstep,
+                'wall': step['wall'],
+                'iterations': self.iterations(tstep),
+                'phases': {name: step['phases'].get(name, [0.0, 0])[0] for name in names}
+            })
+
+        with open(path_base + '.profile.json', 'w') as f:
+            json.dump({'run': self.summary(), 'timesteps': timesteps}, f, indent=1)
+
+        with open(path_base + '.profile.csv', mode='w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, delimiter=';')
+            writer.writerow(['tstep', 'wall', 'iterations'] + names)
+            for step in timesteps:
+                writer.writerow([step['tstep'], f"{step['wall']:.6f}", step['iterations']]
+                                + [f"{step['phases'][name]:.6f}" for name in names])
+
+    def print_summary(self):
+        '''
+        Prints the run totals per phase
+
+        :returns: no return value
+        '''
+        if not self.enabled:
+            return
+        summary = self.summary()
+        print(f"{'Phase':30s} {'time [s]':>12s} {'calls':>8s} {'share':>8s}")
+        for name, entry in summary['phases'].items():
+            if not entry['concurrent']:
+                print(f"{name:30s} {entry['seconds']:12.3f} {entry['count']:8d} {entry['share']:8.1%}")
+        print(f"{'total':30s} {'':12s} {'':8s} {summary['share']:8.1%}")
+        for name, entry in summary['phases'].items():
+            if entry['concurrent']:
+                print(f"{name + ' (concurrent)':30s} {entry['seconds']:12.3f} {entry['count']:8d} "
+                      f"{entry['share']:8.1%}")
+
+
+class ConvergenceLog:
+    '''
+    Records the fixed-point iterations of the coupling for every timestep.
+
+    For each iteration the pressure and mass flow residuals between power
+    plant and storage and the branch taken by calc_timestep are kept, for each
+    timestep the storage mode, the number of iterations and whether the step
+    was accepted. The log is exported as JSON with one line per timestep and
+    a summary with iteration and branch histograms.
+    '''
+
+    branches = ('pressure_adjust', 'flow_adjust', 'converged', 'forced_shut_in',
+                'shut_in', 'power_plant_off', 'mode_error')
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.steps = []
+        self.current = None
+
+    def start(self, tstep, mode):
+        '''
+        Opens the record of a timestep
+
+        :param tstep: timestep
+        :param type: int
+        :param mode: storage mode at the start of the timestep
+        :param type: str
+        :returns: no return value
+        '''
+        if not self.enabled:
+            return
+        self.current = {'tstep': tstep, 'mode': mode, 'iterations': 0, 'accepted': False,
+                        'branch': [], 'dp': [], 'dp_rel': [], 'dm': [], 'dm_rel': []}
+        self.steps.append(self.current)
+
+    def iteration(self, branch, dp, dp_rel, dm, dm_rel):
+        '''
+        Records one coupling iteration of the current timestep
+
+        :param branch: branch taken after the storage simulation, see ConvergenceLog.branches
+        :param type: str
+        :param dp: absolute pressure residual in bar
+        :param type: float
+        :param dp_rel: relative pressure residual
+        :param type: float
+        :param dm: absolute mass flow residual in kg/s
+        :param type: float
+        :param dm_rel: relative mass flow residual
+        :param type: float
+        :returns: no return value
+        '''
+        if not self.enabled or self.current is None:
+            return
+        self.current['iterations'] += 1
+        self.current['branch'].append(branch)
+        for key, value in (('dp', dp), ('dp_rel', dp_rel), ('dm', dm), ('dm_rel', dm_rel)):
+            self.current[key].append(round(float(value), 8))
+
+    def finish(self, accepted):
+        '''
+        Closes the record of the current timestep
+
+        :param accepted: True if the timestep converged
+        :param type: bool
+        :returns: no return value
+        '''
+        if not self.enabled or self.current is None:
+            return
+        self.current['accepted'] = bool(accepted)
+        self.current = None
+
+    def summary(self):
+        '''
+        Aggregates the timestep records
+
+        :returns: dict with the number of timesteps and not accepted timesteps
+                  and histograms of the iteration counts and branches
+        '''
+        iterations = {}
+        branches = {}
+        for step in self.steps:
+            iterations[step['iterations']] = iterations.get(step['iterations'], 0) + 1
+            for branch in step['branch']:
+                branches[branch] = branches.get(branch, 0) + 1
+        return {
+            'timesteps': len(self.steps),
+            'not_accepted': sum(not step['accepted'] for step in self.steps),
+            'storage_runs': sum(step['iterations'] for step in self.steps),
+            'iterations': {str(k): iterations[k] for k in sorted(iterations)},
+            'branches': branches
+        }
+
+    def export(self, path_base):
+        '''
+        Writes the log to path_base + '.convergence.json'
+
+        :param path_base: path of the output file without extension
+        :param type: str
+        :returns: no return value
+        '''
+        if not self.enabled:
+            return
+        with open(path_base + '.convergence.json', 'w') as f:
+            f.write('{"summary": ' + json.dumps(self.summary()) + ',\n "timesteps": [\n')
+            f.write(',\n'.join('  ' + json.dumps(step) for step in self.steps))
+            f.write('\n ]}\n')
+
+    def print_summary(self):
+        '''
+        Prints the iteration and branch histograms
+
+        :returns: no return value
+        '''
+        if not self.enabled:
+            return
+        summary = self.summary()
+        print(f"{'Timesteps not accepted:':30s} {summary['not_accepted']} of {summary['timesteps']}")
+        print(f"{'Iterations':30s} {'timesteps':>12s}")
+        for count, number in summary['iterations'].items():
+            print(f"{count:30s} {number:12d}")
+        print(f"{'Branch':30s} {'count':>12s}")
+        for branch, number in summary['branches'].items():
+            print(f"{branch:30s} {number:12d}")
+
+
+class MetricsFile:
+    '''
+    Live progress metrics of a run in the Prometheus text format.
+
+    The file is rewritten at most every 'interval' seconds, atomically by
+    renaming a temporary file, so it can be read at any time, e.g. by the
+    textfile collector of the Prometheus node exporter or a dashboard
+    watching many runs. All metrics carry the scenario and working
+    directory as labels.
+    '''
+
+    def __init__(self, path, interval=10.0, timesteps=0, labels=None, enabled=True):
+        self.enabled = enabled
+        self.path = path
+        self.interval = float(interval)
+        self.timesteps = int(timesteps)
+        self.labels = ','.join(f'{key}="{_escape(value)}"' for key, value in (labels or {}).items())
+        self.start = None
+        self.last_write = None
+        self.tstep = -1
+        self.done = 0
+        self.not_accepted = 0
+
+    def update(self, cd, tstep, accepted, powerplant=None, steps=1):
+        '''
+        Counts finished timesteps and rewrites the file if the interval elapsed
+
+        :param cd: coupling data with the profiler, convergence log and caches
+        :param type: CouplingData
+        :param tstep: finished timestep
+        :param type: int
+        :param accepted: True if the timestep converged
+        :param type: bool
+        :param powerplant: power plant model, None in storage-only runs
+        :param type: PowerPlantCoupling
+        :param steps: number of timesteps covered by the storage run
+        :param type: int
+        :returns: no return value
+        '''
+        if not self.enabled:
+            return
+        self.tstep = tstep
+        self.done += steps
+        self.not_accepted += (not accepted) * steps
+        now = time.perf_counter()
+        if self.last_write is None or now - self.last_write >= self.interval:
+            self.write(cd, powerplant)
+
+    def write(self, cd, powerplant=None, finished=False):
+        '''
+        Rewrites the metrics file, the first call marks the start of the time loop
+
+        :param finished: True at the end of the run
+        :param type: bool
+        :returns: no return value
+        '''
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.last_write is None:
+            # the initial storage run and the power plant layouts are not part of the time loop
+            self.start = now
+        self.last_write = now
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0.0 else 0.0
+        metrics = [
+            ('timestep', 'gauge', 'Last finished timestep', self.tstep),
+            ('timesteps', 'gauge', 'Scheduled timesteps', self.timesteps),
+            ('timesteps_done_total', 'counter', 'Finished timesteps', self.done),
+            ('timesteps_not_accepted_total', 'counter', 'Timesteps accepted without convergence', self.not_accepted),
+            ('elapsed_seconds', 'gauge', 'Wall time since the start of the time loop', elapsed),
+            ('throughput_steps_per_hour', 'gauge', 'Finished timesteps per wall-clock hour', rate * 3600.0),
+            ('eta_seconds', 'gauge', 'Estimated wall time to the last timestep',
+             (self.timesteps - self.done) / rate if rate > 0.0 else float('nan')),
+            ('finished', 'gauge', '1 once the run has finished', int(finished)),
+        ]
+
+        convergence = getattr(cd, 'convergence', None)
+        if convergence is not None and convergence.enabled and convergence.steps:
+            metrics.append(('iterations_mean', 'gauge', 'Mean coupling iterations per timestep',
+                            sum(step['iterations'] for step in convergence.steps) / len(convergence.steps)))
+        profiler = getattr(cd, 'profiler', None)
+        if profiler is not None and profiler.enabled:
+            seconds, count = profiler.totals.get('simulator', [0.0, 0])
+            metrics.append(('simulator_runs_total', 'counter', 'Storage simulator runs', count))
+            metrics.append(('simulator_share', 'gauge', 'Share of the wall time spent in the storage simulator',
+                            seconds / (now - profiler.run_start)))
+        storage_cache = getattr(cd, 'storage_cache', None)
+        if storage_cache is not None and storage_cache.enabled:
+            lookups = storage_cache.hits + storage_cache.misses
+            metrics.append(('storage_cache_hit_ratio', 'gauge', 'Share of storage simulations served from the cache',
+                            storage_cache.hits / lookups if lookups else 0.0))
+        if powerplant is not None:
+            lookups = getattr(powerplant, 'layout_cache_hits', 0) + getattr(powerplant, 'layout_cache_misses', 0)
+            if lookups:
+                metrics.append(('layout_cache_hit_ratio', 'gauge', 'Share of power plant layouts from the cache',
+                                powerplant.layout_cache_hits / lookups))
+        scheduler = getattr(cd, 'scheduler', None)
+        if scheduler is not None and scheduler.enabled:
+            summary = scheduler.summary()
+            metrics.append(('core_wait_seconds_total', 'counter', 'Time spent waiting for cores', summary['wait']))
+
+        lines = []
+        for name, kind, description, value in metrics:
+            lines.append(f"# HELP if_pplant_{name} {description}")
+            lines.append(f"# TYPE if_pplant_{name} {kind}")
+            lines.append(f"if_pplant_{name}{{{self.labels}}} {float(value):.6g}")
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.path)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
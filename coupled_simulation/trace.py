@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Binary event trace of the coupling loop and its pretty-printer.
+
+usage: python -m coupled_simulation.trace [-e event] [-t tstep] [-n last] <output>.trace.bin
+
+__author__ = "fgasa"
+
+"""
+
+import getopt
+import json
+import struct
+import sys
+import threading
+import time
+
+MAGIC = b'IFTRACE1'
+# wall time since the start of the trace, timestep, iteration, event, status, four values
+RECORD = struct.Struct('<dihBB4d')
+
+MODES = ('init', 'charging', 'discharging', 'shut-in')
+
+# event name, labels of the four values, labels of the status codes
+EVENTS = (
+    ('timestep', ('power_target', 'pressure', '', ''), MODES),
+    ('storage', ('target_flow', 'flowrate', 'pressure', 'step_length'), MODES),
+    ('powerplant', ('mass_flow', 'power', 'pressure', 'heat'),
+     ('solved', 'below_min_flow', 'above_max_flow', 'below_envelope', 'above_envelope',
+      'linearized', 'no_solution')),
+    ('iteration', ('m_target', 'm_storage', 'p_assumed', 'p_storage'),
+     ('none', 'pressure_adjust', 'flow_adjust', 'converged', 'forced_shut_in',
+      'shut_in', 'power_plant_off', 'mode_error')),
+    ('accept', ('pressure', 'mass_flow', 'power', 'heat'), ('not_accepted', 'accepted')),
+)
+EVENT_CODES = {name: code for code, (name, _, _) in enumerate(EVENTS)}
+STATUS_CODES = {name: {status: code for code, status in enumerate(statuses)}
+                for name, _, statuses in EVENTS}
+
+
+class EventTrace:
+    '''
+    Fixed-schema event records of the coupling loop in a preallocated ring
+    buffer.
+
+    Every record holds the wall time, the timestep and iteration it belongs
+    to, an event and a status code and four values whose meaning depends on
+    the event, see EVENTS. Recording packs the record into the buffer without
+    any string formatting, the oldest records are overwritten once the buffer
+    is full. The trace is dumped as a binary file and decoded on demand with
+    format_trace or from the command line.
+    '''
+
+    def __init__(self, capacity=65536, enabled=True):
+        # a buffer without records is the same as no trace
+        self.enabled = enabled and int(capacity) > 0
+        self.capacity = int(capacity) if self.enabled else 0
+        self.buffer = bytearray(RECORD.size * self.capacity)
+        self.count = 0
+        self.start = time.perf_counter()
+        self.tstep = -1
+        self.iteration = 0
+        # the storage initialisation may run in a thread during startup
+        self.lock = threading.Lock()
+
+    def at(self, tstep, iteration):
+        '''
+        Assigns subsequent records to a timestep and iteration
+
+        :param tstep: timestep, -1 for the initialisation
+        :param type: int
+        :param iteration: coupling iteration
+        :param type: int
+        :returns: no return value
+        '''
+        self.tstep = tstep
+        self.iteration = iteration
+
+    def record(self, event, status, v0=0.0, v1=0.0, v2=0.0, v3=0.0):
+        '''
+        Adds a record to the buffer
+
+        :param event: event name, see EVENTS
+        :param type: str
+        :param status: status name of the event
+        :param type: str
+        :param v0: first to fourth value of the event
+        :param type: float
+        :returns: no return value
+        '''
+        if not self.enabled:
+            return
+        with self.lock:
+            offset = (self.count % self.capacity) * RECORD.size
+            RECORD.pack_into(self.buffer, offset, time.perf_counter() - self.start,
+                             self.tstep, self.iteration, EVENT_CODES[event],
+                             STATUS_CODES[event].get(status, 0), v0, v1, v2, v3)
+            self.count += 1
+
+    def dump(self, path_base):
+        '''
+        Writes the buffered records in chronological order to path_base + '.trace.bin'
+
+        :param path_base: path of the output file without extension
+        :param type: str
+        :returns: no return value
+        '''
+        if not self.enabled:
+            return
+        head = (self.count % self.capacity) * RECORD.size
+        if self.count > self.capacity:
+            records = self.buffer[head:] + self.buffer[:head]
+        else:
+            records = self.buffer[:head]
+        header = json.dumps({
+            'record': RECORD.format,
+            'events': EVENTS,
+            'recorded': self.count,
+            'dropped': max(0, self.count - self.capacity),
+        }).encode()
+        with open(path_base + '.trace.bin', 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            f.write(records)
+
+
+def read_trace(path):
+    '''
+    Reads a dumped trace
+
+    :param path: path of the .trace.bin file
+    :param type: str
+    :returns: tuple of the header (dict) and a list of records (tuples)
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not an event trace.")
+    offset = len(MAGIC) + 4
+    size, = struct.unpack_from('<I', data, len(MAGIC))
+    header = json.loads(data[offset:offset + size])
+    record = struct.Struct(header['record'])
+    return header, list(record.iter_unpack(data[offset + size:]))
+
+
+def format_trace(path, event=None, tstep=None, last=None):
+    '''
+    Decodes a dumped trace into text lines
+
+    :param path: path of the .trace.bin file
+    :param type: str
+    :param event: only records of this event
+    :param type: str
+    :param tstep: only records of this timestep
+    :param type: int
+    :param last: only the last records
+    :param type: int
+    :returns: list of str
+    '''
+    header, records = read_trace(path)
+    events = header['events']
+
+    lines = [f"{'time [s]':>10s} {'tstep':>6s} {'iter':>4s} {'event':12s} {'status':16s} values"]
+    if header['dropped']:
+        lines.append(f"{header['dropped']} older records were overwritten.")
+    selected = [r for r in records
+                if (event is None or events[r[3]][0] == event) and (tstep is None or r[1] == tstep)]
+    if last is not None:
+        selected = selected[-last:]
+    for wall, step, iteration, code, status, *values in selected:
+        name, labels, statuses = events[code]
+        pairs = ' '.join(f"{label}={value:.6f}" for label, value in zip(labels, values) if label)
+        lines.append(f"{wall:10.3f} {step:6d} {iteration:4d} {name:12s} {statuses[status]:16s} {pairs}")
+    return lines
+
+
+def main(argv):
+    usage = 'trace.py [-e event] [-t tstep] [-n last] <output>.trace.bin'
+    event = tstep = last = None
+
+    try:
+        opts, args = getopt.getopt(argv, 'he:t:n:', ['event=', 'tstep=', 'last='])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            sys.exit()
+        elif opt in ('-e', '--event'):
+            event = arg
+        elif opt in ('-t', '--tstep'):
+            tstep = int(arg)
+        elif opt in ('-n', '--last'):
+            last = int(arg)
+    if len(args) != 1:
+        print(usage)
+        sys.exit(2)
+
+    for line in format_trace(args[0], event, tstep, last):
+        print(line)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
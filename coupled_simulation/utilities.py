@@ -185,13 +185,17 @@ def get_string_count(input, keyword):
     return sum ( 1 for s in input if keyword in s)
 
 
-def read_series(path):
+def read_series(path, positive='input', negative='output'):
     '''
     reads now the input time series file using csv package.
 
     :param path: path to input time series
     :type path: str
-    :returns: ts_dict (*dict*) - dictionary mapping datetime to power
+    :param positive: column of the values into the storage (charging)
+    :type positive: str
+    :param negative: column of the values out of the storage (discharging)
+    :type negative: str
+    :returns: ts_dict (*dict*) - dictionary mapping datetime to power (or mass flow)
     '''
     ts_dict = {}
     with open(path, mode='r', newline='', encoding='utf-8') as f:
@@ -203,11 +207,28 @@ def read_series(path):
             t_idx = datetime.datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S')
 
             # Net power [MW or kW]
-            power = float(row['input']) - float(row['output'])
+            power = float(row[positive] or 0.0) - float(row[negative] or 0.0)
             ts_dict[t_idx] = power
 
     return ts_dict
 
+def run_lengths(values, tolerance=1E-7):
+    '''
+    run-length compression of a schedule, counts the values equal to the
+    value at each position up to the next change.
+
+    :param values: schedule values on the time grid
+    :type values: list
+    :param tolerance: largest difference of values counted as equal
+    :type tolerance: float
+    :returns: runs (*list*) - number of equal values from each position on, at least 1
+    '''
+    runs = [1] * len(values)
+    for i in range(len(values) - 2, -1, -1):
+        if abs(values[i + 1] - values[i]) <= tolerance:
+            runs[i] = runs[i + 1] + 1
+    return runs
+
 class Logger(object):
     """
     Redirects stdout to a file and the terminal.
@@ -11,5 +11,6 @@ import sys
 
 from coupled_simulation import cp
 
-print (sys.argv)
-cp.main(sys.argv[1:])
+if __name__ == '__main__':
+    print (sys.argv)
+    cp.main(sys.argv[1:])
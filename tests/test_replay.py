@@ -0,0 +1,54 @@
+import os
+
+from coupled_simulation.replay import Recording, read_recording
+
+
+class CheckingPlant:
+    '''
+    Power plant stand-in that, like PowerPlantCoupling._check_results,
+    calls its own get_power for requests above the maximum mass flow
+    '''
+
+    mass_flow_max = 100.0
+
+    def get_mass_flow(self, power, pressure, mode):
+        mass_flow = 2.0 * power + 0.1 * pressure
+        if mass_flow > self.mass_flow_max:
+            return self.get_power(self.mass_flow_max, pressure, mode)
+        return mass_flow, power, 0.5 * power
+
+    def get_power(self, mass_flow, pressure, mode):
+        power = min(mass_flow, self.mass_flow_max) / 2.0 - 0.05 * pressure
+        return min(mass_flow, self.mass_flow_max), power, 0.5 * power
+
+
+def couple(recording, powerplant):
+    '''
+    Coupling loop in miniature: one storage simulation and two solves per timestep
+    '''
+    results = []
+    for tstep, power in enumerate((20.0, 60.0, 30.0, 80.0)):
+        pressure = 60.0 + tstep
+        if recording.replaying:
+            recording.storage(power, tstep, 0, 3600.0, 'charge')
+        else:
+            recording.record_storage(power, tstep, 0, 3600.0, 'charge', pressure, power)
+        results.append(powerplant.get_mass_flow(power, pressure, 'charge'))
+        results.append(powerplant.get_power(power, pressure, 'charge'))
+    return results
+
+
+def test_replay_of_nested_solves(tmp_path):
+    recording = Recording(record=True, powerplant=True)
+    recorded = couple(recording, recording.attach(CheckingPlant()))
+    path_base = os.path.join(tmp_path, 'output')
+    recording.save(path_base)
+
+    # only the solves of the coupling loop are recorded, not the nested ones
+    _, records = read_recording(path_base + '.replay.bin')
+    assert sum(record[0] != 0 for record in records) == 8
+
+    replay = Recording(replay=path_base + '.replay.bin', replay_powerplant=True)
+    replayed = couple(replay, replay.attach(CheckingPlant()))
+    assert replay.diverged == 0
+    assert replayed == [tuple(result) for result in recorded]